@@ -0,0 +1,184 @@
+# backend/analytics.py
+
+"""
+Analytics de uso dos agentes: chamadas, taxa de acerto do cache, percentis de
+latência e mapa de calor por dia da semana x hora.
+
+Os números vêm dos agregados de `usage_rollup.py` (nunca do log bruto
+inteiro) e são somados com NumPy por período. Para não recalcular tudo a cada
+abertura do popup:
+
+- a parte dos dias já fechados (antes de hoje, UTC) é calculada uma vez por
+  dia para cada (usuário, agente, janela, fuso) e fica em cache, a não ser que
+  uma compactação tenha avançado a marca d'água durante a leitura (aí a
+  próxima abertura recalcula);
+- a parte de hoje é recalculada e somada a ela, e o relatório completo fica
+  em cache por `ANALYTICS_CACHE_TTL` segundos.
+
+Os dias do relatório são dias UTC; o fuso (`tz_offset_minutes`) só desloca o
+mapa de calor, que cobre no máximo a retenção dos agregados por hora. Em fusos
+de meia hora (ex: +330), cada hora UTC conta na hora local em que começa.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from cache import TTLCache
+from usage_rollup import LATENCY_BINS, latency_bin_upper_ms
+
+WEEKDAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+PERCENTILES = (0.5, 0.9, 0.99)
+
+# Limite superior de cada faixa de latência, em ms
+_BIN_UPPER_MS = np.array([latency_bin_upper_ms(index) for index in range(LATENCY_BINS)])
+
+
+def latency_percentiles(histogram: np.ndarray) -> dict:
+    """Percentis a partir de um histograma por faixas (limite superior da faixa)."""
+    total = histogram.sum()
+    if total == 0:
+        return {f"p{int(q * 100)}": None for q in PERCENTILES}
+    cumulative = np.cumsum(histogram)
+    indexes = np.searchsorted(cumulative, np.array(PERCENTILES) * total)
+    return {f"p{int(q * 100)}": round(float(_BIN_UPPER_MS[i])) for q, i in zip(PERCENTILES, indexes)}
+
+
+class _Partial:
+    """Somas de um intervalo de dias, prontas para serem combinadas."""
+
+    def __init__(self, days: int):
+        self.agents = {}  # agente -> [chamadas, acertos de cache, histograma de latência]
+        self.daily = np.zeros((days, 2), dtype=np.int64)
+        self.heatmap = np.zeros((7, 24), dtype=np.int64)
+
+    def agent(self, name):
+        if name not in self.agents:
+            self.agents[name] = [0, 0, np.zeros(LATENCY_BINS, dtype=np.int64)]
+        return self.agents[name]
+
+    def __add__(self, other):
+        result = _Partial(len(self.daily))
+        result.daily = self.daily + other.daily
+        result.heatmap = self.heatmap + other.heatmap
+        for partial in (self, other):
+            for name, (calls, cache_hits, histogram) in partial.agents.items():
+                entry = result.agent(name)
+                entry[0] += calls
+                entry[1] += cache_hits
+                entry[2] = entry[2] + histogram
+        return result
+
+
+class UsageAnalytics:
+    def __init__(self, rollup, ttl: float = None, maxsize: int = None):
+        self._rollup = rollup
+        maxsize = maxsize or int(os.getenv("ANALYTICS_CACHE_SIZE", 5000))
+        self._reports = TTLCache(maxsize=maxsize, ttl=ttl or float(os.getenv("ANALYTICS_CACHE_TTL", 60)))
+        # A chave inclui o dia de hoje, então a parte histórica expira sozinha na virada do dia
+        self._history = TTLCache(maxsize=maxsize, ttl=26 * 3600)
+        self.history_builds = 0
+        self.history_skipped = 0
+
+    async def _aggregate(self, since: datetime, until: datetime, origin, days: int,
+                         user_id, agent_name, tz_offset_minutes: int) -> tuple:
+        """(somas do intervalo, marca d'água usada na leitura)."""
+        data = await self._rollup.read(
+            since, until, user_id=user_id, agent_name=agent_name, hourly=True, daily=True, latency=True
+        )
+        partial = _Partial(days)
+
+        if data["daily"]:
+            keys, values = zip(*data["daily"].items())
+            agents, agent_index = np.unique([key[1] for key in keys], return_inverse=True)
+            values = np.array(values, dtype=np.int64)
+            day_index = np.array([(key[2] - origin).days for key in keys])
+            np.add.at(partial.daily, day_index, values)
+            calls = np.bincount(agent_index, weights=values[:, 0], minlength=len(agents))
+            cache_hits = np.bincount(agent_index, weights=values[:, 1], minlength=len(agents))
+            for i, name in enumerate(agents):
+                entry = partial.agent(str(name))
+                entry[0] += int(calls[i])
+                entry[1] += int(cache_hits[i])
+
+        if data["latency"]:
+            keys, counts = zip(*data["latency"].items())
+            agents, agent_index = np.unique([key[1] for key in keys], return_inverse=True)
+            histograms = np.zeros((len(agents), LATENCY_BINS), dtype=np.int64)
+            np.add.at(histograms, (agent_index, np.array([key[3] for key in keys])), np.array(counts, dtype=np.int64))
+            for i, name in enumerate(agents):
+                entry = partial.agent(str(name))
+                entry[2] = entry[2] + histograms[i]
+
+        if data["hourly"]:
+            keys, values = zip(*data["hourly"].items())
+            starts = np.array([key[2] for key in keys], dtype="datetime64[m]") + np.timedelta64(tz_offset_minutes, "m")
+            hours = starts.astype("datetime64[h]")
+            hour_of_day = hours.astype(np.int64) % 24
+            # 1970-01-01 foi uma quinta-feira: +3 faz a segunda-feira ser o dia 0
+            weekday = (hours.astype("datetime64[D]").astype(np.int64) + 3) % 7
+            np.add.at(partial.heatmap, (weekday, hour_of_day), np.array([value[0] for value in values], dtype=np.int64))
+        return partial, data["watermark"]
+
+    async def report(self, days: int = 30, user_id: int = None, agent_name: str = None,
+                     tz_offset_minutes: int = 0) -> dict:
+        """Relatório dos últimos `days` dias (incluindo hoje). `user_id=None` soma todos os usuários."""
+        today = datetime.utcnow().date()
+        key = (user_id, agent_name, days, tz_offset_minutes, today)
+        report = self._reports.get(key)
+        if report is not None:
+            return report
+
+        origin = today - timedelta(days=days - 1)
+        since = datetime.combine(origin, datetime.min.time())
+        today_start = datetime.combine(today, datetime.min.time())
+        history = self._history.get(key)
+        if history is None:
+            history, watermark = await self._aggregate(since, today_start, origin, days, user_id, agent_name, tz_offset_minutes)
+            self.history_builds += 1
+            # Fica em cache até a virada do dia: só se nenhuma compactação terminou no meio da leitura
+            if await self._rollup.watermark() == watermark:
+                self._history.set(key, history)
+            else:
+                self.history_skipped += 1
+        current, _ = await self._aggregate(today_start, None, origin, days, user_id, agent_name, tz_offset_minutes)
+        report = self._render(history + current, origin, days, tz_offset_minutes)
+        self._reports.set(key, report)
+        return report
+
+    @staticmethod
+    def _summary(calls: int, cache_hits: int, histogram: np.ndarray) -> dict:
+        return {
+            "calls": int(calls),
+            "cache_hits": int(cache_hits),
+            "cache_hit_rate": round(cache_hits / calls, 4) if calls else 0.0,
+            "latency_ms": latency_percentiles(histogram),
+        }
+
+    def _render(self, partial: _Partial, origin, days: int, tz_offset_minutes: int) -> dict:
+        agents = {name: self._summary(*values) for name, values in sorted(partial.agents.items())}
+        total_histogram = sum((values[2] for values in partial.agents.values()), np.zeros(LATENCY_BINS, dtype=np.int64))
+        calls, cache_hits = partial.daily.sum(axis=0)
+        # Três horários de maior atividade no mapa de calor
+        flat = partial.heatmap.ravel()
+        peaks = [index for index in np.argsort(flat, kind="stable")[::-1][:3] if flat[index] > 0]
+        return {
+            "since": origin.isoformat(),
+            "days": days,
+            "tz_offset_minutes": tz_offset_minutes,
+            "totals": self._summary(calls, cache_hits, total_histogram),
+            "agents": agents,
+            "daily": [
+                {"day": (origin + timedelta(days=i)).isoformat(), "calls": int(row[0]), "cache_hits": int(row[1])}
+                for i, row in enumerate(partial.daily)
+            ],
+            "heatmap": {"weekdays": WEEKDAYS, "counts": partial.heatmap.tolist()},
+            "peak_hours": [
+                {"weekday": WEEKDAYS[index // 24], "hour": int(index % 24), "calls": int(flat[index])}
+                for index in peaks
+            ],
+        }
+
+    def stats(self) -> dict:
+        return {"reports": self._reports.stats(), "history_builds": self.history_builds, "history_skipped": self.history_skipped}
@@ -0,0 +1,471 @@
+# backend/benchmark.py
+
+"""
+Benchmark de carga do backend com provedores falsos locais (sem custo).
+
+Os clientes da OpenAI, do Gemini e do Stripe são trocados por fakes com
+latência log-normal e taxa de erro configuráveis, na mesma fronteira do SDK:
+limitadores, roteador, cota, cache e banco continuam no caminho medido. O app
+FastAPI real roda no mesmo processo (com o lifespan) sobre um banco
+temporário, e usuários virtuais FREE/PRO chamam todos os agentes em paralelo,
+incluindo streaming, /batch, jobs de imagem e checkout, até esgotarem cota.
+
+Relatório: vazão, p50/p95/p99 por endpoint, status por endpoint (403/429
+esperados para FREE), tempo por etapa e contenção do banco (tempo por tipo de
+comando, de `metrics.py`). Cliente e servidor dividem o event loop, então os
+números servem para comparar versões, não como capacidade absoluta.
+
+Uso:
+    python benchmark.py --users 50 --duration 20 --pro-ratio 0.3
+    python benchmark.py --requests 40 --seed 7 --save baselines/main.json
+    python benchmark.py --requests 40 --seed 7 --compare baselines/main.json --tolerance 0.15
+
+Com `--compare`, o processo sai com código 1 se a vazão cair ou o p95 subir
+mais que a tolerância em relação à baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import timedelta
+from types import SimpleNamespace
+
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+# Endpoints com menos amostras que isso não entram na comparação com a baseline
+MIN_COMPARE_SAMPLES = 20
+# PNG 1x1 devolvido pelo "download" das imagens falsas
+_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44ae426082"
+)
+
+
+# --- Provedores falsos ---
+@dataclass
+class FakeProfile:
+    """Latência log-normal (mediana e dispersão) e taxa de erro de um provedor falso."""
+    median_ms: float
+    sigma: float = 0.4
+    error_rate: float = 0.0
+
+    @classmethod
+    def parse(cls, value: str) -> "FakeProfile":
+        """ "mediana_ms[,sigma[,taxa_de_erro]]", ex: "800,0.5,0.02"."""
+        parts = [float(part) for part in value.split(",")]
+        return cls(*parts)
+
+
+class FakeUpstreamError(Exception):
+    """Erro simulado de um provedor falso."""
+
+
+class FakeProviders:
+    def __init__(self, profiles: dict, seed: int = 0):
+        self.profiles = profiles
+        self.rng = random.Random(seed)
+        self.calls = {name: 0 for name in profiles}
+        self.errors = {name: 0 for name in profiles}
+
+    def _draw(self, name: str) -> tuple:
+        profile = self.profiles[name]
+        self.calls[name] += 1
+        delay = profile.median_ms * self.rng.lognormvariate(0, profile.sigma) / 1000
+        failed = self.rng.random() < profile.error_rate
+        if failed:
+            self.errors[name] += 1
+        return delay, failed
+
+    async def _wait(self, name: str):
+        delay, failed = self._draw(name)
+        await asyncio.sleep(delay)
+        if failed:
+            raise FakeUpstreamError(f"{name} falso: erro simulado")
+
+    @staticmethod
+    def _text_for(prompt: str) -> str:
+        # Agentes com saída estruturada pedem JSON no formato do exemplo do prompt
+        if '"niche_identified"' in prompt:
+            return json.dumps({"niche_identified": "Marketing", "content_style_analysis": "Educativo",
+                               "insights": ["Consistência", "Tom próximo", "Reels"]})
+        for field in ("hashtags", "topics", "variations"):
+            if f'"{field}"' in prompt:
+                items = [f"#tag{i}" for i in range(30)] if field == "hashtags" else \
+                    [f"Sugestão de texto número {i} para o post." for i in range(1, 6)]
+                return json.dumps({field: items}, ensure_ascii=False)
+        return "\n".join(f"{i}. Sugestão de texto número {i} para o post." for i in range(1, 6))
+
+    async def openai_chat(self, model: str, messages: list, stream: bool = False, **kwargs):
+        text = self._text_for(" ".join(message["content"] for message in messages))
+        usage = SimpleNamespace(prompt_tokens=sum(len(m["content"]) // 4 for m in messages), completion_tokens=len(text) // 4)
+        if stream:
+            return self._openai_stream(text)
+        await self._wait("openai")
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage
+        )
+
+    async def _openai_stream(self, text: str):
+        # O tempo até o primeiro trecho segue o perfil; o resto chega em pedaços curtos
+        await self._wait("openai")
+        for start in range(0, len(text), 16):
+            await asyncio.sleep(0.002)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[start:start + 16]))])
+
+    async def openai_image(self, model: str, prompt: str, **kwargs):
+        await self._wait("image")
+        return SimpleNamespace(data=[SimpleNamespace(url=f"https://fake.local/{self.calls['image']}.png")])
+
+    async def gemini_generate(self, model: str, prompt: str):
+        await self._wait("gemini")
+        text = self._text_for(prompt)
+        return SimpleNamespace(
+            text=text,
+            usage_metadata=SimpleNamespace(prompt_token_count=len(prompt) // 4, candidates_token_count=len(text) // 4),
+        )
+
+    async def gemini_stream(self, model: str, prompt: str):
+        await self._wait("gemini")
+        text = self._text_for(prompt)
+        for start in range(0, len(text), 16):
+            await asyncio.sleep(0.002)
+            part = SimpleNamespace(text=text[start:start + 16])
+            yield SimpleNamespace(text=part.text, candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    def stripe_checkout(self, **kwargs):
+        # O SDK do Stripe é síncrono e roda no pool de threads de providers.py
+        delay, failed = self._draw("stripe")
+        time.sleep(delay)
+        if failed:
+            raise FakeUpstreamError("stripe falso: erro simulado")
+        return SimpleNamespace(url="https://checkout.fake.local/session")
+
+    async def download(self, url: str) -> bytes:
+        await self._wait("download")
+        return _PNG
+
+    async def _close(self):
+        pass
+
+    async def install(self, providers, main):
+        """Troca os clientes do registro de `providers` e o download de imagens dos jobs."""
+        fakes = self
+        await providers.registry.openai.close()
+        providers.registry.openai = SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=self.openai_chat)),
+            images=SimpleNamespace(generate=self.openai_image),
+            close=self._close,
+        )
+
+        class _GenerativeModel:
+            def __init__(self, model):
+                self.model = model
+
+            async def generate_content_async(self, prompt, stream=False, **kwargs):
+                if stream:
+                    return fakes.gemini_stream(self.model, prompt)
+                return await fakes.gemini_generate(self.model, prompt)
+
+        providers.registry.set_gemini_factory(_GenerativeModel)
+        providers.registry.stripe = SimpleNamespace(
+            checkout=SimpleNamespace(Session=SimpleNamespace(create=self.stripe_checkout))
+        )
+        main.image_jobs._download = self.download
+
+    def stats(self) -> dict:
+        return {name: {"calls": self.calls[name], "errors": self.errors[name]} for name in self.profiles}
+
+
+DEFAULT_PROFILES = {
+    "openai": FakeProfile(900, 0.5, 0.01),
+    "gemini": FakeProfile(700, 0.5, 0.01),
+    "image": FakeProfile(4000, 0.3, 0.02),
+    "download": FakeProfile(150, 0.3, 0.0),
+    "stripe": FakeProfile(400, 0.3, 0.0),
+}
+
+
+# --- Carga ---
+TOPICS = [
+    "marketing digital", "receitas fit", "viagem barata", "finanças pessoais", "moda praia", "pets",
+    "skincare", "home office", "café especial", "corrida", "maternidade", "games", "decoração",
+    "fotografia", "vinhos", "jardinagem", "idiomas", "yoga", "empreendedorismo", "música",
+]
+
+
+def _topic(rng: random.Random, distinct: int) -> str:
+    # Distribuição enviesada (poucos temas muito repetidos) para exercitar o cache de respostas
+    index = min(int(rng.paretovariate(1.2)) - 1, distinct - 1)
+    return f"{TOPICS[index % len(TOPICS)]} {index // len(TOPICS)}".strip()
+
+
+def _requests(rng: random.Random, distinct: int) -> dict:
+    topic = _topic(rng, distinct)
+    return {
+        "gerar-copy-social-media": {"prompt": f"Post sobre {topic}", "tone": rng.choice(["divertido", "formal"])},
+        "pesquisar-hashtags": {"topic": topic, "niche": "lifestyle"},
+        "suggest-content-topics": {"niche": topic},
+        "analyze-competitor-profile": {
+            "username": f"perfil_{topic.replace(' ', '_')}", "bio": f"Tudo sobre {topic}",
+            "recent_captions": [f"Dica de {topic}", f"Novidade em {topic}"],
+        },
+        "generate-copy-variations": {"original_copy": f"Conheça o melhor de {topic}!"},
+        "gerar-imagem": {"prompt": f"Capa sobre {topic}", "style": "minimalista"},
+    }
+
+
+# (nome no relatório, método, caminho, agente cujo corpo é usado, peso)
+ENDPOINTS = [
+    ("POST /gerar-copy-social-media", "POST", "/gerar-copy-social-media", "gerar-copy-social-media", 20),
+    ("POST /gerar-copy-social-media/stream", "POST", "/gerar-copy-social-media/stream", "gerar-copy-social-media", 5),
+    ("POST /pesquisar-hashtags", "POST", "/pesquisar-hashtags", "pesquisar-hashtags", 20),
+    ("POST /suggest-content-topics", "POST", "/suggest-content-topics", "suggest-content-topics", 10),
+    ("POST /analyze-competitor-profile", "POST", "/analyze-competitor-profile", "analyze-competitor-profile", 8),
+    ("POST /generate-copy-variations", "POST", "/generate-copy-variations", "generate-copy-variations", 8),
+    ("POST /generate-copy-variations/stream", "POST", "/generate-copy-variations/stream", "generate-copy-variations", 4),
+    ("POST /gerar-imagem", "POST", "/gerar-imagem", "gerar-imagem", 4),
+    ("POST /batch", "POST", "/batch", None, 4),
+    ("GET /users/me/usage", "GET", "/users/me/usage", None, 3),
+    ("GET /analytics/usage", "GET", "/analytics/usage", None, 2),
+    ("POST /create-checkout-session", "POST", "/create-checkout-session", None, 2),
+]
+
+
+@dataclass
+class BenchConfig:
+    users: int = 50
+    pro_ratio: float = 0.3
+    duration: float = 20.0
+    requests: int = 0            # > 0: número fixo de requisições por usuário (ignora `duration`)
+    think_ms: float = 50.0
+    distinct_prompts: int = 200
+    seed: int = 0
+
+
+def _body(name: str, agent, rng: random.Random, distinct: int):
+    if name == "POST /batch":
+        bodies = _requests(rng, distinct)
+        agents = rng.sample(["gerar-copy-social-media", "pesquisar-hashtags", "suggest-content-topics"], 2)
+        return {"items": [{"id": str(i), "agent": a, "request": bodies[a]} for i, a in enumerate(agents)]}
+    if name == "POST /create-checkout-session":
+        return {"price_id": "price_fake", "success_url": "https://x/ok", "cancel_url": "https://x/cancel"}
+    if agent is None:
+        return None
+    return _requests(rng, distinct)[agent]
+
+
+async def _virtual_user(client, token: str, config: BenchConfig, rng: random.Random, deadline: float, samples: list):
+    headers = {"Authorization": f"Bearer {token}"}
+    weights = [endpoint[4] for endpoint in ENDPOINTS]
+    sent = 0
+    while (sent < config.requests) if config.requests else (time.perf_counter() < deadline):
+        name, method, path, agent, _ = rng.choices(ENDPOINTS, weights)[0]
+        body = _body(name, agent, rng, config.distinct_prompts)
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, path, json=body, headers=headers)
+            status = response.status_code
+        except Exception:
+            status = 599  # exceção no transporte (o app não respondeu)
+        samples.append((name, status, time.perf_counter() - started))
+        sent += 1
+        if config.think_ms:
+            await asyncio.sleep(rng.expovariate(1000 / config.think_ms))
+
+
+def _histogram_snapshot(histogram) -> dict:
+    return {values: (list(child.counts), child.sum) for values, child in histogram._children.items()}
+
+
+def _histogram_delta(histogram, before: dict) -> dict:
+    """Contagem, soma e p95/p99 aproximados (limite superior do bucket) desde `before`."""
+    bounds = np.array(histogram.buckets + (float("inf"),))
+    result = {}
+    for values, (counts, total) in _histogram_snapshot(histogram).items():
+        old_counts, old_total = before.get(values, ([0] * len(counts), 0.0))
+        delta = np.array(counts) - np.array(old_counts)
+        count = int(delta.sum())
+        if count == 0:
+            continue
+        cumulative = np.cumsum(delta)
+        entry = {"count": count, "total_s": round(total - old_total, 4), "mean_ms": round((total - old_total) / count * 1000, 3)}
+        for q in (95, 99):
+            entry[f"p{q}_ms_le"] = float(bounds[np.searchsorted(cumulative, q / 100 * count)]) * 1000
+        result["/".join(values)] = entry
+    return result
+
+
+def _summarize(samples: list, elapsed: float) -> dict:
+    by_endpoint = {}
+    for name, status, seconds in samples:
+        by_endpoint.setdefault(name, []).append((status, seconds))
+
+    def summary(entries):
+        latencies = np.array([seconds for _, seconds in entries]) * 1000
+        statuses = {}
+        for status, _ in entries:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        result = {"requests": len(entries), "throughput_rps": round(len(entries) / elapsed, 2), "status": statuses}
+        for q, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+            result[f"p{q}_ms"] = round(float(value), 1)
+        return result
+
+    return {
+        "overall": summary([(status, seconds) for _, status, seconds in samples]),
+        "endpoints": {name: summary(entries) for name, entries in sorted(by_endpoint.items())},
+    }
+
+
+def _prepare_environment(workdir: str, database_url: str = None):
+    # Precisa acontecer antes de importar main: a configuração é lida no import
+    os.environ.setdefault("DATABASE_URL", database_url or f"sqlite:///{workdir}/bench.db")
+    os.environ.setdefault("RESPONSE_CACHE_PATH", os.path.join(workdir, "response_cache.db"))
+    os.environ.setdefault("SEMANTIC_CACHE_PATH", os.path.join(workdir, "semantic_cache.npz"))
+    os.environ.setdefault("MEDIA_DIR", os.path.join(workdir, "media"))
+    os.environ.setdefault("OPENAI_API_KEY", "fake")
+    os.environ.setdefault("GEMINI_API_KEY", "fake")
+    # Sem aquecimento: os provedores reais não são contatados
+    os.environ.setdefault("PROVIDER_WARMUP", "0")
+
+
+async def run_benchmark(config: BenchConfig, profiles: dict = None, database_url: str = None) -> dict:
+    import httpx
+
+    workdir = tempfile.mkdtemp(prefix="monsterapp-bench-")
+    _prepare_environment(workdir, database_url)
+    import main
+    import metrics
+    import providers
+
+    fakes = FakeProviders(profiles or DEFAULT_PROFILES, seed=config.seed)
+    rng = random.Random(config.seed)
+    async with main.app.router.lifespan_context(main.app):
+        # O pré-carregamento dos provedores roda em segundo plano: espera antes de trocar os clientes
+        await main.startup_report.wait_ready()
+        await fakes.install(providers, main)
+        tokens = []
+        async with main.SessionLocal() as db:
+            for i in range(config.users):
+                plan = main.Plan.PRO if rng.random() < config.pro_ratio else main.Plan.FREE
+                email = f"bench{i}@monsterapp.local"
+                db.add(main.User(email=email, plan=plan))
+                tokens.append(main.create_access_token({"sub": email}, timedelta(hours=6)))
+            await db.commit()
+
+        db_before = _histogram_snapshot(metrics.DB_SECONDS)
+        stages_before = _histogram_snapshot(metrics.STAGE_SECONDS)
+        samples = []
+        transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            started = time.perf_counter()
+            deadline = started + config.duration
+            await asyncio.gather(*(
+                _virtual_user(client, token, config, random.Random(config.seed * 100003 + i), deadline, samples)
+                for i, token in enumerate(tokens)
+            ))
+            elapsed = time.perf_counter() - started
+
+        report = _summarize(samples, elapsed)
+        report["elapsed_s"] = round(elapsed, 2)
+        report["db"] = _histogram_delta(metrics.DB_SECONDS, db_before)
+        report["stages"] = _histogram_delta(metrics.STAGE_SECONDS, stages_before)
+        report["providers"] = fakes.stats()
+        report["router"] = main.provider_router.stats()
+    return report
+
+
+# --- Baseline ---
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Regressões em relação à baseline: vazão menor ou p95 maior que a tolerância."""
+    regressions = []
+    pairs = [("overall", report["overall"], baseline["results"]["overall"])]
+    pairs += [
+        (name, entry, baseline["results"]["endpoints"][name])
+        for name, entry in report["endpoints"].items()
+        if name in baseline["results"]["endpoints"]
+        and min(entry["requests"], baseline["results"]["endpoints"][name]["requests"]) >= MIN_COMPARE_SAMPLES
+    ]
+    for name, current, previous in pairs:
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+    current, previous = report["overall"]["throughput_rps"], baseline["results"]["overall"]["throughput_rps"]
+    if current < previous * (1 - tolerance):
+        regressions.append(f"overall: vazão {previous} req/s -> {current} req/s")
+    return regressions
+
+
+def _print_report(report: dict):
+    overall = report["overall"]
+    print(f"\n{overall['requests']} requisições em {report['elapsed_s']}s: {overall['throughput_rps']} req/s, "
+          f"p50 {overall['p50_ms']}ms, p95 {overall['p95_ms']}ms, p99 {overall['p99_ms']}ms")
+    print(f"\n{'endpoint':42} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8}  status")
+    for name, entry in report["endpoints"].items():
+        print(f"{name:42} {entry['requests']:>6} {entry['p50_ms']:>8} {entry['p95_ms']:>8} {entry['p99_ms']:>8}  {entry['status']}")
+    print(f"\n{'etapa / comando SQL':42} {'n':>6} {'média':>8} {'p95<=':>8} {'total s':>8}")
+    for section in ("stages", "db"):
+        for name, entry in sorted(report[section].items(), key=lambda item: -item[1]["total_s"]):
+            label = f"db {name}" if section == "db" else name
+            print(f"{label:42} {entry['count']:>6} {entry['mean_ms']:>8} {entry['p95_ms_le']:>8} {entry['total_s']:>8}")
+    print(f"\nprovedores falsos: {report['providers']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de carga do MonsterApp com provedores falsos.")
+    defaults = BenchConfig()
+    parser.add_argument("--users", type=int, default=defaults.users, help="usuários virtuais simultâneos")
+    parser.add_argument("--pro-ratio", type=float, default=defaults.pro_ratio, help="fração de usuários PRO")
+    parser.add_argument("--duration", type=float, default=defaults.duration, help="segundos de carga")
+    parser.add_argument("--requests", type=int, default=defaults.requests, help="requisições por usuário (substitui --duration)")
+    parser.add_argument("--think-ms", type=float, default=defaults.think_ms, help="pausa média entre requisições de um usuário")
+    parser.add_argument("--distinct-prompts", type=int, default=defaults.distinct_prompts, help="variedade de temas (menos = mais acertos de cache)")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--database-url", help="banco alternativo (padrão: SQLite temporário)")
+    for name, profile in DEFAULT_PROFILES.items():
+        parser.add_argument(f"--{name}", type=FakeProfile.parse, default=profile,
+                            help=f"perfil do {name} falso: mediana_ms,sigma,taxa_de_erro (padrão {profile.median_ms:g},{profile.sigma:g},{profile.error_rate:g})")
+    parser.add_argument("--save", help="grava o relatório como baseline neste arquivo JSON")
+    parser.add_argument("--compare", help="compara com uma baseline salva por --save")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="piora relativa aceita na comparação")
+    args = parser.parse_args(argv)
+
+    config = BenchConfig(args.users, args.pro_ratio, args.duration, args.requests, args.think_ms, args.distinct_prompts, args.seed)
+    profiles = {name: getattr(args, name) for name in DEFAULT_PROFILES}
+    report = asyncio.run(run_benchmark(config, profiles, args.database_url))
+    _print_report(report)
+
+    document = {
+        "config": asdict(config),
+        "profiles": {name: asdict(profile) for name, profile in profiles.items()},
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "results": report,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(document, f, indent=2, ensure_ascii=False)
+        print(f"\nBaseline gravada em {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["config"] != document["config"] or baseline["profiles"] != document["profiles"]:
+            print("\nAviso: configuração diferente da baseline; a comparação pode não ser justa.")
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("\nRegressões acima de {:.0%}:".format(args.tolerance))
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nSem regressões acima de {args.tolerance:.0%} em relação a {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# backend/cache.py
+
+"""
+Caches em memória usados nos caminhos quentes da API.
+"""
+
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+
+class TTLCache:
+    """
+    Cache LRU com expiração por item.
+
+    Não é thread-safe: foi feito para ser usado a partir do event loop.
+    Conta acertos, faltas e remoções para podermos acompanhar a eficácia.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Cópia imutável dos campos de `User` que os endpoints usam."""
+    id: int
+    email: str
+    plan: str
+    stripe_customer_id: Optional[str] = None
+
+    @classmethod
+    def from_user(cls, user) -> "UserSnapshot":
+        return cls(id=user.id, email=user.email, plan=user.plan, stripe_customer_id=user.stripe_customer_id)
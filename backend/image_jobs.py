@@ -0,0 +1,328 @@
+# backend/image_jobs.py
+
+"""
+Fila de jobs de geração de imagem (DALL-E).
+
+`/gerar-imagem` só cria o job e responde na hora; um pool limitado de
+workers processa a fila, baixa a imagem uma única vez para um armazenamento
+local endereçado por conteúdo (SHA-256) e a imagem passa a ser servida pelo
+próprio backend, sem depender da URL temporária da OpenAI.
+
+- Justiça entre usuários: a fila é round-robin por usuário, então quem
+  enfileira 10 imagens não atrasa a imagem única de outra pessoa.
+- Persistência: o estado do job fica em `image_jobs`. Jobs enfileirados (ou
+  interrompidos no meio, depois que a concessão expira) são retomados quando
+  o worker reinicia.
+- Cota: a reserva feita em `/gerar-imagem` fica presa ao job e só é
+  confirmada quando a imagem fica pronta (com a latência real da geração);
+  se o job falhar ou for abandonado, ela é devolvida.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import select, update
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TERMINAL_STATUSES = (SUCCEEDED, FAILED)
+
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+
+
+class FairQueue:
+    """Fila round-robin por usuário."""
+
+    def __init__(self):
+        self._queues = OrderedDict()
+        self._available = asyncio.Semaphore(0)
+
+    def put(self, user_id, item):
+        self._queues.setdefault(user_id, deque()).append(item)
+        self._available.release()
+
+    async def get(self):
+        await self._available.acquire()
+        user_id, queue = next(iter(self._queues.items()))
+        item = queue.popleft()
+        # O usuário atendido vai para o fim da fila (ou sai dela, se não tiver mais jobs)
+        del self._queues[user_id]
+        if queue:
+            self._queues[user_id] = queue
+        return user_id, item
+
+    def __len__(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+
+class MediaStore:
+    """Arquivos endereçados pelo SHA-256 do conteúdo: `<dir>/ab/abcdef....png`."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path_for(self, digest: str) -> str:
+        if not _DIGEST.match(digest):
+            raise ValueError("Hash de mídia inválido")
+        return os.path.join(self.root, digest[:2], f"{digest}.png")
+
+    def save(self, content: bytes) -> str:
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.path_for(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return digest
+
+
+class ImageJobManager:
+    def __init__(self, session_factory, job_model, generate, media_dir: str = None, workers: int = None,
+                 lease_seconds: float = None, max_attempts: int = None, sweep_interval: float = None,
+                 record_usage=None):
+        self._session_factory = session_factory
+        self._job_model = job_model
+        self._generate = generate  # async (prompt) -> URL temporária da imagem
+        # async (user_id, latency_ms): registra o uso de um job sem reserva neste processo
+        # (enfileirado antes de um restart ou por outro worker)
+        self._record_usage = record_usage
+        self.media = MediaStore(media_dir or os.getenv("MEDIA_DIR", "./media"))
+        self.workers = workers or int(os.getenv("IMAGE_WORKERS", 4))
+        # Depois disso um job "running" é considerado abandonado (worker morreu)
+        self.lease = timedelta(seconds=lease_seconds or float(os.getenv("IMAGE_JOB_LEASE_SECONDS", 600)))
+        self.max_attempts = max_attempts or int(os.getenv("IMAGE_JOB_MAX_ATTEMPTS", 2))
+        self.sweep_interval = sweep_interval or float(os.getenv("IMAGE_JOB_SWEEP_INTERVAL", 30))
+        self._queue = FairQueue()
+        self._known = set()
+        self._running = set()
+        self._events = {}
+        self._reservations = {}  # job_id -> quota.Reservation ainda não confirmada
+        self._tasks = []
+        self._http = None
+
+    # --- Banco de dados ---
+    async def _insert(self, job_id, user_id, prompt):
+        async with self._session_factory() as db:
+            db.add(self._job_model(id=job_id, user_id=user_id, prompt=prompt, status=QUEUED))
+            await db.commit()
+
+    async def _get(self, job_id):
+        async with self._session_factory() as db:
+            job = await db.get(self._job_model, job_id)
+            if job is None:
+                return None
+            return {
+                "id": job.id,
+                "user_id": job.user_id,
+                "status": job.status,
+                "image_sha256": job.image_sha256,
+                "error": job.error,
+                "created_at": job.created_at,
+                "finished_at": job.finished_at,
+            }
+
+    async def _claim(self, job_id):
+        """Passa o job de queued para running; None se outro worker já o pegou."""
+        Job = self._job_model
+        async with self._session_factory() as db:
+            prompt = await db.scalar(
+                update(Job)
+                .where(Job.id == job_id, Job.status == QUEUED)
+                .values(status=RUNNING, started_at=datetime.utcnow(), attempts=Job.attempts + 1)
+                .returning(Job.prompt)
+            )
+            await db.commit()
+            return prompt
+
+    async def _finish(self, job_id, status, image_sha256=None, error=None):
+        Job = self._job_model
+        async with self._session_factory() as db:
+            await db.execute(
+                update(Job).where(Job.id == job_id)
+                .values(status=status, image_sha256=image_sha256, error=error, finished_at=datetime.utcnow())
+            )
+            await db.commit()
+
+    async def _requeue(self, job_ids):
+        Job = self._job_model
+        async with self._session_factory() as db:
+            await db.execute(update(Job).where(Job.id.in_(job_ids), Job.status == RUNNING).values(status=QUEUED))
+            await db.commit()
+
+    async def _recover(self):
+        """
+        Devolve à fila os jobs abandonados e lista os jobs enfileirados.
+        Retorna (enfileirados, ids dos jobs que esgotaram as tentativas).
+        """
+        Job = self._job_model
+        expired = datetime.utcnow() - self.lease
+        abandoned = (Job.status == RUNNING, Job.started_at < expired)
+        async with self._session_factory() as db:
+            failed = await db.scalars(
+                update(Job).where(*abandoned, Job.attempts >= self.max_attempts)
+                .values(status=FAILED, error="Job interrompido repetidas vezes", finished_at=datetime.utcnow())
+                .returning(Job.id)
+            )
+            failed = failed.all()
+            await db.execute(update(Job).where(*abandoned, Job.attempts < self.max_attempts).values(status=QUEUED))
+            await db.commit()
+            result = await db.execute(select(Job.id, Job.user_id).where(Job.status == QUEUED).order_by(Job.created_at))
+            return result.all(), failed
+
+    # --- Cota ---
+    async def _settle(self, job_id, user_id, succeeded: bool, latency_ms: int = None):
+        """Confirma a cota do job que gerou a imagem; devolve a de quem falhou."""
+        reservation = self._reservations.pop(job_id, None)
+        if not succeeded:
+            if reservation is not None:
+                await reservation.release()
+        elif reservation is not None:
+            reservation.commit(latency_ms=latency_ms)
+        elif self._record_usage is not None:
+            await self._record_usage(user_id, latency_ms)
+
+    # --- Fila e workers ---
+    def _enqueue_local(self, job_id, user_id):
+        if job_id not in self._known:
+            self._known.add(job_id)
+            self._queue.put(user_id, job_id)
+
+    async def submit(self, user_id: int, prompt: str, reservation=None) -> str:
+        """
+        Cria o job. A `reservation` (quota.Reservation) passa a ser do job:
+        confirmada quando a imagem fica pronta, devolvida se ele falhar.
+        Se `submit` levantar uma exceção, a reserva continua com o chamador.
+        """
+        job_id = uuid.uuid4().hex
+        if reservation is not None:
+            self._reservations[job_id] = reservation
+        try:
+            await self._insert(job_id, user_id, prompt)
+        except BaseException:
+            self._reservations.pop(job_id, None)
+            raise
+        self._enqueue_local(job_id, user_id)
+        return job_id
+
+    async def _download(self, url) -> bytes:
+        response = await self._http.get(url)
+        response.raise_for_status()
+        return response.content
+
+    async def _process(self, user_id, job_id):
+        self._known.discard(job_id)
+        prompt = await self._claim(job_id)
+        if prompt is None:
+            return
+        self._running.add(job_id)
+        started = time.monotonic()
+        try:
+            url = await self._generate(prompt)
+            content = await self._download(url)
+            digest = await asyncio.to_thread(self.media.save, content)
+            await self._finish(job_id, SUCCEEDED, digest)
+            succeeded = True
+        except asyncio.CancelledError:
+            # Worker parado no meio do job: ele continua em _running e stop() o devolve à fila
+            raise
+        except Exception as e:
+            logger.warning("Job de imagem %s falhou: %s", job_id, e)
+            await self._finish(job_id, FAILED, None, str(e))
+            succeeded = False
+        self._running.discard(job_id)
+        try:
+            await self._settle(job_id, user_id, succeeded, int((time.monotonic() - started) * 1000))
+        except Exception:
+            logger.exception("Falha ao acertar a cota do job de imagem %s", job_id)
+        event = self._events.pop(job_id, None)
+        if event:
+            event.set()
+
+    async def _worker(self):
+        while True:
+            user_id, job_id = await self._queue.get()
+            try:
+                await self._process(user_id, job_id)
+            except Exception:
+                logger.exception("Erro inesperado no worker de imagens (job %s)", job_id)
+
+    async def _sweep(self):
+        while True:
+            try:
+                queued, failed = await self._recover()
+                for job_id, user_id in queued:
+                    self._enqueue_local(job_id, user_id)
+                # Concessão expirada sem mais tentativas: a cota volta para o usuário
+                for job_id in failed:
+                    reservation = self._reservations.pop(job_id, None)
+                    if reservation is not None:
+                        await reservation.release()
+            except Exception:
+                logger.exception("Falha ao recuperar jobs de imagem")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def start(self):
+        self._queue = FairQueue()
+        self._known.clear()
+        self._http = httpx.AsyncClient(timeout=60, follow_redirects=True)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Jobs interrompidos voltam para a fila e serão retomados no próximo start
+        if self._running:
+            await self._requeue(list(self._running))
+            self._running.clear()
+        # Reservas não sobrevivem ao processo: devolve-as, e o job retomado
+        # depois do restart registra o uso quando terminar (record_usage)
+        reservations, self._reservations = self._reservations, {}
+        for reservation in reservations.values():
+            await reservation.release()
+        if self._http:
+            await self._http.aclose()
+            self._http = None
+
+    # --- Consulta ---
+    async def get(self, job_id: str):
+        return await self._get(job_id)
+
+    async def wait(self, job_id: str, timeout: float):
+        """
+        Long-poll: espera o job terminar (ou o timeout) e devolve seu estado.
+        Se o job estiver em outro worker, consulta o banco a cada segundo.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            job = await self.get(job_id)
+            remaining = deadline - loop.time()
+            if job is None or job["status"] in TERMINAL_STATUSES or remaining <= 0:
+                if job_id not in self._running:
+                    self._events.pop(job_id, None)
+                return job
+            event = self._events.setdefault(job_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(event.wait(), min(remaining, 1.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {"queued": len(self._queue), "running": len(self._running), "workers": self.workers}
@@ -1,25 +1,48 @@
 # backend/main.py
 
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import os
-import re
-import stripe # Importar a biblioteca Stripe
-from fastapi import FastAPI, HTTPException, Depends
+import asyncio
+import hmac
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse, Response
+from pydantic import BaseModel, ValidationError
+from typing import Optional, Callable
+from dataclasses import dataclass
+from collections import Counter
 
 # --- Adicionando os novos imports ---
-from sqlalchemy import create_engine, Column, Integer, String, Enum, DateTime
+from sqlalchemy import Column, Integer, String, Enum, DateTime, Date, Boolean, false, select
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 import enum
 
-# --- Configuração do Banco de Dados (SQLite) ---
-DATABASE_URL = "sqlite:///./monsterapp.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+from quota import QuotaEngine
+from cache import TTLCache, UserSnapshot
+import response_cache
+import semantic_cache
+import prompts
+from singleflight import SingleFlight
+import streaming
+import structured
+from image_jobs import ImageJobManager
+from usage_rollup import UsageRollup
+from analytics import UsageAnalytics
+import database
+import metrics
+from startup import StartupReport
+
+# --- Configuração do Banco de Dados ---
+# SQLite (WAL) por padrão; DATABASE_URL aceita um banco de servidor com pool (ver database.py)
+engine = database.create_engine_from_env()
+metrics.instrument_engine(engine)
+SessionLocal = database.create_session_factory(engine)
 Base = declarative_base()
 
 # --- Modelos do Banco de Dados (SQLAlchemy) ---
@@ -41,46 +64,113 @@ class ApiUsage(Base):
     user_id = Column(Integer, index=True)
     agent_name = Column(String, index=True)
     timestamp = Column(DateTime, default=datetime.utcnow)
-
-# Cria as tabelas no banco de dados na primeira execução
-Base.metadata.create_all(bind=engine)
+    cache_hit = Column(Boolean, default=False, nullable=False, server_default=false())
+    latency_ms = Column(Integer, nullable=True)  # duração da chamada ao agente (só respostas fora do cache)
+
+# Agregados de api_usage mantidos pelo UsageRollup (ver usage_rollup.py)
+class UsageHourly(Base):
+    __tablename__ = "usage_hourly"
+    user_id = Column(Integer, primary_key=True)
+    agent_name = Column(String, primary_key=True)
+    bucket = Column(DateTime, primary_key=True, index=True)  # início da hora (UTC)
+    count = Column(Integer, nullable=False, default=0)
+    cache_hits = Column(Integer, nullable=False, default=0)
+
+class UsageDaily(Base):
+    __tablename__ = "usage_daily"
+    user_id = Column(Integer, primary_key=True)
+    agent_name = Column(String, primary_key=True)
+    bucket = Column(Date, primary_key=True, index=True)  # dia (UTC)
+    count = Column(Integer, nullable=False, default=0)
+    cache_hits = Column(Integer, nullable=False, default=0)
+
+class UsageLatencyDaily(Base):
+    __tablename__ = "usage_latency_daily"
+    user_id = Column(Integer, primary_key=True)
+    agent_name = Column(String, primary_key=True)
+    bucket = Column(Date, primary_key=True, index=True)  # dia (UTC)
+    bin = Column(Integer, primary_key=True)  # faixa de latência (ver usage_rollup.latency_bin)
+    count = Column(Integer, nullable=False, default=0)
+
+class RollupState(Base):
+    __tablename__ = "rollup_state"
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False)  # maior api_usage.id já compactado
+
+class ImageJob(Base):
+    __tablename__ = "image_jobs"
+    id = Column(String, primary_key=True)  # uuid4 hex
+    user_id = Column(Integer, index=True, nullable=False)
+    prompt = Column(String, nullable=False)
+    status = Column(String, index=True, nullable=False, default="queued")  # queued, running, succeeded, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    image_sha256 = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
 
 # --- Configuração da Autenticação (JWT) ---
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "a_super_secret_key_for_development") # Use uma chave segura em produção
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7 # 1 semana
 
-from fastapi.security import OAuth2PasswordBearer
+from fastapi.security import OAuth2PasswordBearer, HTTPBearer, HTTPAuthorizationCredentials
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Endpoints internos (analytics de todos os usuários, estatísticas, métricas) exigem
+# `Authorization: Bearer <INTERNAL_API_TOKEN>`; sem o token configurado, respondem 404
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN", "")
+internal_bearer = HTTPBearer(auto_error=False)
+
 # --- Funções de Dependência ---
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# Snapshots dos usuários autenticados, chaveados pelo "sub" do token (email).
+# Qualquer mudança de plano precisa chamar invalidate_user_cache.
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("USER_CACHE_TTL", 60))
+)
+
+def invalidate_user_cache(email: str):
+    user_cache.invalidate(email)
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> UserSnapshot:
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with metrics.stage("auth_jwt"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             raise credentials_exception
         token_data = TokenData(email=email)
     except JWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.email == token_data.email).first()
+    user = user_cache.get(token_data.email)
     if user is None:
-        raise credentials_exception
+        with metrics.stage("auth_user_lookup"):
+            async with SessionLocal() as db:
+                db_user = await db.scalar(select(User).where(User.email == token_data.email))
+        if db_user is None:
+            raise credentials_exception
+        user = UserSnapshot.from_user(db_user)
+        user_cache.set(token_data.email, user)
     return user
 
+async def require_internal_token(credentials: Optional[HTTPAuthorizationCredentials] = Depends(internal_bearer)):
+    if not INTERNAL_API_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if credentials is None or not hmac.compare_digest(credentials.credentials.encode(), INTERNAL_API_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Token interno inválido.", headers={"WWW-Authenticate": "Bearer"})
+
 # --- Funções de Limite de Uso ---
 FREE_TIER_LIMITS = {
     "gerar-copy-social-media": 5,  # 5 usos por dia
@@ -88,30 +178,84 @@ FREE_TIER_LIMITS = {
     "gerar-imagem": 2,             # 2 usos por dia
 }
 
-def check_and_log_usage(db: Session, user: User, agent_name: str):
-    if user.plan == Plan.FREE:
-        limit = FREE_TIER_LIMITS.get(agent_name, 0)
-        if limit > 0:
-            # Calcula o início do dia (UTC)
-            start_of_day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-            
-            usage_count = db.query(ApiUsage).filter(
-                ApiUsage.user_id == user.id,
-                ApiUsage.agent_name == agent_name,
-                ApiUsage.timestamp >= start_of_day
-            ).count()
-
-            if usage_count >= limit:
-                raise HTTPException(
-                    status_code=429, 
-                    detail=f"Limite de uso diário excedido para {agent_name}. Faça upgrade para o plano PRO para uso ilimitado."
-                )
-    
-    # Registra o uso
-    new_usage = ApiUsage(user_id=user.id, agent_name=agent_name)
-    db.add(new_usage)
-    db.commit()
-    db.refresh(new_usage)
+# Limite de rajada por usuário (todas as chamadas de agentes somadas)
+BURST_WINDOW_SECONDS = float(os.getenv("BURST_WINDOW_SECONDS", 60))
+BURST_LIMITS = {
+    Plan.FREE: int(os.getenv("BURST_LIMIT_FREE", 10)),  # 10 chamadas por minuto
+    Plan.PRO: int(os.getenv("BURST_LIMIT_PRO", 60)),    # 60 chamadas por minuto
+}
+
+# Respostas em cache contam na cota diária? "count" (padrão) ou "free" (registradas, mas não contam)
+RESPONSE_CACHE_QUOTA_POLICY = os.getenv("RESPONSE_CACHE_QUOTA_POLICY", "count")
+
+# Compactação de api_usage em agregados por hora/dia e retenção do log bruto
+usage_rollup = UsageRollup(SessionLocal, ApiUsage, UsageHourly, UsageDaily, UsageLatencyDaily, RollupState)
+
+usage_analytics = UsageAnalytics(usage_rollup)
+
+# Backend dos contadores em QUOTA_BACKEND: "memory" (um worker) ou "sqlite" (vários workers)
+quota_engine = QuotaEngine(
+    SessionLocal, ApiUsage, count_cache_hits=RESPONSE_CACHE_QUOTA_POLICY != "free", rollup=usage_rollup
+)
+
+async def enforce_burst_limit(user: UserSnapshot, agent_name: str):
+    with metrics.stage("quota"):
+        retry_after = await quota_engine.check_burst(user.id, BURST_LIMITS.get(user.plan, 0), BURST_WINDOW_SECONDS)
+    if retry_after > 0:
+        metrics.QUOTA_REJECTIONS.labels(agent_name, "burst").inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Muitas requisições em sequência. Aguarde alguns segundos e tente novamente.",
+            headers={"Retry-After": str(int(retry_after) + 1)}
+        )
+
+async def reserve_usage(user: UserSnapshot, agent_name: str, amount: int = 1, cache_hit: bool = False):
+    """
+    Aplica o limite de rajada e reserva `amount` usos na cota diária.
+    O chamador confirma com `reservation.commit()` ou devolve com `release()`.
+    """
+    # Contadores diários fora do banco principal (ver quota.py); o registro em api_usage é gravado em lote
+    await enforce_burst_limit(user, agent_name)
+    limit = FREE_TIER_LIMITS.get(agent_name, 0) if user.plan == Plan.FREE else 0
+    with metrics.stage("quota"):
+        reservation = await quota_engine.reserve(user.id, agent_name, limit, amount=amount, cache_hit=cache_hit)
+    if reservation is None:
+        metrics.QUOTA_REJECTIONS.labels(agent_name, "daily").inc()
+        raise HTTPException(
+            status_code=429, 
+            detail=f"Limite de uso diário excedido para {agent_name}. Faça upgrade para o plano PRO para uso ilimitado."
+        )
+    return reservation
+
+async def check_and_log_usage(user: UserSnapshot, agent_name: str, cache_hit: bool = False):
+    reservation = await reserve_usage(user, agent_name, cache_hit=cache_hit)
+    reservation.commit()
+
+def elapsed_ms(started: float) -> int:
+    return int((time.monotonic() - started) * 1000)
+
+# --- Cache de Respostas dos Agentes ---
+# TTL (segundos) por agente; agentes fora da lista não usam cache
+RESPONSE_CACHE_TTLS = {
+    "pesquisar-hashtags": int(os.getenv("RESPONSE_CACHE_TTL_HASHTAGS", 6 * 3600)),
+    "suggest-content-topics": int(os.getenv("RESPONSE_CACHE_TTL_TOPICS", 3600)),
+    "analyze-competitor-profile": int(os.getenv("RESPONSE_CACHE_TTL_COMPETITOR", 24 * 3600)),
+}
+agent_response_cache = response_cache.ResponseCache(RESPONSE_CACHE_TTLS)
+# Cache semântico (texto parecido, mesmo contexto) para os agentes de texto livre; limiar 0 desativa
+SEMANTIC_CACHE_THRESHOLDS = {
+    "pesquisar-hashtags": float(os.getenv("SEMANTIC_CACHE_THRESHOLD_HASHTAGS", 0.85)),
+    "gerar-copy-social-media": float(os.getenv("SEMANTIC_CACHE_THRESHOLD_COPY", 0.9)),
+}
+SEMANTIC_CACHE_TTLS = {
+    "pesquisar-hashtags": RESPONSE_CACHE_TTLS["pesquisar-hashtags"],
+    "gerar-copy-social-media": int(os.getenv("SEMANTIC_CACHE_TTL_COPY", 3600)),
+}
+agent_semantic_cache = semantic_cache.SemanticCache(SEMANTIC_CACHE_THRESHOLDS, SEMANTIC_CACHE_TTLS)
+# Requisições idênticas simultâneas compartilham uma única chamada ao provedor
+agent_single_flight = SingleFlight()
+# Orçamento de tokens do contexto de perfil nos prompts (ver prompts.py)
+prompt_compactor = prompts.PromptCompactor()
 
 # --- Pydantic Models ---
 class TokenData(BaseModel):
@@ -147,10 +291,41 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 # --- Inicialização da Aplicação FastAPI ---
+# Fases da subida (com duração) e prontidão do worker, ver startup.py
+startup_report = StartupReport()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Cria as tabelas no banco de dados na primeira execução
+    with startup_report.phase("database"):
+        await database.init_models(engine, Base.metadata)
+    with startup_report.phase("quota"):
+        await quota_engine.start()
+    with startup_report.phase("usage_rollup"):
+        await usage_rollup.start()
+    with startup_report.phase("image_jobs"):
+        await image_jobs.start()
+    with startup_report.phase("semantic_cache"):
+        await agent_semantic_cache.start()
+    # SDKs, pools HTTP e modelos dos provedores: carregados em segundo plano, com a porta já aberta
+    startup_report.background("providers", providers.registry.preload())
+    startup_report.mark_started()
+    yield
+    await startup_report.cancel_background()
+    await image_jobs.stop()
+    await usage_rollup.stop()
+    # Grava os usos pendentes antes de encerrar o worker
+    await quota_engine.stop()
+    await agent_response_cache.close()
+    await agent_semantic_cache.stop()
+    await providers.registry.close()
+    await engine.dispose()
+
 app = FastAPI(
     title="MonsterApp API",
     description="Backend para a extensão MonsterApp com autenticação e agentes de IA.",
-    version="3.0.0"
+    version="3.0.0",
+    lifespan=lifespan
 )
 
 # Configuração do CORS
@@ -161,26 +336,37 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Duração por rota e detalhamento por etapa das requisições lentas (ver metrics.py)
+slow_request_log = metrics.SlowRequestLog()
+app.add_middleware(metrics.MetricsMiddleware, slow_log=slow_request_log)
 
 # --- Configuração das APIs de IA ---
 # Carrega as variáveis de ambiente do arquivo .env
 from dotenv import load_dotenv
 load_dotenv()
 
-# Configuração da API Gemini
-import google.generativeai as genai
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
-# Configuração da API OpenAI
-from openai import OpenAI
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-# Configuração do Stripe
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# Clientes assíncronos do Gemini, OpenAI e Stripe (ver providers.py)
+import providers
+from router import ProviderRouter
+
+# Backends capazes de atender cada agente, em ordem de preferência (ver router.py).
+# Pode ser sobrescrito por agente, ex: ROUTE_PESQUISAR_HASHTAGS="openai:gpt-4o-mini,gemini:gemini-pro"
+DEFAULT_AGENT_ROUTES = {
+    "gerar-copy-social-media": ["openai:gpt-4o", "gemini:gemini-pro"],
+    "generate-copy-variations": ["openai:gpt-4o", "gemini:gemini-pro"],
+    "pesquisar-hashtags": ["gemini:gemini-pro", "openai:gpt-4o-mini"],
+    "suggest-content-topics": ["gemini:gemini-pro", "openai:gpt-4o-mini"],
+    "analyze-competitor-profile": ["gemini:gemini-pro", "openai:gpt-4o"],
+}
+AGENT_ROUTES = {
+    agent_name: [spec.strip() for spec in os.getenv("ROUTE_" + agent_name.upper().replace("-", "_"), "").split(",") if spec.strip()] or route
+    for agent_name, route in DEFAULT_AGENT_ROUTES.items()
+}
+provider_router = ProviderRouter(AGENT_ROUTES, providers.text_backend, providers.text_stream_backend)
 
 # --- Endpoints de Autenticação e Usuário ---
 @app.post("/auth/google", tags=["Authentication"])
-async def login_with_google(request: GoogleLoginRequest, db: Session = Depends(get_db)):
+async def login_with_google(request: GoogleLoginRequest, db: AsyncSession = Depends(get_db)):
     # Em um cenário real, você validaria o token do Google aqui
     # usando a biblioteca google-auth. Por simplicidade, vamos pular a validação.
     # Exemplo de como seria a validação:
@@ -197,12 +383,12 @@ async def login_with_google(request: GoogleLoginRequest, db: Session = Depends(g
     user_email = f"user_{hash(request.token)}@example.com"
     google_id = str(hash(request.token))
 
-    user = db.query(User).filter(User.google_id == google_id).first()
+    user = await db.scalar(select(User).where(User.google_id == google_id))
     if not user:
         user = User(email=user_email, google_id=google_id, plan=Plan.FREE)
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        invalidate_user_cache(user.email)
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -238,15 +424,118 @@ class SuggestTopicsRequest(BaseModel):
 class GenerateCopyVariationsRequest(BaseModel):
     original_copy: str
 
+# --- Métricas ---
+# Gauges lidos na hora do scrape a partir do estado dos componentes
+metrics.CallbackMetric(
+    "monsterapp_provider_in_flight", "gauge", "Chamadas em andamento por provedor.", ("provider",),
+    lambda: {(name,): limiter.in_flight for name, limiter in (
+        ("openai", providers.openai_limiter), ("gemini", providers.gemini_limiter), ("stripe", providers.stripe_limiter)
+    )},
+)
+metrics.CallbackMetric(
+    "monsterapp_image_jobs", "gauge", "Jobs de imagem na fila e em execução.", ("state",),
+    lambda: {("queued",): image_jobs.stats()["queued"], ("running",): image_jobs.stats()["running"]},
+)
+metrics.CallbackMetric(
+    "monsterapp_single_flight_in_flight", "gauge", "Chamadas ao provedor compartilhadas em andamento.", (),
+    lambda: {(): agent_single_flight.stats()["in_flight"]},
+)
+metrics.CallbackMetric(
+    "monsterapp_cache_lookups_total", "counter", "Consultas aos caches em memória.", ("cache", "result"),
+    lambda: {
+        (name, result): stats[result]
+        for name, stats in (
+            ("user", user_cache.stats()), ("response", agent_response_cache.stats()), ("semantic", agent_semantic_cache.stats())
+        )
+        for result in ("hits", "misses")
+    },
+)
+
+@app.get("/metrics", tags=["Internal"], include_in_schema=False, dependencies=[Depends(require_internal_token)])
+async def prometheus_metrics():
+    """Métricas deste worker no formato de texto do Prometheus."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/internal/slow-requests", tags=["Internal"], dependencies=[Depends(require_internal_token)])
+async def slow_requests():
+    """Últimas requisições acima de `SLOW_REQUEST_THRESHOLD_MS`, com o tempo de cada etapa."""
+    return {
+        "enabled": slow_request_log.enabled,
+        "threshold_ms": slow_request_log.threshold_ms,
+        "sample_rate": slow_request_log.sample_rate,
+        "requests": list(reversed(slow_request_log.entries)),
+    }
+
+@app.get("/health/live", tags=["Health"])
+async def health_live():
+    """O processo está de pé e respondendo."""
+    return {"status": "ok"}
+
+@app.get("/health/ready", tags=["Health"])
+async def health_ready():
+    """Pronto para tráfego: subida concluída e provedores carregados. Inclui a duração de cada fase."""
+    report = startup_report.as_dict()
+    if not report["ready"]:
+        return JSONResponse(status_code=503, content={"status": "starting", **report})
+    return {"status": "ready", **report}
+
+@app.get("/internal/cache-stats", tags=["Internal"], dependencies=[Depends(require_internal_token)])
+async def cache_stats():
+    """Acertos/faltas dos caches em memória e chamadas coalescidas deste worker."""
+    return {
+        "user_cache": user_cache.stats(),
+        "response_cache": agent_response_cache.stats(),
+        "semantic_cache": agent_semantic_cache.stats(),
+        "single_flight": agent_single_flight.stats(),
+        "image_jobs": image_jobs.stats(),
+        "providers": provider_router.stats(),
+        "provider_clients": providers.registry.stats(),
+        "analytics": usage_analytics.stats(),
+        "prompts": prompt_compactor.stats()
+    }
+
+@app.get("/internal/analytics", tags=["Internal"], dependencies=[Depends(require_internal_token)])
+async def internal_analytics(days: int = 30, agent: Optional[str] = None):
+    """Analytics de todos os usuários (chamadas, cache, latência e mapa de calor)."""
+    return await usage_analytics.report(days=min(max(days, 1), 3650), agent_name=agent)
+
 @app.get("/users/me", response_model=UserSchema, tags=["Users"])
-async def read_users_me(current_user: User = Depends(get_current_user)):
+async def read_users_me(current_user: UserSnapshot = Depends(get_current_user)):
     """Retorna os dados do usuário logado."""
     return current_user
 
+@app.get("/users/me/usage", tags=["Users"])
+async def read_my_usage(days: int = 30, current_user: UserSnapshot = Depends(get_current_user)):
+    """Usos por dia e agente nos últimos `days` dias (máx. 365), lidos dos agregados."""
+    days = min(max(days, 1), 365)
+    today = datetime.utcnow().date()
+    since = datetime.combine(today - timedelta(days=days - 1), datetime.min.time())
+    counts = await usage_rollup.counts(since, user_id=current_user.id)
+    return {
+        "usage": [
+            {"day": day.isoformat(), "agent_name": agent_name, "count": count}
+            for (_, agent_name, day), count in sorted(counts.items(), key=lambda item: (item[0][2], item[0][1]))
+        ],
+        "daily_limits": FREE_TIER_LIMITS if current_user.plan == Plan.FREE else {}
+    }
+
+@app.get("/analytics/usage", tags=["Analytics"])
+async def read_usage_analytics(days: int = 30, agent: Optional[str] = None, tz_offset_minutes: int = 0,
+                               current_user: UserSnapshot = Depends(get_current_user)):
+    """
+    Analytics do usuário logado nos últimos `days` dias (máx. 3650): chamadas e
+    taxa de acerto do cache por agente, percentis de latência, série diária e
+    mapa de calor dia da semana x hora (deslocado por `tz_offset_minutes`).
+    """
+    return await usage_analytics.report(
+        days=min(max(days, 1), 3650), user_id=current_user.id, agent_name=agent,
+        tz_offset_minutes=max(min(tz_offset_minutes, 14 * 60), -12 * 60)
+    )
+
 @app.post("/create-checkout-session", tags=["Stripe"])
-async def create_checkout_session(request: StripeCheckoutRequest, current_user: User = Depends(get_current_user)):
+async def create_checkout_session(request: StripeCheckoutRequest, current_user: UserSnapshot = Depends(get_current_user)):
     try:
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = await providers.create_checkout_session(
             line_items=[
                 {
                     'price': request.price_id,
@@ -263,262 +552,562 @@ async def create_checkout_session(request: StripeCheckoutRequest, current_user:
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao criar sessão de checkout: {str(e)}")
 
-@app.post("/analyze-competitor-profile", tags=["Agents"])
-async def analyze_competitor_profile(request: CompetitorAnalysisRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "analyze-competitor-profile")
-    """
-    Agente de Pesquisa (Gemini - PRO Feature): Analisa o perfil de um concorrente.
-    """
-    if current_user.plan == Plan.FREE:
-        raise HTTPException(status_code=403, detail="Funcionalidade PRO. Faça upgrade para o plano PRO para usar a Análise de Concorrentes.")
+# --- Agentes de IA ---
+# Cada agente é uma função (request, user) -> dict, sem plano, cota nem cache:
+# os endpoints individuais e o /batch aplicam isso em volta (ver AGENTS).
 
+async def run_competitor_analysis(request: CompetitorAnalysisRequest, user: UserSnapshot) -> dict:
     try:
-        model = genai.GenerativeModel('gemini-pro')
-        prompt = f"Analise o seguinte perfil de concorrente do Instagram e forneça insights sobre seu nicho, estilo de conteúdo e pontos fortes. Retorne a análise em formato de texto, com as seções: 'Nicho Identificado', 'Estilo de Conteúdo' e 'Insights Principais'.\n\n"
-        prompt += f"Username: {request.username}\n"
-        if request.bio: prompt += f"Bio: {request.bio}\n"
-        if request.followers: prompt += f"Seguidores: {request.followers}\n"
-        if request.following: prompt += f"Seguindo: {request.following}\n"
-        if request.posts: prompt += f"Posts: {request.posts}\n"
-        if request.recent_captions: prompt += f"Legendas Recentes: {', '.join(request.recent_captions)}\n"
-
-        response = model.generate_content(prompt)
-        
-        # Parse Gemini's response
-        response_text = response.text
-        niche_match = re.search(r"Nicho Identificado:\s*(.*)", response_text)
-        style_match = re.search(r"Estilo de Conteúdo:\s*(.*)", response_text)
-        insights_match = re.search(r"Insights Principais:\s*(.*)", response_text, re.DOTALL)
-
-        niche = niche_match.group(1).strip() if niche_match else "Não identificado"
-        style = style_match.group(1).strip() if style_match else "Não identificado"
-        insights = insights_match.group(1).strip().split('\n') if insights_match else ["Nenhum insight disponível."]
-        insights = [re.sub(r"^\d+\.\s*", "", s).strip() for s in insights if s.strip()]
-
+        with metrics.stage("prompt"):
+            prompt = f"Analise o seguinte perfil de concorrente do Instagram e forneça insights sobre seu nicho, estilo de conteúdo e pontos fortes.\n\n"
+            budget = prompt_compactor.budget("analyze-competitor-profile")
+            bio = prompts.truncate(request.bio or "", budget // 4)
+            prompt += f"Username: {request.username}\n"
+            if bio: prompt += f"Bio: {bio}\n"
+            if request.followers: prompt += f"Seguidores: {request.followers}\n"
+            if request.following: prompt += f"Seguindo: {request.following}\n"
+            if request.posts: prompt += f"Posts: {request.posts}\n"
+            # A bio indica o nicho: legendas alinhadas a ela têm prioridade
+            captions = prompt_compactor.captions(request.recent_captions, budget - prompts.count_tokens(bio), query=bio)
+            if captions: prompt += f"Legendas Recentes: {', '.join(captions)}\n"
+
+        analysis = await structured.complete_structured(
+            provider_router, "analyze-competitor-profile", [{"role": "user", "content": prompt}], structured.COMPETITOR_ANALYSIS
+        )
         return {
             "username": request.username,
-            "niche_identified": niche,
-            "content_style_analysis": style,
-            "insights": insights
+            "niche_identified": analysis.niche_identified,
+            "content_style_analysis": analysis.content_style_analysis,
+            "insights": analysis.insights or ["Nenhum insight disponível."]
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro no Agente de Análise de Concorrentes: {str(e)}")
 
-@app.post("/suggest-content-topics", tags=["Agents"])
-async def suggest_content_topics(request: SuggestTopicsRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "suggest-content-topics")
-    """
-    Agente de Pesquisa (Gemini - PRO Feature): Sugere tópicos de conteúdo.
-    """
-    if current_user.plan == Plan.FREE:
-        raise HTTPException(status_code=403, detail="Funcionalidade PRO. Faça upgrade para o plano PRO para usar a Sugestão de Tópicos.")
+def competitor_fingerprint(request: CompetitorAnalysisRequest) -> str:
+    return response_cache.fingerprint(
+        "analyze-competitor-profile", "gemini-pro",
+        username=request.username, bio=request.bio, followers=request.followers,
+        following=request.following, posts=request.posts, recent_captions=request.recent_captions
+    )
 
+async def run_content_topics(request: SuggestTopicsRequest, user: UserSnapshot) -> dict:
     try:
-        model = genai.GenerativeModel('gemini-pro')
-        prompt = "Gere 5 ideias de tópicos de conteúdo para redes sociais. "
-        
-        if request.niche:
-            prompt += f"O nicho principal é '{request.niche}'. "
-        if request.user_profile_data:
-            prompt += f"O perfil do usuário tem a seguinte bio: {request.user_profile_data.get('bio', '')}. "
-            if request.user_profile_data.get('recent_captions'):
-                prompt += f"Legendas recentes do usuário: {', '.join(request.user_profile_data['recent_captions'])}. "
-        if request.competitor_profile_data:
-            prompt += f"Considere também o perfil do concorrente: {request.competitor_profile_data.get('username', '')} com bio: {request.competitor_profile_data.get('bio', '')}. "
-            if request.competitor_profile_data.get('recent_captions'):
-                prompt += f"Legendas recentes do concorrente: {', '.join(request.competitor_profile_data['recent_captions'])}. "
-
-        prompt += "Retorne apenas uma lista numerada de tópicos, um por linha."
-
-        response = model.generate_content(prompt)
-        topics = [line.strip() for line in response.text.split('\n') if line.strip()]
-        topics = [re.sub(r"^\d+\.\s*", "", t).strip() for t in topics]
-
-        return {"topics": topics}
+        with metrics.stage("prompt"):
+            prompt = "Gere 5 ideias de tópicos de conteúdo para redes sociais. "
+
+            budget = prompt_compactor.budget("suggest-content-topics")
+            if request.competitor_profile_data:
+                user_budget = int(budget * prompts.TOPICS_USER_SHARE)
+            else:
+                user_budget = budget
+            query = request.niche or ""
+            if request.niche:
+                prompt += f"O nicho principal é '{request.niche}'. "
+            if request.user_profile_data:
+                bio = prompts.truncate(str(request.user_profile_data.get('bio', '')), user_budget // 4)
+                prompt += f"O perfil do usuário tem a seguinte bio: {bio}. "
+                captions = prompt_compactor.captions(
+                    request.user_profile_data.get('recent_captions'), user_budget - prompts.count_tokens(bio), query=query
+                )
+                if captions:
+                    prompt += f"Legendas recentes do usuário: {', '.join(captions)}. "
+            if request.competitor_profile_data:
+                competitor_budget = budget - user_budget if request.user_profile_data else budget
+                bio = prompts.truncate(str(request.competitor_profile_data.get('bio', '')), competitor_budget // 4)
+                prompt += f"Considere também o perfil do concorrente: {request.competitor_profile_data.get('username', '')} com bio: {bio}. "
+                captions = prompt_compactor.captions(
+                    request.competitor_profile_data.get('recent_captions'), competitor_budget - prompts.count_tokens(bio), query=query
+                )
+                if captions:
+                    prompt += f"Legendas recentes do concorrente: {', '.join(captions)}. "
+
+        result = await structured.complete_structured(
+            provider_router, "suggest-content-topics", [{"role": "user", "content": prompt}], structured.TOPICS
+        )
+        return {"topics": result.topics}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro no Agente de Sugestão de Tópicos: {str(e)}")
 
-@app.post("/generate-copy-variations", tags=["Agents"])
-async def generate_copy_variations(request: GenerateCopyVariationsRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "generate-copy-variations")
-    """
-    Agente de Copywriting (ChatGPT - PRO Feature): Gera variações de uma copy.
-    """
-    if current_user.plan == Plan.FREE:
-        raise HTTPException(status_code=403, detail="Funcionalidade PRO. Faça upgrade para o plano PRO para usar a Geração de Variações de Copy.")
+def topics_fingerprint(request: SuggestTopicsRequest) -> str:
+    user_profile = request.user_profile_data or {}
+    competitor_profile = request.competitor_profile_data or {}
+    return response_cache.fingerprint(
+        "suggest-content-topics", "gemini-pro",
+        niche=request.niche,
+        user_bio=user_profile.get('bio') if request.user_profile_data else None,
+        user_captions=user_profile.get('recent_captions'),
+        competitor_username=competitor_profile.get('username'),
+        competitor_bio=competitor_profile.get('bio'),
+        competitor_captions=competitor_profile.get('recent_captions')
+    )
+
+def build_copy_variation_messages(request: GenerateCopyVariationsRequest) -> list:
+    system_message = "Você é um copywriter criativo e versátil. Sua tarefa é gerar 3 variações da copy original, com diferentes tons (ex: mais formal, mais divertido, mais direto)."
+    user_message = f"Copy original: {request.original_copy}"
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": user_message}
+    ]
 
+async def run_copy_variations(request: GenerateCopyVariationsRequest, user: UserSnapshot) -> dict:
     try:
-        system_message = "Você é um copywriter criativo e versátil. Sua tarefa é gerar 3 variações da copy original, com diferentes tons (ex: mais formal, mais divertido, mais direto). Retorne as variações como uma lista numerada."
-        user_message = f"Copy original: {request.original_copy}"
-
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ]
+        with metrics.stage("prompt"):
+            messages = build_copy_variation_messages(request)
+        result = await structured.complete_structured(
+            provider_router, "generate-copy-variations", messages, structured.COPY_VARIATIONS
         )
-        variations = [line.strip() for line in response.choices[0].message.content.split('\n') if line.strip()]
-        variations = [re.sub(r"^\d+\.\s*", "", v).strip() for v in variations]
-
-        return {"variations": variations}
+        return {"variations": result.variations}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro no Agente de Geração de Variações de Copy: {str(e)}")
 
-# --- Endpoints dos Agentes de IA (Protegidos) ---
+def build_social_media_copy_messages(request: GenerateCopyRequest) -> list:
+    system_message = "Você é um copywriter profissional especializado em conteúdo para redes sociais que engaja."
+    user_message = f"Crie uma legenda para um post com base no seguinte:\n" \
+                   f"- Tópico principal: {request.prompt}\n" \
+                   f"- Tom de voz: {request.tone}\n"
+
+    if request.niche and request.niche != 'autodetect':
+        user_message += f"- Nicho de mercado: {request.niche}\n"
+    if request.profile_data:
+        context = prompt_compactor.profile_context(
+            request.profile_data, prompt_compactor.budget("gerar-copy-social-media"),
+            query=f"{request.prompt} {request.niche or ''}"
+        )
+        user_message += f"- Informações do perfil para dar contexto:\n{context}\n"
 
-@app.post("/gerar-copy-social-media", tags=["Agents"])
-async def generate_social_media_copy(request: GenerateCopyRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "gerar-copy-social-media")
-    """
-    Agente de Copywriting (ChatGPT): Gera texto para redes sociais.
-    """
+    user_message += "A legenda deve ser criativa, clara e otimizada para a plataforma."
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": user_message}
+    ]
+
+async def run_social_media_copy(request: GenerateCopyRequest, user: UserSnapshot) -> dict:
     try:
-        system_message = "Você é um copywriter profissional especializado em conteúdo para redes sociais que engaja."
-        user_message = f"Crie uma legenda para um post com base no seguinte:\n" \
-                       f"- Tópico principal: {request.prompt}\n" \
-                       f"- Tom de voz: {request.tone}\n"
-
-        if request.niche and request.niche != 'autodetect':
-            user_message += f"- Nicho de mercado: {request.niche}\n"
-        if request.profile_data:
-            user_message += f"- Informações do perfil para dar contexto: {request.profile_data}\n"
-
-        user_message += "A legenda deve ser criativa, clara e otimizada para a plataforma."
-
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ]
-        )
-        return {"copy": response.choices[0].message.content}
+        with metrics.stage("prompt"):
+            messages = build_social_media_copy_messages(request)
+        copy = await provider_router.complete("gerar-copy-social-media", messages)
+        return {"copy": copy}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro no Agente de Copywriting: {str(e)}")
 
-@app.post("/pesquisar-hashtags", tags=["Agents"])
-async def research_hashtags(request: HashtagResearchRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "pesquisar-hashtags")
-    """
-    Agente de Pesquisa (Gemini): Encontra as melhores hashtags para um tópico.
-    """
+def social_media_copy_semantic_key(request: GenerateCopyRequest) -> tuple:
+    context = response_cache.fingerprint(
+        "gerar-copy-social-media", "gpt-4o", tone=request.tone, niche=request.niche, profile_data=request.profile_data
+    )
+    return context, request.prompt
+
+async def run_hashtag_research(request: HashtagResearchRequest, user: UserSnapshot) -> dict:
     try:
-        model = genai.GenerativeModel('gemini-pro')
-        prompt = f"Você é um especialista em social media. Sua tarefa é encontrar as 30 melhores hashtags para um post sobre '{request.topic}'."
-        
-        if request.niche:
-            prompt += f" O nicho é '{request.niche}'."
-        if request.profile_data and request.profile_data.get('bio'):
-             prompt += f" A bio do perfil é '{request.profile_data['bio']}' para te dar mais contexto sobre o público."
-
-        prompt += " Retorne apenas as hashtags, separadas por espaços, começando com #. Exemplo: #marketing #socialmedia #dicas"
-
-        response = model.generate_content(prompt)
-        # Limpeza para garantir que só temos hashtags
-        hashtags = re.findall(r'#\w+', response.text)
-        return {"hashtags": hashtags}
+        with metrics.stage("prompt"):
+            prompt = f"Você é um especialista em social media. Sua tarefa é encontrar as 30 melhores hashtags para um post sobre '{request.topic}'."
+
+            if request.niche:
+                prompt += f" O nicho é '{request.niche}'."
+            if request.profile_data and request.profile_data.get('bio'):
+                bio = prompts.truncate(str(request.profile_data['bio']), prompt_compactor.budget("pesquisar-hashtags"))
+                prompt += f" A bio do perfil é '{bio}' para te dar mais contexto sobre o público."
+
+        result = await structured.complete_structured(
+            provider_router, "pesquisar-hashtags", [{"role": "user", "content": prompt}], structured.HASHTAGS
+        )
+        return {"hashtags": result.hashtags}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro no Agente de Pesquisa de Hashtags: {str(e)}")
 
-@app.post("/gerar-imagem", tags=["Agents"])
-async def generate_image(request: GenerateImageRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "gerar-imagem")
+def hashtags_fingerprint(request: HashtagResearchRequest) -> str:
+    bio = request.profile_data.get('bio') if request.profile_data else None
+    return response_cache.fingerprint(
+        "pesquisar-hashtags", "gemini-pro", topic=request.topic, niche=request.niche, bio=bio
+    )
+
+def hashtags_semantic_key(request: HashtagResearchRequest) -> tuple:
+    bio = request.profile_data.get('bio') if request.profile_data else None
+    context = response_cache.fingerprint("pesquisar-hashtags", "gemini-pro", niche=request.niche, bio=bio)
+    return context, request.topic
+
+# --- Agente de Design: fila de jobs de imagem ---
+async def generate_image_url(full_prompt: str) -> str:
+    response = await providers.generate_image(
+        full_prompt,
+        n=1,
+        size="1024x1024", # Formato quadrado padrão para redes sociais
+        quality="hd" # Solicita maior detalhe
+    )
+    return response.data[0].url
+
+async def record_image_usage(user_id: int, latency_ms: int):
     """
-    Agente de Design (DALL-E): Cria uma imagem com base em uma descrição.
+    Uso de um job retomado depois de um restart, cuja reserva não existe mais
+    neste processo: a imagem já foi gerada, então entra no contador do dia
+    mesmo que passe do limite do plano.
     """
+    reservation = await quota_engine.charge(user_id, "gerar-imagem")
+    reservation.commit(latency_ms=latency_ms)
+
+image_jobs = ImageJobManager(SessionLocal, ImageJob, generate_image_url, record_usage=record_image_usage)
+
+async def run_image_generation(request: GenerateImageRequest, user: UserSnapshot, reservation) -> dict:
+    # Adapta o prompt para o estilo desejado
+    full_prompt = f"Uma imagem no estilo '{request.style}' descrevendo: {request.prompt}. "
+    full_prompt += "A imagem deve ser vibrante, de alta qualidade e adequada para postagem em redes sociais como o Instagram."
     try:
-        # Adapta o prompt para o estilo desejado
-        full_prompt = f"Uma imagem no estilo '{request.style}' descrevendo: {request.prompt}. "
-        full_prompt += "A imagem deve ser vibrante, de alta qualidade e adequada para postagem em redes sociais como o Instagram."
-
-        response = openai_client.images.generate(
-            model="dall-e-3",
-            prompt=full_prompt,
-            n=1,
-            size="1024x1024", # Formato quadrado padrão para redes sociais
-            quality="hd" # Solicita maior detalhe
-        )
-        image_url = response.data[0].url
-        return {"image_url": image_url}
+        # A reserva passa a ser do job: confirmada quando a imagem fica pronta
+        job_id = await image_jobs.submit(user.id, full_prompt, reservation)
+    except BaseException as e:
+        await reservation.release()
+        if isinstance(e, Exception):
+            raise HTTPException(status_code=500, detail=f"Erro no Agente de Design: {str(e)}")
+        raise
+    return {"job_id": job_id, "status": "queued", "status_url": f"/image-jobs/{job_id}"}
+
+def image_job_response(job: dict) -> dict:
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "image_url": f"/media/{job['image_sha256']}.png" if job["image_sha256"] else None,
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "finished_at": job["finished_at"],
+    }
+
+# --- Registro dos Agentes ---
+@dataclass(frozen=True)
+class AgentSpec:
+    request_model: type
+    run: Callable
+    fingerprint: Optional[Callable] = None  # habilita cache de respostas e coalescência
+    semantic_key: Optional[Callable] = None # (contexto, texto livre): habilita o cache semântico
+    pro_feature: Optional[str] = None       # nome da funcionalidade PRO na mensagem de upgrade
+    deferred_usage: bool = False            # run(request, user, reserva): o próprio agente confirma a cota (jobs)
+
+AGENTS = {
+    "gerar-copy-social-media": AgentSpec(
+        GenerateCopyRequest, run_social_media_copy, semantic_key=social_media_copy_semantic_key
+    ),
+    "pesquisar-hashtags": AgentSpec(
+        HashtagResearchRequest, run_hashtag_research,
+        fingerprint=hashtags_fingerprint, semantic_key=hashtags_semantic_key
+    ),
+    "gerar-imagem": AgentSpec(GenerateImageRequest, run_image_generation, deferred_usage=True),
+    "analyze-competitor-profile": AgentSpec(
+        CompetitorAnalysisRequest, run_competitor_analysis,
+        fingerprint=competitor_fingerprint, pro_feature="a Análise de Concorrentes"
+    ),
+    "suggest-content-topics": AgentSpec(
+        SuggestTopicsRequest, run_content_topics,
+        fingerprint=topics_fingerprint, pro_feature="a Sugestão de Tópicos"
+    ),
+    "generate-copy-variations": AgentSpec(
+        GenerateCopyVariationsRequest, run_copy_variations, pro_feature="a Geração de Variações de Copy"
+    ),
+}
+
+def require_agent_plan(agent_name: str, user: UserSnapshot):
+    spec = AGENTS[agent_name]
+    if spec.pro_feature and user.plan == Plan.FREE:
+        raise HTTPException(status_code=403, detail=f"Funcionalidade PRO. Faça upgrade para o plano PRO para usar {spec.pro_feature}.")
+
+async def lookup_cached_response(agent_name: str, request):
+    """
+    Retorna (fingerprint, resposta em cache ou None); agentes sem cache devolvem (None, None).
+    O cache exato é consultado primeiro; depois, se o agente tiver, o semântico.
+    """
+    spec = AGENTS[agent_name]
+    if spec.fingerprint is None and spec.semantic_key is None:
+        return None, None
+    fingerprint = cached = None
+    with metrics.stage("cache_lookup"):
+        if spec.fingerprint is not None:
+            fingerprint = spec.fingerprint(request)
+            # Com TTL 0 o cache fica desligado, mas o fingerprint ainda coalesce chamadas iguais
+            if agent_response_cache.enabled_for(agent_name):
+                cached = await agent_response_cache.get(fingerprint)
+        if cached is None and spec.semantic_key is not None:
+            cached = agent_semantic_cache.get(agent_name, *spec.semantic_key(request))
+    return fingerprint, cached
+
+def store_semantic_response(agent_name: str, request, result):
+    spec = AGENTS[agent_name]
+    if spec.semantic_key is not None:
+        agent_semantic_cache.set(agent_name, *spec.semantic_key(request), result)
+
+async def compute_agent(agent_name: str, request, user: UserSnapshot, fingerprint: Optional[str] = None):
+    """Chama o agente; com fingerprint, chamadas idênticas simultâneas são coalescidas e o resultado vai para o cache."""
+    spec = AGENTS[agent_name]
+    if fingerprint is None:
+        result = await spec.run(request, user)
+        if spec.semantic_key is not None:
+            with metrics.stage("cache_store"):
+                store_semantic_response(agent_name, request, result)
+        return result
+
+    async def compute_and_store():
+        result = await spec.run(request, user)
+        with metrics.stage("cache_store"):
+            await agent_response_cache.set(agent_name, fingerprint, result)
+            store_semantic_response(agent_name, request, result)
+        return result
+
+    return await agent_single_flight.do(fingerprint, compute_and_store)
+
+async def run_agent_endpoint(agent_name: str, request, user: UserSnapshot):
+    """Fluxo de um endpoint de agente: plano, cache, cota e chamada ao provedor."""
+    require_agent_plan(agent_name, user)
+    fingerprint, cached = await lookup_cached_response(agent_name, request)
+    if cached is not None:
+        await check_and_log_usage(user, agent_name, cache_hit=True)
+        return cached
+    reservation = await reserve_usage(user, agent_name)
+    if AGENTS[agent_name].deferred_usage:
+        return await AGENTS[agent_name].run(request, user, reservation)
+    started = time.monotonic()
+    try:
+        result = await compute_agent(agent_name, request, user, fingerprint)
+    except BaseException:
+        # Falha do provedor (ou cliente desconectado) não consome a cota
+        await reservation.release()
+        raise
+    reservation.commit(latency_ms=elapsed_ms(started))
+    return result
+
+async def open_agent_stream(deltas, reservation, error_prefix: str, parser=None):
+    """Espera o primeiro token antes de responder: falhas até aí viram HTTP 500 e devolvem a cota."""
+    try:
+        deltas = await streaming.prefetch(deltas)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erro no Agente de Design: {str(e)}")
+        await reservation.release()
+        raise HTTPException(status_code=500, detail=f"{error_prefix}: {str(e)}")
+    return StreamingResponse(
+        streaming.stream_agent(deltas, reservation, error_prefix, parser),
+        media_type=streaming.NDJSON_MEDIA_TYPE
+    )
 
 # --- Endpoints dos Agentes de IA (Protegidos) ---
 
+@app.post("/analyze-competitor-profile", tags=["Agents"])
+async def analyze_competitor_profile(request: CompetitorAnalysisRequest, current_user: UserSnapshot = Depends(get_current_user)):
+    """
+    Agente de Pesquisa (Gemini - PRO Feature): Analisa o perfil de um concorrente.
+    """
+    return await run_agent_endpoint("analyze-competitor-profile", request, current_user)
+
+@app.post("/suggest-content-topics", tags=["Agents"])
+async def suggest_content_topics(request: SuggestTopicsRequest, current_user: UserSnapshot = Depends(get_current_user)):
+    """
+    Agente de Pesquisa (Gemini - PRO Feature): Sugere tópicos de conteúdo.
+    """
+    return await run_agent_endpoint("suggest-content-topics", request, current_user)
+
+@app.post("/generate-copy-variations", tags=["Agents"])
+async def generate_copy_variations(request: GenerateCopyVariationsRequest, current_user: UserSnapshot = Depends(get_current_user)):
+    """
+    Agente de Copywriting (ChatGPT - PRO Feature): Gera variações de uma copy.
+    """
+    return await run_agent_endpoint("generate-copy-variations", request, current_user)
+
+@app.post("/generate-copy-variations/stream", tags=["Agents"])
+async def stream_copy_variations(request: GenerateCopyVariationsRequest, current_user: UserSnapshot = Depends(get_current_user)):
+    """
+    Versão em streaming (NDJSON) de /generate-copy-variations: cada variação é
+    enviada como um evento `item` assim que sua linha termina.
+    """
+    require_agent_plan("generate-copy-variations", current_user)
+    reservation = await reserve_usage(current_user, "generate-copy-variations")
+    # Mesmo formato JSON do endpoint sem streaming: cada variação sai assim que sua string fecha
+    return await open_agent_stream(
+        provider_router.stream(
+            "generate-copy-variations",
+            structured.COPY_VARIATIONS.with_instructions(build_copy_variation_messages(request)),
+            json_mode=True
+        ),
+        reservation,
+        "Erro no Agente de Geração de Variações de Copy",
+        parser=structured.JsonArrayParser("variations")
+    )
+
 @app.post("/gerar-copy-social-media", tags=["Agents"])
-async def generate_social_media_copy(request: GenerateCopyRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "gerar-copy-social-media")
+async def generate_social_media_copy(request: GenerateCopyRequest, current_user: UserSnapshot = Depends(get_current_user)):
     """
     Agente de Copywriting (ChatGPT): Gera texto para redes sociais.
     """
-    try:
-        system_message = "Você é um copywriter profissional especializado em conteúdo para redes sociais que engaja."
-        user_message = f"Crie uma legenda para um post com base no seguinte:\n" \
-                       f"- Tópico principal: {request.prompt}\n" \
-                       f"- Tom de voz: {request.tone}\n"
-
-        if request.niche and request.niche != 'autodetect':
-            user_message += f"- Nicho de mercado: {request.niche}\n"
-        if request.profile_data:
-            user_message += f"- Informações do perfil para dar contexto: {request.profile_data}\n"
-
-        user_message += "A legenda deve ser criativa, clara e otimizada para a plataforma."
-
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ]
-        )
-        return {"copy": response.choices[0].message.content}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erro no Agente de Copywriting: {str(e)}")
+    return await run_agent_endpoint("gerar-copy-social-media", request, current_user)
+
+@app.post("/gerar-copy-social-media/stream", tags=["Agents"])
+async def stream_social_media_copy(request: GenerateCopyRequest, current_user: UserSnapshot = Depends(get_current_user)):
+    """
+    Versão em streaming (NDJSON) de /gerar-copy-social-media.
+    """
+    reservation = await reserve_usage(current_user, "gerar-copy-social-media")
+    return await open_agent_stream(
+        provider_router.stream("gerar-copy-social-media", build_social_media_copy_messages(request)),
+        reservation,
+        "Erro no Agente de Copywriting"
+    )
 
 @app.post("/pesquisar-hashtags", tags=["Agents"])
-async def research_hashtags(request: HashtagResearchRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "pesquisar-hashtags")
+async def research_hashtags(request: HashtagResearchRequest, current_user: UserSnapshot = Depends(get_current_user)):
     """
     Agente de Pesquisa (Gemini): Encontra as melhores hashtags para um tópico.
     """
-    try:
-        model = genai.GenerativeModel('gemini-pro')
-        prompt = f"Você é um especialista em social media. Sua tarefa é encontrar as 30 melhores hashtags para um post sobre '{request.topic}'."
-        
-        if request.niche:
-            prompt += f" O nicho é '{request.niche}'."
-        if request.profile_data and request.profile_data.get('bio'):
-             prompt += f" A bio do perfil é '{request.profile_data['bio']}' para te dar mais contexto sobre o público."
-
-        prompt += " Retorne apenas as hashtags, separadas por espaços, começando com #. Exemplo: #marketing #socialmedia #dicas"
-
-        response = model.generate_content(prompt)
-        # Limpeza para garantir que só temos hashtags
-        hashtags = re.findall(r'#\w+', response.text)
-        return {"hashtags": hashtags}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erro no Agente de Pesquisa de Hashtags: {str(e)}")
+    return await run_agent_endpoint("pesquisar-hashtags", request, current_user)
 
-@app.post("/gerar-imagem", tags=["Agents"])
-async def generate_image(request: GenerateImageRequest, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    check_and_log_usage(db, current_user, "gerar-imagem")
+@app.post("/gerar-imagem", status_code=202, tags=["Agents"])
+async def generate_image(request: GenerateImageRequest, current_user: UserSnapshot = Depends(get_current_user)):
     """
-    Agente de Design (DALL-E): Cria uma imagem com base em uma descrição.
+    Agente de Design (DALL-E): Enfileira a criação de uma imagem com base em uma descrição.
+    Acompanhe o job em /image-jobs/{job_id} (ou /image-jobs/{job_id}/wait para long-poll).
     """
+    return await run_agent_endpoint("gerar-imagem", request, current_user)
+
+async def get_user_image_job(job_id: str, current_user: UserSnapshot, wait: float = 0):
+    job = await (image_jobs.wait(job_id, wait) if wait > 0 else image_jobs.get(job_id))
+    if job is None or job["user_id"] != current_user.id:
+        raise HTTPException(status_code=404, detail="Job de imagem não encontrado.")
+    return image_job_response(job)
+
+@app.get("/image-jobs/{job_id}", tags=["Agents"])
+async def read_image_job(job_id: str, current_user: UserSnapshot = Depends(get_current_user)):
+    """Estado atual de um job de imagem."""
+    return await get_user_image_job(job_id, current_user)
+
+@app.get("/image-jobs/{job_id}/wait", tags=["Agents"])
+async def wait_image_job(job_id: str, timeout: float = 25, current_user: UserSnapshot = Depends(get_current_user)):
+    """Long-poll: responde quando o job termina ou depois de `timeout` segundos (máx. 60)."""
+    return await get_user_image_job(job_id, current_user, wait=min(max(timeout, 0.1), 60))
+
+@app.get("/media/{digest}.png", tags=["Media"])
+async def read_media(digest: str, request: Request):
+    """Imagens geradas, endereçadas pelo SHA-256 do conteúdo (imutáveis)."""
     try:
-        # Adapta o prompt para o estilo desejado
-        full_prompt = f"Uma imagem no estilo '{request.style}' descrevendo: {request.prompt}. "
-        full_prompt += "A imagem deve ser vibrante, de alta qualidade e adequada para postagem em redes sociais como o Instagram."
-
-        response = openai_client.images.generate(
-            model="dall-e-3",
-            prompt=full_prompt,
-            n=1,
-            size="1024x1024", # Formato quadrado padrão para redes sociais
-            quality="hd" # Solicita maior detalhe
-        )
-        image_url = response.data[0].url
-        return {"image_url": image_url}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erro no Agente de Design: {str(e)}")
\ No newline at end of file
+        path = image_jobs.media.path_for(digest)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Imagem não encontrada.")
+    headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": f'"{digest}"'}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Imagem não encontrada.")
+    return FileResponse(path, media_type="image/png", headers=headers)
+
+# --- Lote de Agentes ---
+class BatchItem(BaseModel):
+    agent: str                 # nome do agente, igual ao caminho do endpoint (ex: "pesquisar-hashtags")
+    request: dict              # corpo que seria enviado ao endpoint do agente
+    id: Optional[str] = None   # devolvido no resultado para o cliente casar as respostas
+
+class BatchRequest(BaseModel):
+    items: list[BatchItem]
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 30))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+
+def batch_result(index: int, item: BatchItem, result=None, status_code: int = 200, detail=None) -> dict:
+    if status_code == 200:
+        return {"index": index, "id": item.id, "agent": item.agent, "ok": True, "result": result}
+    return {"index": index, "id": item.id, "agent": item.agent, "ok": False, "status_code": status_code, "detail": detail}
+
+@app.post("/batch", tags=["Agents"])
+async def run_batch(batch: BatchRequest, stream: bool = False, current_user: UserSnapshot = Depends(get_current_user)):
+    """
+    Executa vários agentes numa única requisição (ex: legendas e hashtags de uma semana de posts).
+
+    A cota de todo o lote é reservada de uma vez: se não houver cota para todos os
+    itens, nada é executado (429). Os itens rodam em paralelo (até BATCH_CONCURRENCY
+    por lote) e cada um traz seu próprio resultado ou erro. Com `?stream=true`, os
+    resultados chegam em NDJSON à medida que ficam prontos.
+    """
+    if len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"O lote aceita no máximo {BATCH_MAX_ITEMS} itens.")
+    await enforce_burst_limit(current_user, "batch")
+
+    # 1. Validação, plano e cache (sem chamar nenhum provedor)
+    ready = {}    # index -> resultado já conhecido (erro de validação/plano ou cache)
+    to_run = []   # (index, item, request, fingerprint)
+    cached_hits = {}
+    for index, item in enumerate(batch.items):
+        spec = AGENTS.get(item.agent)
+        if spec is None:
+            ready[index] = batch_result(index, item, status_code=400, detail=f"Agente desconhecido: {item.agent}")
+            continue
+        try:
+            request = spec.request_model(**item.request)
+            require_agent_plan(item.agent, current_user)
+        except ValidationError as e:
+            ready[index] = batch_result(index, item, status_code=422, detail=e.errors(include_url=False, include_context=False))
+            continue
+        except HTTPException as e:
+            ready[index] = batch_result(index, item, status_code=e.status_code, detail=e.detail)
+            continue
+        fingerprint, cached = await lookup_cached_response(item.agent, request)
+        if cached is not None:
+            cached_hits[index] = cached
+        to_run.append((index, item, request, fingerprint))
+
+    # 2. Reserva da cota do lote inteiro, tudo ou nada
+    amounts = Counter((item.agent, index in cached_hits) for index, item, _, _ in to_run)
+    reservations = {}
+    try:
+        for (agent_name, cache_hit), amount in amounts.items():
+            limit = FREE_TIER_LIMITS.get(agent_name, 0) if current_user.plan == Plan.FREE else 0
+            reservation = await quota_engine.reserve(current_user.id, agent_name, limit, amount=amount, cache_hit=cache_hit)
+            if reservation is None:
+                metrics.QUOTA_REJECTIONS.labels(agent_name, "batch").inc()
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"Limite de uso diário insuficiente para {amount} chamadas de {agent_name} neste lote. Faça upgrade para o plano PRO para uso ilimitado."
+                )
+            reservations[(agent_name, cache_hit)] = reservation
+    except BaseException:
+        for reservation in reservations.values():
+            await reservation.release()
+        raise
+
+    # 3. Execução em paralelo, limitada por lote
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_item(index, item, request, fingerprint):
+        if index in cached_hits:
+            reservations[(item.agent, True)].commit()
+            return batch_result(index, item, cached_hits[index])
+        reservation = reservations[(item.agent, False)]
+        if AGENTS[item.agent].deferred_usage:
+            try:
+                async with semaphore:
+                    result = await AGENTS[item.agent].run(request, current_user, reservation.split())
+            except HTTPException as e:
+                return batch_result(index, item, status_code=e.status_code, detail=e.detail)
+            return batch_result(index, item, result)
+        try:
+            async with semaphore:
+                started = time.monotonic()
+                result = await compute_agent(item.agent, request, current_user, fingerprint)
+        except HTTPException as e:
+            await reservation.release(1)
+            return batch_result(index, item, status_code=e.status_code, detail=e.detail)
+        except BaseException:
+            await reservation.release(1)
+            raise
+        reservation.commit(latency_ms=elapsed_ms(started))
+        return batch_result(index, item, result)
+
+    tasks = [asyncio.ensure_future(run_item(*entry)) for entry in to_run]
+
+    if not stream:
+        for result in await asyncio.gather(*tasks):
+            ready[result["index"]] = result
+        return {"results": [ready[index] for index in range(len(batch.items))]}
+
+    async def stream_results():
+        try:
+            for result in ready.values():
+                yield streaming.ndjson_line(result)
+            for next_done in asyncio.as_completed(tasks):
+                yield streaming.ndjson_line(await next_done)
+        finally:
+            # Cliente desconectou: cancela o que falta (as reservas são devolvidas em run_item)
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type=streaming.NDJSON_MEDIA_TYPE)
+
+startup_report.record("import", time.perf_counter() - IMPORT_STARTED)
@@ -0,0 +1,309 @@
+# backend/metrics.py
+
+"""
+Métricas no formato de texto do Prometheus (`/metrics`) e instrumentação por
+etapa das requisições.
+
+Sem dependências externas: contadores, gauges e histogramas simples, pensados
+para o event loop (atualizados só pela thread do loop, sem locks). O custo por
+observação é uma busca binária nos limites do histograma.
+
+Etapas (`stage`): cada trecho instrumentado do caminho quente (decodificação
+do JWT, busca do usuário, cota, cache, montagem do prompt, chamada ao
+provedor, pós-processamento, banco) alimenta `monsterapp_stage_seconds` e o
+detalhamento da requisição atual. Com `SLOW_REQUEST_THRESHOLD_MS` definido,
+requisições mais lentas que o limite (amostradas por
+`SLOW_REQUEST_SAMPLE_RATE`) são guardadas com esse detalhamento e aparecem
+em `/internal/slow-requests`.
+"""
+
+import bisect
+import contextvars
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+    _new_child = _Value
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def render(self) -> list:
+        lines = self._header()
+        for values, child in self._children.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self) -> list:
+        lines = self._header()
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {repr(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Valores lidos na hora do scrape (ex: `in_flight` de um limitador)."""
+
+    def __init__(self, name: str, kind: str, documentation: str, labelnames, collect, registry=None):
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._collect = collect  # () -> {tupla de labels: valor}
+        (registry or REGISTRY).register(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in self._collect().items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrica duplicada: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logger.exception("Falha ao coletar a métrica %s", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Métricas do caminho quente ---
+HTTP_REQUESTS = Counter("monsterapp_http_requests_total", "Requisições HTTP por rota e status.", ("method", "route", "status"))
+HTTP_DURATION = Histogram("monsterapp_http_request_duration_seconds", "Duração das requisições HTTP (até o fim do corpo).", ("method", "route"))
+HTTP_IN_FLIGHT = Gauge("monsterapp_http_requests_in_flight", "Requisições HTTP em andamento.")
+STAGE_SECONDS = Histogram("monsterapp_stage_seconds", "Duração de cada etapa instrumentada.", ("stage",))
+UPSTREAM_SECONDS = Histogram("monsterapp_upstream_seconds", "Duração das chamadas aos provedores de IA.", ("backend", "outcome"))
+UPSTREAM_TOKENS = Counter("monsterapp_upstream_tokens_total", "Tokens informados pelos provedores.", ("backend", "kind"))
+QUOTA_REJECTIONS = Counter("monsterapp_quota_rejections_total", "Requisições recusadas por cota.", ("agent", "reason"))
+DB_SECONDS = Histogram(
+    "monsterapp_db_query_seconds", "Duração das consultas ao banco por tipo de comando.", ("statement",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+
+# --- Etapas e detalhamento por requisição ---
+_trace = contextvars.ContextVar("monsterapp_trace", default=None)
+
+
+def observe_stage(name: str, seconds: float):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    trace = _trace.get()
+    if trace is not None:
+        trace[name] = trace.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+class SlowRequestLog:
+    """Últimas requisições lentas com o tempo gasto em cada etapa."""
+
+    def __init__(self, threshold_ms: float = None, sample_rate: float = None, size: int = None):
+        self.threshold_ms = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", 0)) if threshold_ms is None else threshold_ms
+        self.sample_rate = float(os.getenv("SLOW_REQUEST_SAMPLE_RATE", 1.0)) if sample_rate is None else sample_rate
+        self.entries = deque(maxlen=size or int(os.getenv("SLOW_REQUEST_LOG_SIZE", 100)))
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_ms > 0
+
+    def maybe_record(self, method, route, status, seconds, trace):
+        if not self.enabled or seconds * 1000 < self.threshold_ms or random.random() >= self.sample_rate:
+            return
+        entry = {
+            "at": datetime.utcnow().isoformat(),
+            "method": method,
+            "route": route,
+            "status": status,
+            "duration_ms": round(seconds * 1000, 1),
+            "stages_ms": {name: round(value * 1000, 1) for name, value in sorted(trace.items(), key=lambda item: -item[1])},
+        }
+        self.entries.append(entry)
+        logger.warning("Requisição lenta %s %s: %.0fms %s", method, route, entry["duration_ms"], entry["stages_ms"])
+
+
+class MetricsMiddleware:
+    """Middleware ASGI: duração, status e requisições em andamento por rota."""
+
+    def __init__(self, app, slow_log: SlowRequestLog = None):
+        self.app = app
+        self.slow_log = slow_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trace = {}
+        token = _trace.set(trace)
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.labels().inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.labels().dec()
+            _trace.reset(token)
+            # Rota "modelo" (ex: /image-jobs/{job_id}) para não explodir a cardinalidade
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUESTS.labels(method, route, str(status)).inc()
+            HTTP_DURATION.labels(method, route).observe(elapsed)
+            if self.slow_log is not None:
+                self.slow_log.maybe_record(method, route, status, elapsed, trace)
+
+
+def instrument_engine(engine):
+    """Mede cada consulta do SQLAlchemy (etapa `db`)."""
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("monsterapp_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["monsterapp_query_start"].pop()
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+        DB_SECONDS.labels(kind).observe(elapsed)
+        observe_stage("db", elapsed)
+
+
+def render() -> str:
+    return REGISTRY.render()
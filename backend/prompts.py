@@ -0,0 +1,209 @@
+# backend/prompts.py
+
+"""
+Orçamento de tokens e compactação do contexto de perfil nos prompts.
+
+Perfis grandes (dezenas de legendas, bio longa, `profile_data` com campos
+arbitrários) viravam prompts enormes: mais caros e mais lentos de gerar. Aqui
+o contexto de perfil de cada agente cabe num orçamento de tokens
+(`PROMPT_BUDGETS`, ajustável por agente com `PROMPT_BUDGET_<AGENTE>`):
+
+- tokens são estimados localmente (`count_tokens`), sem tokenizer do
+  provedor: cada palavra conta um token a cada 4 caracteres, e cada sinal de
+  pontuação conta um, o que fica próximo do BPE para português;
+- legendas são normalizadas, deduplicadas, cortadas em
+  `PROMPT_CAPTION_MAX_TOKENS` e ordenadas por relevância (termos em comum com
+  o tema do pedido, com desempate pelas mais recentes) até o orçamento acabar;
+- o perfil preparado (campos formatados, legendas limpas) fica em cache por
+  perfil, então chamadas repetidas para o mesmo perfil só refazem a escolha
+  das legendas pelo tema, que é barata.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from cache import TTLCache
+
+_TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+_WORD_RE = re.compile(r"\w{3,}")
+_SPACE_RE = re.compile(r"\s+")
+
+# Orçamento (em tokens) do contexto de perfil de cada agente
+PROMPT_BUDGETS = {
+    "gerar-copy-social-media": 600,
+    "suggest-content-topics": 900,
+    "analyze-competitor-profile": 1200,
+    "pesquisar-hashtags": 150,
+}
+# No /suggest-content-topics, fração do orçamento para o perfil do usuário (o resto é do concorrente)
+TOPICS_USER_SHARE = 0.6
+
+# Campos de `profile_data` usados no contexto, em ordem; os demais entram só se forem curtos
+PROFILE_FIELDS = [
+    ("username", "Usuário"), ("full_name", "Nome"), ("bio", "Bio"), ("category", "Categoria"),
+    ("followers", "Seguidores"), ("following", "Seguindo"), ("posts", "Posts"),
+]
+# Palavras comuns demais para indicar relevância
+_STOPWORDS = frozenset(
+    "que para com uma por mais como mas dos das nos nas seu sua seus suas ele ela eles elas isso este esta "
+    "esse essa aqui muito tem ter são foi ser pra the and for you with this that".split()
+)
+
+
+def count_tokens(text: str) -> int:
+    return len(_TOKEN_RE.findall(text)) if text else 0
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """Corta `text` em `max_tokens` (na fronteira de palavra), com reticências se cortou."""
+    text = _SPACE_RE.sub(" ", text or "").strip()
+    if count_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    for match in re.finditer(r"\S+", text):
+        tokens = count_tokens(match.group())
+        if used + tokens > max_tokens:
+            if used == 0:
+                # Uma única "palavra" enorme (URL, texto sem espaços): corta por caracteres
+                return text[:max_tokens * 4] + "…"
+            return text[:match.start()].rstrip(" ,.;:") + "…"
+        used += tokens
+    return text
+
+
+def _terms(text: str) -> set:
+    return {word for word in _WORD_RE.findall(text.lower()) if word not in _STOPWORDS}
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False).encode()).hexdigest()
+
+
+class _Caption:
+    __slots__ = ("position", "text", "tokens", "terms")
+
+    def __init__(self, position: int, text: str):
+        self.position = position
+        self.text = text
+        self.tokens = count_tokens(text)
+        self.terms = _terms(text)
+
+
+class PromptCompactor:
+    def __init__(self, budgets: dict = None, caption_max_tokens: int = None, maxsize: int = None, ttl: float = None):
+        budgets = budgets or PROMPT_BUDGETS
+        self.budgets = {
+            agent_name: int(os.getenv("PROMPT_BUDGET_" + agent_name.upper().replace("-", "_"), budget))
+            for agent_name, budget in budgets.items()
+        }
+        self.caption_max_tokens = caption_max_tokens or int(os.getenv("PROMPT_CAPTION_MAX_TOKENS", 60))
+        # Perfil preparado (legendas normalizadas, deduplicadas e cortadas); a seleção por tema é barata
+        self._prepared = TTLCache(
+            maxsize=maxsize or int(os.getenv("PROMPT_CONTEXT_CACHE_SIZE", 5000)),
+            ttl=ttl or float(os.getenv("PROMPT_CONTEXT_CACHE_TTL", 3600)),
+        )
+        self.tokens_in = 0
+        self.tokens_out = 0
+
+    def budget(self, agent_name: str) -> int:
+        return self.budgets[agent_name]
+
+    # --- Legendas ---
+    def _prepare_captions(self, captions: list) -> tuple:
+        """(legendas únicas e cortadas, tokens das legendas originais)."""
+        seen = set()
+        prepared = []
+        raw_tokens = 0
+        for caption in captions:
+            if not isinstance(caption, str):
+                continue
+            raw_tokens += count_tokens(caption)
+            text = truncate(caption, self.caption_max_tokens)
+            key = " ".join(_WORD_RE.findall(text.lower()))
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            prepared.append(_Caption(len(prepared), text))
+        return prepared, raw_tokens
+
+    @staticmethod
+    def _select(prepared: list, budget: int, query: str) -> list:
+        query_terms = _terms(query or "")
+        # Mais termos em comum com o tema primeiro; empate: as mais recentes (chegam primeiro)
+        ranked = sorted(prepared, key=lambda c: (-len(c.terms & query_terms), c.position))
+        chosen, used = [], 0
+        for caption in ranked:
+            # ", " entre as legendas custa um token
+            cost = caption.tokens + (1 if chosen else 0)
+            if used + cost <= budget:
+                chosen.append(caption)
+                used += cost
+        return [caption.text for caption in sorted(chosen, key=lambda c: c.position)]
+
+    def captions(self, captions: list, budget: int, query: str = "") -> list:
+        """Legendas deduplicadas, cortadas e priorizadas pelo tema para caber em `budget` tokens."""
+        if not captions:
+            return []
+        key = ("captions", _digest(captions))
+        entry = self._prepared.get(key)
+        if entry is None:
+            entry = self._prepare_captions(captions)
+            self._prepared.set(key, entry)
+        prepared, raw_tokens = entry
+        selected = self._select(prepared, budget, query)
+        self.tokens_in += raw_tokens
+        self.tokens_out += sum(map(count_tokens, selected))
+        return selected
+
+    # --- Perfil ---
+    def _prepare_profile(self, profile: dict, budget: int) -> tuple:
+        lines = []
+        known = {field for field, _ in PROFILE_FIELDS} | {"recent_captions"}
+        for field, label in PROFILE_FIELDS:
+            value = profile.get(field)
+            if value not in (None, ""):
+                # A bio pode ser longa, mas não pode ocupar o espaço das legendas
+                lines.append(f"{label}: {truncate(str(value), max(budget // 4, 20))}")
+        for field, value in profile.items():
+            if field in known or isinstance(value, (dict, list)) or value in (None, ""):
+                continue
+            value = str(value)
+            if count_tokens(value) <= 30:
+                lines.append(f"{field}: {value}")
+        captions = profile.get("recent_captions")
+        prepared, _ = self._prepare_captions(captions) if isinstance(captions, list) else ([], 0)
+        raw_tokens = count_tokens(json.dumps(profile, ensure_ascii=False, default=str))
+        return "\n".join(lines), prepared, raw_tokens
+
+    def profile_context(self, profile: dict, budget: int, query: str = "") -> str:
+        """
+        Contexto compacto de um `profile_data` arbitrário: campos conhecidos,
+        campos extras curtos e as legendas mais relevantes, em até `budget` tokens.
+        """
+        if not profile:
+            return ""
+        key = ("profile", _digest(profile), budget)
+        entry = self._prepared.get(key)
+        if entry is None:
+            entry = self._prepare_profile(profile, budget)
+            self._prepared.set(key, entry)
+        header, prepared, raw_tokens = entry
+        context = header
+        remaining = budget - count_tokens(header) - 5  # "Legendas recentes:"
+        selected = self._select(prepared, remaining, query) if remaining > 0 else []
+        if selected:
+            context = (context + "\n" if context else "") + "Legendas recentes: " + ", ".join(selected)
+        context = truncate(context, budget) if count_tokens(context) > budget else context
+        self.tokens_in += raw_tokens
+        self.tokens_out += count_tokens(context)
+        return context
+
+    def stats(self) -> dict:
+        return {
+            "cache": self._prepared.stats(),
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "budgets": self.budgets,
+        }
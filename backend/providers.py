@@ -0,0 +1,453 @@
+# backend/providers.py
+
+"""
+Camada de provedores externos (OpenAI, Gemini e Stripe).
+
+Nenhum endpoint deve chamar um SDK diretamente: tudo passa por aqui para que
+as chamadas lentas (DALL-E, GPT-4o, Gemini) não bloqueiem o event loop do
+uvicorn. Cada provedor tem um limite de concorrência e um timeout próprios,
+configuráveis por variáveis de ambiente.
+
+Os clientes ficam num registro (`registry`) aberto uma vez no lifespan do
+app: pools HTTP keep-alive (HTTP/2 na OpenAI) dimensionados pelos limites de
+concorrência, modelos do Gemini construídos uma vez por nome, conexões
+aquecidas na subida e fechadas no desligamento.
+
+Os SDKs (google.generativeai com grpc/protobuf, openai e stripe) levam
+segundos para importar, então não são importados com o app: o lifespan os
+carrega numa thread depois da subida (`registry.preload()`) e, se uma
+chamada chegar antes, o SDK é importado no primeiro uso.
+"""
+
+import os
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
+
+import httpx
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    """Erro genérico ao falar com um provedor externo."""
+
+
+class ProviderTimeoutError(ProviderError):
+    """O provedor não respondeu dentro do tempo limite configurado."""
+
+
+class ProviderLimiter:
+    """
+    Limita quantas chamadas a um provedor ficam em voo ao mesmo tempo e por
+    quanto tempo cada uma pode esperar (fila + resposta).
+    """
+
+    def __init__(self, name: str, max_concurrency: int, timeout: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.in_flight = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run(self, coro_factory):
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                return await coro_factory()
+            finally:
+                self.in_flight -= 1
+
+    async def run(self, coro_factory, timeout: float = None):
+        timeout = timeout or self.timeout
+        try:
+            return await asyncio.wait_for(self._run(coro_factory), timeout)
+        except asyncio.TimeoutError:
+            raise ProviderTimeoutError(f"Tempo limite excedido ao chamar {self.name} ({timeout:.0f}s)")
+
+    async def stream(self, stream_factory, timeout: float = None):
+        """
+        Repassa os itens de um stream do provedor, ocupando uma vaga do limite
+        enquanto ele durar. O timeout vale para a espera de cada item.
+        """
+        timeout = timeout or self.timeout
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise ProviderTimeoutError(f"Tempo limite excedido ao aguardar {self.name} ({timeout:.0f}s)")
+        self.in_flight += 1
+        upstream = None
+        try:
+            upstream = await asyncio.wait_for(stream_factory(), timeout)
+            iterator = upstream.__aiter__()
+            while True:
+                try:
+                    item = await asyncio.wait_for(iterator.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                yield item
+        except asyncio.TimeoutError:
+            raise ProviderTimeoutError(f"{self.name} parou de responder durante o streaming ({timeout:.0f}s)")
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            if upstream is not None and hasattr(upstream, "close"):
+                await upstream.close()
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+# --- Limites por provedor ---
+openai_limiter = ProviderLimiter(
+    "openai", _env_int("OPENAI_MAX_CONCURRENCY", 200), _env_float("OPENAI_TIMEOUT", 60)
+)
+gemini_limiter = ProviderLimiter(
+    "gemini", _env_int("GEMINI_MAX_CONCURRENCY", 200), _env_float("GEMINI_TIMEOUT", 45)
+)
+stripe_limiter = ProviderLimiter(
+    "stripe", _env_int("STRIPE_MAX_CONCURRENCY", 16), _env_float("STRIPE_TIMEOUT", 20)
+)
+# DALL-E 3 em qualidade HD leva bem mais que uma completion de texto
+IMAGE_TIMEOUT = _env_float("OPENAI_IMAGE_TIMEOUT", 120)
+
+# --- SDKs (importados sob demanda) ---
+@cache
+def gemini_sdk():
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+    return genai
+
+
+@cache
+def openai_sdk():
+    import openai
+    return openai
+
+
+@cache
+def stripe_sdk():
+    import stripe
+    stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+    return stripe
+
+
+def load_sdks():
+    for load in (gemini_sdk, openai_sdk, stripe_sdk):
+        load()
+
+
+# --- Clientes ---
+# A versão do SDK do Stripe que usamos só tem cliente síncrono, então as
+# chamadas vão para um pool de threads do mesmo tamanho do limite.
+_stripe_executor = ThreadPoolExecutor(
+    max_workers=stripe_limiter.max_concurrency, thread_name_prefix="stripe"
+)
+
+
+class ProviderRegistry:
+    """
+    Clientes reaproveitados entre requisições. `preload()` no lifespan importa
+    os SDKs, abre os pools e aquece as conexões; sem ele (scripts), os
+    clientes são criados no primeiro uso.
+    """
+
+    def __init__(self):
+        self.http2 = os.getenv("PROVIDER_HTTP2", "1") == "1"
+        self.keepalive_expiry = _env_float("PROVIDER_KEEPALIVE_EXPIRY", 60)
+        self.warmup_enabled = os.getenv("PROVIDER_WARMUP", "1") == "1"
+        self.warmup_timeout = _env_float("PROVIDER_WARMUP_TIMEOUT", 5)
+        self.gemini_factory = None  # padrão: genai.GenerativeModel
+        self._openai = None
+        self._stripe = None
+        self._gemini_models = {}
+        self._stripe_session = None
+        self.warmup = {}
+
+    def _open_openai(self):
+        # Com HTTP/2 uma conexão multiplexa várias chamadas; o limite cobre o pior caso em HTTP/1.1
+        http_client = httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=openai_limiter.max_concurrency,
+                max_keepalive_connections=openai_limiter.max_concurrency,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=max(openai_limiter.timeout, IMAGE_TIMEOUT),
+            follow_redirects=True,
+        )
+        self._openai = openai_sdk().AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=max(openai_limiter.timeout, IMAGE_TIMEOUT),
+            http_client=http_client,
+        )
+
+    @property
+    def openai(self):
+        if self._openai is None:
+            self._open_openai()
+        return self._openai
+
+    @openai.setter
+    def openai(self, client):
+        self._openai = client
+
+    @property
+    def stripe(self):
+        return self._stripe or stripe_sdk()
+
+    @stripe.setter
+    def stripe(self, module):
+        self._stripe = module
+
+    def set_gemini_factory(self, factory):
+        """Troca a fábrica de modelos do Gemini (ex: fakes do benchmark) e descarta os já criados."""
+        self.gemini_factory = factory
+        self._gemini_models.clear()
+
+    def gemini_model(self, model: str):
+        handle = self._gemini_models.get(model)
+        if handle is None:
+            factory = self.gemini_factory or gemini_sdk().GenerativeModel
+            handle = self._gemini_models[model] = factory(model)
+        return handle
+
+    def _open_stripe(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # Uma sessão compartilhada pelas threads do executor, com uma conexão por thread
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=stripe_limiter.max_concurrency)
+        session.mount("https://", adapter)
+        self._stripe_session = session
+        stripe = stripe_sdk()
+        stripe.default_http_client = stripe.RequestsClient(timeout=stripe_limiter.timeout, session=session)
+
+    # --- Ciclo de vida ---
+    async def _warm(self, name: str, call):
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(call(), self.warmup_timeout)
+            self.warmup[name] = {"ok": True}
+        except Exception as e:
+            # Até uma resposta de erro (ex: 401) já deixa a conexão TLS aberta no pool
+            self.warmup[name] = {"ok": False, "error": type(e).__name__}
+        self.warmup[name]["ms"] = round((time.perf_counter() - started) * 1000)
+
+    async def preload(self):
+        """Importa os SDKs fora do event loop e então abre e aquece os clientes."""
+        await asyncio.to_thread(load_sdks)
+        await self.start()
+
+    async def start(self):
+        if self._openai is None:
+            self._open_openai()
+        if self._stripe_session is None:
+            self._open_stripe()
+        self.gemini_model("gemini-pro")
+        if not self.warmup_enabled:
+            return
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            self._warm("openai", lambda: self.openai.with_options(max_retries=0).models.list()),
+            self._warm("gemini", lambda: self.gemini_model("gemini-pro").count_tokens_async("ping")),
+            self._warm("stripe", lambda: loop.run_in_executor(
+                _stripe_executor, partial(self._stripe_session.head, stripe_sdk().api_base, timeout=self.warmup_timeout)
+            )),
+        )
+        logger.info("Conexões com os provedores aquecidas: %s", self.warmup)
+
+    async def close(self):
+        if self._openai is not None:
+            await self._openai.close()
+            self._openai = None
+        if self._stripe_session is not None:
+            self._stripe_session.close()
+            self._stripe_session = None
+            stripe_sdk().default_http_client = None
+        self._gemini_models.clear()
+
+    def stats(self) -> dict:
+        return {
+            "http2": self.http2,
+            "gemini_models": sorted(self._gemini_models),
+            "warmup": self.warmup,
+        }
+
+
+registry = ProviderRegistry()
+
+
+# --- Chamadas ---
+async def chat_completion(messages: list, model: str = "gpt-4o", timeout: float = None, **kwargs):
+    """Chat completion da OpenAI sem bloquear o event loop."""
+    return await openai_limiter.run(
+        lambda: registry.openai.chat.completions.create(model=model, messages=messages, **kwargs),
+        timeout=timeout,
+    )
+
+
+async def chat_completion_stream(messages: list, model: str = "gpt-4o", timeout: float = None, **kwargs):
+    """Chat completion em streaming: gera os trechos de texto à medida que chegam."""
+    stream = openai_limiter.stream(
+        lambda: registry.openai.chat.completions.create(model=model, messages=messages, stream=True, **kwargs),
+        timeout=timeout,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def generate_image(prompt: str, model: str = "dall-e-3", **kwargs):
+    """Geração de imagem (DALL-E) com timeout próprio."""
+    return await openai_limiter.run(
+        lambda: registry.openai.images.generate(model=model, prompt=prompt, **kwargs),
+        timeout=IMAGE_TIMEOUT,
+    )
+
+
+async def gemini_generate(prompt: str, model: str = "gemini-pro", timeout: float = None, generation_config: dict = None):
+    """Geração de texto no Gemini usando o cliente assíncrono do SDK."""
+    kwargs = {"generation_config": generation_config} if generation_config else {}
+    return await gemini_limiter.run(
+        lambda: registry.gemini_model(model).generate_content_async(prompt, **kwargs),
+        timeout=timeout,
+    )
+
+
+async def gemini_generate_stream(prompt: str, model: str = "gemini-pro", timeout: float = None, generation_config: dict = None):
+    """Geração de texto no Gemini em streaming: gera os trechos de texto à medida que chegam."""
+    kwargs = {"generation_config": generation_config} if generation_config else {}
+    stream = gemini_limiter.stream(
+        lambda: registry.gemini_model(model).generate_content_async(prompt, stream=True, **kwargs),
+        timeout=timeout,
+    )
+    async for chunk in stream:
+        # O último trecho pode vir só com o motivo de parada, sem texto
+        if chunk.candidates and chunk.candidates[0].content.parts:
+            yield chunk.text
+
+
+# --- Backends de texto para o roteador (ver router.py) ---
+# Todos recebem mensagens no formato da OpenAI e devolvem só o texto gerado.
+async def openai_text(messages: list, model: str, timeout: float = None, json_mode: bool = False) -> str:
+    kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+    response = await chat_completion(messages, model=model, timeout=timeout, **kwargs)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        _record_tokens(f"openai:{model}", usage.prompt_tokens, usage.completion_tokens)
+    return response.choices[0].message.content
+
+
+# Modelos do Gemini sem o modo JSON (`response_mime_type`): seguem só as instruções do prompt
+_GEMINI_WITHOUT_JSON_MODE = ("gemini-pro", "gemini-1.0")
+
+
+def _gemini_request(messages: list, model: str, json_mode: bool):
+    # O gemini-pro não tem papel de sistema: as mensagens viram um único prompt
+    prompt = "\n\n".join(message["content"] for message in messages)
+    config = None
+    if json_mode and not model.startswith(_GEMINI_WITHOUT_JSON_MODE):
+        config = {"response_mime_type": "application/json"}
+    return prompt, config
+
+
+async def gemini_text(messages: list, model: str, timeout: float = None, json_mode: bool = False) -> str:
+    prompt, config = _gemini_request(messages, model, json_mode)
+    response = await gemini_generate(prompt, model=model, timeout=timeout, generation_config=config)
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        _record_tokens(f"gemini:{model}", usage.prompt_token_count, usage.candidates_token_count)
+    return response.text
+
+
+async def openai_text_stream(messages: list, model: str, timeout: float = None, json_mode: bool = False):
+    kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+    async for delta in chat_completion_stream(messages, model=model, timeout=timeout, **kwargs):
+        yield delta
+
+
+async def gemini_text_stream(messages: list, model: str, timeout: float = None, json_mode: bool = False):
+    prompt, config = _gemini_request(messages, model, json_mode)
+    async for delta in gemini_generate_stream(prompt, model=model, timeout=timeout, generation_config=config):
+        yield delta
+
+
+def _record_tokens(backend: str, prompt_tokens, completion_tokens):
+    metrics.UPSTREAM_TOKENS.labels(backend, "prompt").inc(prompt_tokens or 0)
+    metrics.UPSTREAM_TOKENS.labels(backend, "completion").inc(completion_tokens or 0)
+
+
+_TEXT_PROVIDERS = {
+    "openai": (openai_text, openai_limiter),
+    "gemini": (gemini_text, gemini_limiter),
+}
+_TEXT_STREAMS = {
+    "openai": openai_text_stream,
+    "gemini": gemini_text_stream,
+}
+
+
+def _parse_spec(spec: str):
+    provider, _, model = spec.partition(":")
+    if provider not in _TEXT_PROVIDERS or not model:
+        raise ValueError(f"Backend de texto inválido: {spec}")
+    return provider, model
+
+
+def text_backend(spec: str):
+    """
+    Resolve "provedor:modelo" em (call, timeout). O timeout pode ser ajustado
+    por backend, ex: `TIMEOUT_GEMINI_GEMINI_PRO=20`.
+    """
+    provider, model = _parse_spec(spec)
+    call, limiter = _TEXT_PROVIDERS[provider]
+    env_name = "TIMEOUT_" + "".join(c if c.isalnum() else "_" for c in spec.upper())
+    timeout = _env_float(env_name, limiter.timeout)
+    return partial(_call_text, spec, call, model), timeout
+
+
+def text_stream_backend(spec: str):
+    """Resolve "provedor:modelo" no stream equivalente de `text_backend`."""
+    provider, model = _parse_spec(spec)
+    return partial(_TEXT_STREAMS[provider], model=model)
+
+
+async def _call_text(spec, call, model, messages, timeout, json_mode=False):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await call(messages, model=model, timeout=timeout, json_mode=json_mode)
+        outcome = "ok"
+        return result
+    except asyncio.CancelledError:
+        # Chamada perdedora de um hedge (ou cliente desconectado)
+        outcome = "cancelled"
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.UPSTREAM_SECONDS.labels(spec, outcome).observe(elapsed)
+        metrics.observe_stage("upstream", elapsed)
+
+
+async def create_checkout_session(**kwargs):
+    """Cria uma sessão de checkout do Stripe fora do event loop."""
+    loop = asyncio.get_running_loop()
+    return await stripe_limiter.run(
+        lambda: loop.run_in_executor(_stripe_executor, partial(_stripe_checkout, kwargs))
+    )
+
+
+def _stripe_checkout(kwargs):
+    # Roda na thread do executor: um eventual import do SDK não trava o event loop
+    return registry.stripe.checkout.Session.create(**kwargs)
@@ -0,0 +1,436 @@
+# backend/quota.py
+
+"""
+Motor de cotas e limites de taxa.
+
+Mantém contadores por (usuário, agente, dia UTC) para que a verificação do
+plano FREE seja O(1), sem COUNT(*) em `api_usage` a cada chamada. Os registros
+de uso continuam indo para `api_usage`, mas em lotes gravados em segundo plano.
+
+O armazenamento dos contadores é plugável (`QUOTA_BACKEND`):
+
+- `memory`: contadores no próprio processo. Exato com um único worker.
+- `sqlite`: arquivo SQLite em modo WAL compartilhado por todos os workers da
+  máquina (`QUOTA_STATE_PATH`). Cada verificação é um único UPSERT
+  condicional, então N workers aplicam os limites de forma exata.
+
+Qualquer outro armazenamento (Redis, por exemplo) só precisa implementar os
+mesmos métodos de `MemoryQuotaBackend`.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select
+
+logger = logging.getLogger(__name__)
+
+
+def utc_day(moment: datetime = None):
+    return (moment or datetime.utcnow()).date()
+
+
+def _day_start(day) -> datetime:
+    return datetime(day.year, day.month, day.day)
+
+
+# --- Backends de contadores ---
+class MemoryQuotaBackend:
+    """Contadores no processo atual: rápido, mas cada worker tem os seus."""
+
+    def __init__(self):
+        self._daily = {}
+        self._current_day = None
+        self._hits = {}
+        self._last_cleanup = 0.0
+
+    async def seed(self, counts: dict):
+        for key, count in counts.items():
+            self._daily[key] = max(self._daily.get(key, 0), count)
+
+    async def consume_daily(self, user_id, agent_name, day, limit: int, amount: int = 1) -> bool:
+        if day != self._current_day:
+            self._daily = {key: value for key, value in self._daily.items() if key[2] >= day}
+            self._current_day = day
+        key = (user_id, agent_name, day)
+        count = self._daily.get(key, 0)
+        if count + amount > limit:
+            return False
+        self._daily[key] = count + amount
+        return True
+
+    async def add_daily(self, user_id, agent_name, day, amount: int = 1):
+        key = (user_id, agent_name, day)
+        self._daily[key] = self._daily.get(key, 0) + amount
+
+    async def release_daily(self, user_id, agent_name, day, amount: int = 1):
+        key = (user_id, agent_name, day)
+        if key in self._daily:
+            self._daily[key] = max(self._daily[key] - amount, 0)
+
+    async def daily_count(self, user_id, agent_name, day) -> int:
+        return self._daily.get((user_id, agent_name, day), 0)
+
+    async def consume_burst(self, user_id, limit: int, window: float) -> float:
+        """Janela deslizante exata. Retorna 0 se permitido, senão os segundos até liberar."""
+        now = time.monotonic()
+        if now - self._last_cleanup > window * 10:
+            # Usuários sem nenhum acesso dentro da janela não precisam de entrada
+            self._hits = {key: hits for key, hits in self._hits.items() if hits and hits[-1] > now - window}
+            self._last_cleanup = now
+        hits = self._hits.setdefault(user_id, deque())
+        while hits and hits[0] <= now - window:
+            hits.popleft()
+        if len(hits) >= limit:
+            return hits[0] + window - now
+        hits.append(now)
+        return 0.0
+
+    async def close(self):
+        pass
+
+
+class SQLiteQuotaBackend:
+    """
+    Contadores num arquivo SQLite (WAL) compartilhado entre workers.
+
+    Verificar e incrementar é um único UPSERT com WHERE: ou a linha é
+    incrementada (rowcount 1) ou o limite já foi atingido (rowcount 0).
+    O limite de rajada usa uma janela deslizante aproximada por dois baldes
+    fixos, também verificada e incrementada num único comando.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS daily_counters (
+            user_id INTEGER NOT NULL,
+            agent_name TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, agent_name, day)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            user_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (user_id, bucket)
+        ) WITHOUT ROWID;
+    """
+
+    _CONSUME_DAILY = """
+        INSERT INTO daily_counters (user_id, agent_name, day, count)
+        SELECT :user_id, :agent_name, :day, :amount WHERE :amount <= :limit
+        ON CONFLICT (user_id, agent_name, day) DO UPDATE SET count = count + :amount
+        WHERE daily_counters.count + :amount <= :limit
+    """
+
+    _ADD_DAILY = """
+        INSERT INTO daily_counters (user_id, agent_name, day, count)
+        VALUES (:user_id, :agent_name, :day, :amount)
+        ON CONFLICT (user_id, agent_name, day) DO UPDATE SET count = count + :amount
+    """
+
+    _RELEASE_DAILY = """
+        UPDATE daily_counters SET count = max(count - :amount, 0)
+        WHERE user_id = :user_id AND agent_name = :agent_name AND day = :day
+    """
+
+    _SEED_DAILY = """
+        INSERT INTO daily_counters (user_id, agent_name, day, count)
+        VALUES (:user_id, :agent_name, :day, :count)
+        ON CONFLICT (user_id, agent_name, day) DO UPDATE SET count = max(count, excluded.count)
+    """
+
+    _CONSUME_BURST = """
+        INSERT INTO rate_buckets (user_id, bucket, count)
+        SELECT :user_id, :bucket, 1
+        WHERE :weight * COALESCE((SELECT count FROM rate_buckets WHERE user_id = :user_id AND bucket = :bucket - 1), 0) + 1 <= :limit
+        ON CONFLICT (user_id, bucket) DO UPDATE SET count = count + 1
+        WHERE :weight * COALESCE((SELECT count FROM rate_buckets WHERE user_id = :user_id AND bucket = :bucket - 1), 0)
+              + rate_buckets.count + 1 <= :limit
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Uma única thread por worker: os comandos levam microssegundos e a
+        # conexão SQLite não precisa ser compartilhada entre threads.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quota")
+        self._conn = None
+        self._last_cleanup = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(self._SCHEMA)
+        return conn
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _execute(self, sql, params=None):
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn.execute(sql, params or {})
+
+    def _seed(self, counts):
+        self._execute("BEGIN IMMEDIATE")
+        try:
+            for (user_id, agent_name, day), count in counts.items():
+                self._execute(self._SEED_DAILY, {
+                    "user_id": user_id, "agent_name": agent_name, "day": day.isoformat(), "count": count,
+                })
+            # Contadores de dias anteriores não servem para mais nada
+            self._execute("DELETE FROM daily_counters WHERE day < :day", {"day": utc_day().isoformat()})
+            self._execute("COMMIT")
+        except Exception:
+            self._execute("ROLLBACK")
+            raise
+
+    async def seed(self, counts: dict):
+        await self._run(self._seed, counts)
+
+    def _consume_daily(self, user_id, agent_name, day, limit, amount):
+        cursor = self._execute(self._CONSUME_DAILY, {
+            "user_id": user_id, "agent_name": agent_name, "day": day.isoformat(), "limit": limit, "amount": amount,
+        })
+        return cursor.rowcount == 1
+
+    async def consume_daily(self, user_id, agent_name, day, limit: int, amount: int = 1) -> bool:
+        return await self._run(self._consume_daily, user_id, agent_name, day, limit, amount)
+
+    def _add_daily(self, user_id, agent_name, day, amount):
+        self._execute(self._ADD_DAILY, {
+            "user_id": user_id, "agent_name": agent_name, "day": day.isoformat(), "amount": amount,
+        })
+
+    async def add_daily(self, user_id, agent_name, day, amount: int = 1):
+        await self._run(self._add_daily, user_id, agent_name, day, amount)
+
+    def _release_daily(self, user_id, agent_name, day, amount):
+        self._execute(self._RELEASE_DAILY, {
+            "user_id": user_id, "agent_name": agent_name, "day": day.isoformat(), "amount": amount,
+        })
+
+    async def release_daily(self, user_id, agent_name, day, amount: int = 1):
+        await self._run(self._release_daily, user_id, agent_name, day, amount)
+
+    def _daily_count(self, user_id, agent_name, day):
+        row = self._execute(
+            "SELECT count FROM daily_counters WHERE user_id = :user_id AND agent_name = :agent_name AND day = :day",
+            {"user_id": user_id, "agent_name": agent_name, "day": day.isoformat()},
+        ).fetchone()
+        return row[0] if row else 0
+
+    async def daily_count(self, user_id, agent_name, day) -> int:
+        return await self._run(self._daily_count, user_id, agent_name, day)
+
+    def _consume_burst(self, user_id, limit, window):
+        now = time.time()
+        bucket, offset = divmod(now, window)
+        weight = 1 - offset / window
+        cursor = self._execute(self._CONSUME_BURST, {
+            "user_id": user_id, "bucket": int(bucket), "weight": weight, "limit": limit,
+        })
+        if now - self._last_cleanup > window * 10:
+            self._execute("DELETE FROM rate_buckets WHERE bucket < :bucket", {"bucket": int(bucket) - 1})
+            self._last_cleanup = now
+        return 0.0 if cursor.rowcount == 1 else window - offset
+
+    async def consume_burst(self, user_id, limit: int, window: float) -> float:
+        return await self._run(self._consume_burst, user_id, limit, window)
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+
+def create_backend(kind: str = None):
+    kind = kind or os.getenv("QUOTA_BACKEND", "memory")
+    if kind == "memory":
+        return MemoryQuotaBackend()
+    if kind == "sqlite":
+        return SQLiteQuotaBackend(os.getenv("QUOTA_STATE_PATH", "./quota_state.db"))
+    raise ValueError(f"QUOTA_BACKEND desconhecido: {kind}")
+
+
+# --- Motor de cotas ---
+class Reservation:
+    """
+    Usos reservados na cota diária mas ainda não registrados.
+
+    `commit` registra usos em `api_usage`; `release` devolve à cota o que não
+    foi confirmado (por exemplo, quando o provedor falha antes de responder).
+    """
+
+    def __init__(self, engine, user_id, agent_name, day, amount: int, limited: bool, cache_hit: bool):
+        self._engine = engine
+        self.user_id = user_id
+        self.agent_name = agent_name
+        self.day = day
+        self.remaining = amount
+        self.limited = limited  # se a reserva ocupa os contadores diários
+        self.cache_hit = cache_hit
+
+    def commit(self, count: int = 1, latency_ms: int = None):
+        count = min(count, self.remaining)
+        if count <= 0:
+            return
+        self.remaining -= count
+        self._engine._record(self.user_id, self.agent_name, self.cache_hit, count, latency_ms)
+
+    def split(self, count: int = 1):
+        """Separa `count` usos numa reserva própria, confirmada ou devolvida à parte (ex.: jobs)."""
+        count = min(count, self.remaining)
+        self.remaining -= count
+        return Reservation(self._engine, self.user_id, self.agent_name, self.day, count, self.limited, self.cache_hit)
+
+    async def release(self, count: int = None):
+        amount = self.remaining if count is None else min(count, self.remaining)
+        self.remaining -= amount
+        if self.limited and amount > 0:
+            await self._engine.backend.release_daily(self.user_id, self.agent_name, self.day, amount)
+
+
+class QuotaEngine:
+    """
+    Cotas diárias e limites de rajada sobre um backend de contadores, mais a
+    fila de gravação em lote para `api_usage`.
+
+    - Na inicialização (`start`) as contagens do dia corrente são lidas com um
+      único GROUP BY e usadas para semear o backend; a partir daí uma chave
+      ausente significa zero usos, inclusive depois da virada do dia (UTC).
+    - Em `stop` a fila pendente é gravada antes de encerrar, então um restart
+      limpo não perde usos; um crash perde no máximo um intervalo de flush.
+    """
+
+    def __init__(self, session_factory, usage_model, backend=None, flush_interval: float = None, batch_size: int = None,
+                 count_cache_hits: bool = True, rollup=None):
+        self._session_factory = session_factory
+        self._usage_model = usage_model
+        # Com um UsageRollup, as contagens iniciais vêm dos agregados diários (ver usage_rollup.py)
+        self._rollup = rollup
+        # Se False, usos servidos pelo cache de respostas não entram na cota diária
+        self.count_cache_hits = count_cache_hits
+        self.backend = backend or create_backend()
+        self.flush_interval = flush_interval or float(os.getenv("QUOTA_FLUSH_INTERVAL", 1.0))
+        self.batch_size = batch_size or int(os.getenv("QUOTA_FLUSH_BATCH", 500))
+        self._pending = []
+        self._started = False
+        self._start_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+
+    async def _load_day(self, day):
+        Usage = self._usage_model
+        start = _day_start(day)
+        if self._rollup is not None:
+            return await self._rollup.counts(start, include_cache_hits=self.count_cache_hits)
+        query = select(Usage.user_id, Usage.agent_name, func.count(Usage.id)).where(
+            Usage.timestamp >= start,
+            Usage.timestamp < start + timedelta(days=1),
+        )
+        if not self.count_cache_hits:
+            query = query.where(Usage.cache_hit.is_(False))
+        async with self._session_factory() as db:
+            rows = (await db.execute(query.group_by(Usage.user_id, Usage.agent_name))).all()
+        return {(user_id, agent_name, day): count for user_id, agent_name, count in rows}
+
+    # --- API pública ---
+    async def reserve(self, user_id: int, agent_name: str, limit: int = 0, amount: int = 1,
+                      cache_hit: bool = False):
+        """
+        Reserva `amount` usos de forma atômica. `limit <= 0` significa ilimitado.
+        Retorna uma `Reservation`, ou None se a reserva estouraria o limite diário.
+        Os usos só vão para `api_usage` quando confirmados com `commit`.
+        """
+        if not self._started:
+            await self.start()
+        day = utc_day()
+        if cache_hit and not self.count_cache_hits:
+            limit = 0
+        if limit > 0 and not await self.backend.consume_daily(user_id, agent_name, day, limit, amount):
+            return None
+        return Reservation(self, user_id, agent_name, day, amount, limit > 0, cache_hit)
+
+    async def charge(self, user_id: int, agent_name: str, amount: int = 1):
+        """
+        Como `reserve`, mas sem checar o limite, para usos que já aconteceram
+        (ex.: um job retomado depois de um restart): o contador do dia sobe
+        mesmo acima do limite, e as próximas reservas já o enxergam.
+        """
+        if not self._started:
+            await self.start()
+        day = utc_day()
+        await self.backend.add_daily(user_id, agent_name, day, amount)
+        return Reservation(self, user_id, agent_name, day, amount, True, False)
+
+    def _record(self, user_id, agent_name, cache_hit, count=1, latency_ms=None):
+        now = datetime.utcnow()
+        self._pending.extend(
+            {"user_id": user_id, "agent_name": agent_name, "timestamp": now, "cache_hit": cache_hit, "latency_ms": latency_ms}
+            for _ in range(count)
+        )
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def check_burst(self, user_id: int, limit: int, window: float) -> float:
+        """Limite de rajada por usuário. Retorna 0 se permitido, senão os segundos de espera."""
+        if limit <= 0:
+            return 0.0
+        return await self.backend.consume_burst(user_id, limit, window)
+
+    # --- Gravação em lote ---
+    async def _write(self, rows):
+        async with self._session_factory() as db:
+            await db.execute(insert(self._usage_model), rows)
+            await db.commit()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await self._write(rows)
+        except Exception:
+            logger.exception("Falha ao gravar %d registros de uso; nova tentativa no próximo ciclo", len(rows))
+            self._pending[:0] = rows
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        async with self._start_lock:
+            if self._started:
+                return
+            counts = await self._load_day(utc_day())
+            await self.backend.seed(counts)
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+            self._started = True
+
+    async def stop(self):
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        await self.backend.close()
+        self._started = False
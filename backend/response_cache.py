@@ -0,0 +1,147 @@
+# backend/response_cache.py
+
+"""
+Cache de respostas dos agentes "determinísticos o bastante" (hashtags,
+tópicos, análise de concorrentes).
+
+A chave é uma impressão digital do prompt normalizado: agente, modelo e os
+campos da requisição que entram no prompt, em minúsculas e sem espaços
+repetidos. Há duas camadas:
+
+- memória: LRU limitado por quantidade de itens, com TTL por agente;
+- disco: SQLite (`RESPONSE_CACHE_PATH`) que sobrevive a restarts e é
+  compartilhado pelos workers da máquina.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(value) -> str:
+    if value is None:
+        return ""
+    text = unicodedata.normalize("NFKC", str(value)).lower()
+    return " ".join(text.split())
+
+
+def _normalize(value):
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in sorted(value.items())}
+    return normalize_text(value)
+
+
+def fingerprint(agent_name: str, model: str, **fields) -> str:
+    """Hash estável de (agente, modelo, campos normalizados)."""
+    payload = json.dumps([agent_name, model, _normalize(fields)], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            agent_name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_responses_expires_at ON responses (expires_at);
+    """
+
+    def __init__(self, ttls: dict, maxsize: int = None, path: str = None, disk_maxsize: int = None):
+        self.ttls = ttls
+        self.memory = TTLCache(
+            maxsize=maxsize or int(os.getenv("RESPONSE_CACHE_SIZE", 5000)),
+            ttl=max(ttls.values(), default=3600),
+        )
+        self.path = os.getenv("RESPONSE_CACHE_PATH", "./response_cache.db") if path is None else path
+        self.disk_maxsize = disk_maxsize or int(os.getenv("RESPONSE_CACHE_DISK_SIZE", 100000))
+        self.disk_hits = 0
+        self._writes = 0
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+
+    def enabled_for(self, agent_name: str) -> bool:
+        return self.ttls.get(agent_name, 0) > 0
+
+    # --- Camada de disco ---
+    def _execute(self, sql, params=()):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self._SCHEMA)
+        return self._conn.execute(sql, params)
+
+    def _disk_get(self, key):
+        row = self._execute("SELECT value, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _disk_set(self, key, agent_name, value, expires_at):
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO responses (key, agent_name, value, expires_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (key, agent_name, json.dumps(value, ensure_ascii=False), expires_at, now),
+        )
+        self._writes += 1
+        if self._writes % 500 == 0:
+            self._execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+            self._execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.disk_maxsize,),
+            )
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    # --- API pública ---
+    async def get(self, key: str):
+        value = self.memory.get(key)
+        if value is not None or not self.path:
+            return value
+        try:
+            found = await self._run(self._disk_get, key)
+        except Exception:
+            logger.exception("Falha ao ler o cache de respostas em disco")
+            return None
+        if found is None:
+            return None
+        value, expires_at = found
+        self.disk_hits += 1
+        self.memory.set(key, value, ttl=expires_at - time.time())
+        return value
+
+    async def set(self, agent_name: str, key: str, value):
+        ttl = self.ttls.get(agent_name, 0)
+        if ttl <= 0:
+            return
+        self.memory.set(key, value, ttl=ttl)
+        if self.path:
+            try:
+                await self._run(self._disk_set, key, agent_name, value, time.time() + ttl)
+            except Exception:
+                logger.exception("Falha ao gravar o cache de respostas em disco")
+
+    def stats(self) -> dict:
+        return {**self.memory.stats(), "disk_hits": self.disk_hits}
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
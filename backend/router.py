@@ -0,0 +1,326 @@
+# backend/router.py
+
+"""
+Roteamento dos agentes entre provedores (OpenAI, Gemini) com failover,
+circuit breaker e requisições "hedged".
+
+Cada agente declara uma lista ordenada de backends capazes de atendê-lo
+(ex: `["gemini:gemini-pro", "openai:gpt-4o-mini"]`). A cada chamada:
+
+- o primário é o primeiro backend saudável da lista, a menos que outro tenha
+  estatísticas recentes claramente melhores (latência ajustada pela taxa de
+  erro, com histerese para não ficar alternando);
+- se o primário falhar, o próximo é chamado na hora (failover);
+- se o primário passar do percentil de latência configurado sem responder,
+  um segundo backend é disparado em paralelo (hedge) e vence quem responder
+  primeiro com sucesso; o outro é cancelado;
+- backends que falham seguidamente têm o circuito aberto e ficam fora do
+  rodízio até o fim do cooldown, quando recebem uma chamada de teste.
+
+Os endpoints em streaming usam `ProviderRouter.stream`: mesma ordem e mesmos
+circuitos, com failover só até o primeiro trecho (depois disso o cliente já
+recebeu parte da resposta) e sem hedge.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self._probing = False
+        if self.state == HALF_OPEN and not self._probing:
+            # Só uma chamada de teste por vez enquanto o circuito está meio aberto
+            self._probing = True
+            return True
+        return False
+
+    def available(self) -> bool:
+        """Como `allow`, mas sem consumir a chamada de teste."""
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return self.state == CLOSED or not self._probing
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_cancel(self):
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self.failures >= self.threshold:
+            if self.state != OPEN:
+                logger.warning("Circuito aberto após %d falha(s) seguida(s)", self.failures)
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class RollingStats:
+    """Latências (só sucessos) e resultados das últimas `window` chamadas."""
+
+    def __init__(self, window: int):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+
+    def record(self, ok: bool, latency: float = None):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+
+    def percentile(self, q: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def score(self):
+        """Latência mediana penalizada pela taxa de erro (menor é melhor)."""
+        if not self.outcomes:
+            return None
+        median = self.percentile(0.5)
+        if median is None:
+            return float("inf")  # só falhas na janela
+        return median / max(1 - self.error_rate(), 0.1)
+
+
+class Backend:
+    """
+    Um provedor + modelo. `call(messages, timeout, json_mode)` devolve o texto
+    gerado; `stream(messages, timeout=..., json_mode=...)`, quando existe, gera
+    os trechos à medida que chegam.
+    """
+
+    def __init__(self, name: str, call, timeout: float, window: int, breaker_threshold: int, breaker_cooldown: float,
+                 stream=None):
+        self.name = name
+        self._call = call
+        self._stream = stream
+        self.timeout = timeout
+        self.stats = RollingStats(window)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+
+    async def call(self, messages: list, json_mode: bool = False) -> str:
+        started = time.monotonic()
+        try:
+            result = await self._call(messages, self.timeout, json_mode=json_mode)
+        except asyncio.CancelledError:
+            # Perdeu o hedge ou o cliente desconectou: não conta como falha
+            self.breaker.record_cancel()
+            raise
+        except Exception:
+            self.stats.record(False)
+            self.breaker.record_failure()
+            raise
+        self.stats.record(True, time.monotonic() - started)
+        self.breaker.record_success()
+        return result
+
+    async def stream(self, messages: list, json_mode: bool = False):
+        # Só o circuito acompanha os streams: a duração deles não é comparável à das chamadas
+        deltas = self._stream(messages, timeout=self.timeout, json_mode=json_mode)
+        try:
+            async for delta in deltas:
+                yield delta
+        except (asyncio.CancelledError, GeneratorExit):
+            self.breaker.record_cancel()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        finally:
+            await deltas.aclose()
+        self.breaker.record_success()
+
+
+def _discard_result(task):
+    if not task.cancelled():
+        task.exception()
+
+
+class NoBackendAvailable(Exception):
+    """Todos os backends da rota estão com o circuito aberto."""
+
+
+class ProviderRouter:
+    def __init__(self, routes: dict, factory, stream_factory=None, hedge_percentile: float = None, hedge_min_samples: int = None,
+                 hedge_min_delay: float = None, window: int = None, min_samples: int = None,
+                 switch_ratio: float = None, breaker_threshold: int = None, breaker_cooldown: float = None):
+        self.routes = routes      # agente -> lista ordenada de specs "provedor:modelo"
+        self._factory = factory   # spec -> (call, timeout)
+        self._stream_factory = stream_factory  # spec -> stream
+        # 0 desliga o hedge
+        self.hedge_percentile = float(os.getenv("ROUTER_HEDGE_PERCENTILE", 0.95)) if hedge_percentile is None else hedge_percentile
+        self.hedge_min_samples = hedge_min_samples or int(os.getenv("ROUTER_HEDGE_MIN_SAMPLES", 20))
+        self.hedge_min_delay = float(os.getenv("ROUTER_HEDGE_MIN_DELAY", 1.0)) if hedge_min_delay is None else hedge_min_delay
+        self.window = window or int(os.getenv("ROUTER_STATS_WINDOW", 200))
+        self.min_samples = min_samples or int(os.getenv("ROUTER_MIN_SAMPLES", 20))
+        # Um fallback só vira primário se for pelo menos esse tanto melhor
+        self.switch_ratio = switch_ratio or float(os.getenv("ROUTER_SWITCH_RATIO", 1.5))
+        self.breaker_threshold = breaker_threshold or int(os.getenv("ROUTER_BREAKER_THRESHOLD", 5))
+        self.breaker_cooldown = breaker_cooldown or float(os.getenv("ROUTER_BREAKER_COOLDOWN", 30))
+        self.backends = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def backend(self, spec: str) -> Backend:
+        backend = self.backends.get(spec)
+        if backend is None:
+            call, timeout = self._factory(spec)
+            stream = self._stream_factory(spec) if self._stream_factory else None
+            backend = self.backends[spec] = Backend(
+                spec, call, timeout, self.window, self.breaker_threshold, self.breaker_cooldown, stream
+            )
+        return backend
+
+    def ranked(self, agent_name: str) -> list:
+        """Backends disponíveis da rota, com o primário na frente."""
+        candidates = [self.backend(spec) for spec in self.routes[agent_name]]
+        candidates = [b for b in candidates if b.breaker.available()]
+        if len(candidates) < 2:
+            return candidates
+        primary = candidates[0]
+        primary_score = primary.stats.score() if len(primary.stats.outcomes) >= self.min_samples else None
+        if primary_score is not None:
+            for backend in candidates[1:]:
+                score = backend.stats.score() if len(backend.stats.outcomes) >= self.min_samples else None
+                if score is not None and score * self.switch_ratio < primary_score:
+                    candidates.remove(backend)
+                    candidates.insert(0, backend)
+                    break
+        return candidates
+
+    def _hedge_delay(self, backend: Backend):
+        if self.hedge_percentile <= 0 or len(backend.stats.latencies) < self.hedge_min_samples:
+            return None
+        return max(backend.stats.percentile(self.hedge_percentile), self.hedge_min_delay)
+
+    async def complete(self, agent_name: str, messages: list, json_mode: bool = False) -> str:
+        """
+        Texto gerado pelo melhor backend disponível para o agente. `json_mode`
+        pede ao provedor uma resposta em JSON quando ele oferece esse modo.
+        """
+        candidates = iter(self.ranked(agent_name))
+        pending = {}
+        errors = []
+
+        def launch() -> bool:
+            for backend in candidates:
+                if backend.breaker.allow():
+                    pending[asyncio.ensure_future(backend.call(messages, json_mode))] = backend
+                    return True
+            return False
+
+        if not launch():
+            raise NoBackendAvailable(f"Nenhum provedor disponível para {agent_name}")
+        primary = next(iter(pending.values()))
+        loop = asyncio.get_running_loop()
+        delay = self._hedge_delay(primary)
+        hedge_at = loop.time() + delay if delay is not None else None
+        try:
+            while pending:
+                timeout = max(hedge_at - loop.time(), 0) if hedge_at is not None else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # O primário passou do percentil de latência: dispara o hedge
+                    hedge_at = None
+                    if launch():
+                        self.hedges += 1
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is None:
+                        if backend is not primary and hedge_at is None and primary in pending.values():
+                            self.hedge_wins += 1
+                        return task.result()
+                    errors.append(task.exception())
+                    logger.warning("Backend %s falhou para %s: %s", backend.name, agent_name, task.exception())
+                if not pending:
+                    hedge_at = None
+                    if launch():
+                        self.failovers += 1
+        finally:
+            for task in pending:
+                # Lê a exceção das que já terminaram junto com a vencedora e das que falharem ao cancelar
+                task.add_done_callback(_discard_result)
+                task.cancel()
+        raise errors[-1]
+
+    async def stream(self, agent_name: str, messages: list, json_mode: bool = False):
+        """
+        Trechos de texto do melhor backend disponível para o agente. Se um
+        backend falhar antes do primeiro trecho, o próximo da rota é chamado;
+        depois dele, a falha chega a quem consome o stream.
+        """
+        errors = []
+        for backend in self.ranked(agent_name):
+            if not backend.breaker.allow():
+                continue
+            if errors:
+                self.failovers += 1
+            deltas = backend.stream(messages, json_mode)
+            try:
+                try:
+                    first = await deltas.__anext__()
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    errors.append(e)
+                    logger.warning("Backend %s falhou para %s: %s", backend.name, agent_name, e)
+                    continue
+                yield first
+                async for delta in deltas:
+                    yield delta
+                return
+            finally:
+                await deltas.aclose()
+        if errors:
+            raise errors[-1]
+        raise NoBackendAvailable(f"Nenhum provedor disponível para {agent_name}")
+
+    def stats(self) -> dict:
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "backends": {
+                name: {
+                    "circuit": backend.breaker.state,
+                    "p50": backend.stats.percentile(0.5),
+                    "p95": backend.stats.percentile(0.95),
+                    "error_rate": round(backend.stats.error_rate(), 4),
+                    "samples": len(backend.stats.outcomes),
+                }
+                for name, backend in self.backends.items()
+            },
+        }
@@ -0,0 +1,393 @@
+# backend/semantic_cache.py
+
+"""
+Cache semântico dos agentes de texto livre (copy e hashtags).
+
+O cache exato de `response_cache.py` só acerta quando o prompt normalizado é
+idêntico: "dicas de marketing digital" e "marketing digital dicas" viravam
+duas chamadas pagas. Aqui o texto livre do pedido vira um vetor e uma
+resposta guardada é reaproveitada quando a similaridade de cosseno passa o
+limiar do agente.
+
+- vetorização local, sem modelo nem rede: TF-IDF sobre n-gramas com hashing
+  (palavras inteiras e trigramas de caracteres de cada palavra, sem acentos),
+  num vetor de `SEMANTIC_CACHE_DIM` posições. O IDF vem das entradas presentes
+  em cada agente e fica congelado entre recálculos: as frequências brutas
+  ficam guardadas, e a cada mudança em 10% das entradas o IDF é recalculado e
+  todos os vetores são refeitos com ele;
+- o resto do pedido (tom, nicho, perfil) não é comparado por similaridade: faz
+  parte da partição, junto com os números e as negações do texto ("5 dicas"
+  nunca reaproveita "10 dicas", nem "receitas não veganas" reaproveita
+  "receitas veganas"). Só entradas da mesma partição competem;
+- a similaridade só escolhe as candidatas: uma resposta é reaproveitada se,
+  além de passar o limiar, os dois textos tiverem as mesmas palavras de
+  conteúdo (sem contar ordem, acentos, plural e palavras de ligação). Num
+  prompt longo em que só uma palavra muda ("padaria" e "pizzaria", "Maria" e
+  "Joana") a similaridade passa do limiar, mas a resposta não serviria;
+- índice em memória por agente: matriz NumPy pré-alocada com no máximo
+  `SEMANTIC_CACHE_SIZE` linhas. A busca é um único produto matriz-vetor sobre
+  todas as entradas; quando o índice enche, sai a entrada expirada ou a usada
+  há mais tempo;
+- snapshot em disco (`SEMANTIC_CACHE_PATH`, `.npz`) a cada
+  `SEMANTIC_CACHE_SNAPSHOT_INTERVAL` segundos e no desligamento, carregado na
+  subida. Com vários workers, cada um grava o arquivo inteiro e o último vence.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import unicodedata
+import zlib
+
+import numpy as np
+
+from response_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 3
+
+_WORD_RE = re.compile(r"\w+")
+_NUMBER_RE = re.compile(r"\d+")
+_NEGATION_RE = re.compile(r"\b(?:nao|nem|sem|nunca|jamais|nenhum|nenhuma)\b")
+# Palavras de ligação, ignoradas na conferência das palavras de conteúdo
+_FUNCTION_WORDS = frozenset(
+    "a o as os e ou de da do das dos em no na nos nas num numa um uma uns umas ao aos para pra por pelo pela "
+    "com sobre que se".split()
+)
+# Candidatas acima do limiar conferidas palavra a palavra em cada consulta
+MAX_CANDIDATES = 5
+
+
+def _strip_accents(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def _plain(text: str) -> str:
+    return _strip_accents(normalize_text(text))
+
+
+def _partition(context: str, text: str) -> int:
+    plain = _plain(text)
+    numbers = " ".join(sorted(_NUMBER_RE.findall(plain)))
+    negations = " ".join(sorted(_NEGATION_RE.findall(plain)))
+    digest = hashlib.blake2b(f"{context}|{numbers}|{negations}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def _terms(text: str) -> frozenset:
+    """Palavras de conteúdo, sem acentos e no singular (só o "s" final)."""
+    words = (word for word in _WORD_RE.findall(_plain(text)) if word not in _FUNCTION_WORDS and not word.isdigit())
+    return frozenset(word[:-1] if len(word) > 3 and word.endswith("s") else word for word in words)
+
+
+# --- Vetorização ---
+class HashedTfidf:
+    """
+    TF-IDF com feature hashing: não guarda vocabulário, só a frequência por
+    posição. O IDF aplicado (`idf`) fica congelado entre chamadas a `refresh`,
+    então consultas e entradas guardadas são sempre pesadas do mesmo jeito.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.df = np.zeros(dim, dtype=np.float32)
+        self.documents = 0
+        self.idf = np.ones(dim, dtype=np.float32)
+
+    def _hashes(self, text: str) -> np.ndarray:
+        grams = []
+        for word in _WORD_RE.findall(_strip_accents(normalize_text(text))):
+            grams.append("w:" + word)
+            padded = f" {word} "
+            grams.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint32, count=len(grams))
+
+    def tf(self, text: str) -> np.ndarray:
+        """Frequências (sublineares, com sinal) por posição, sem IDF."""
+        hashes = self._hashes(text)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if not hashes.size:
+            return vector
+        # O bit mais alto decide o sinal: colisões tendem a se cancelar em vez de somar
+        signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, (hashes % self.dim).astype(np.intp), signs)
+        used = vector != 0
+        vector[used] = np.sign(vector[used]) * (1 + np.log(np.abs(vector[used])))
+        return vector
+
+    def weigh(self, tf: np.ndarray) -> np.ndarray:
+        """Vetores (uma linha ou uma matriz) com o IDF congelado, normalizados por linha."""
+        weighted = tf * self.idf
+        norms = np.linalg.norm(weighted, axis=-1, keepdims=True)
+        return np.divide(weighted, norms, out=np.zeros_like(weighted), where=norms > 0)
+
+    def fit(self, tf: np.ndarray):
+        self.df[tf != 0] += 1
+        self.documents += 1
+
+    def unfit(self, tf: np.ndarray):
+        self.df[tf != 0] -= 1
+        self.documents -= 1
+
+    def refresh(self):
+        self.idf = (np.log((1 + self.documents) / (1 + self.df)) + 1).astype(np.float32)
+
+
+# --- Índice por agente ---
+# O IDF é recalculado (e os vetores refeitos) depois de mudanças em 10% das entradas
+IDF_REFRESH_FRACTION = 0.1
+IDF_REFRESH_MIN_CHANGES = 32
+
+
+class _AgentIndex:
+    def __init__(self, dim: int, capacity: int):
+        self.capacity = capacity
+        self.vectorizer = HashedTfidf(dim)
+        self.tf = np.zeros((capacity, dim), dtype=np.float32)       # frequências de cada entrada
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)  # as mesmas, com o IDF congelado
+        self.partitions = np.zeros(capacity, dtype=np.int64)
+        self.expires_at = np.zeros(capacity, dtype=np.float64)  # 0: linha livre
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.values = [None] * capacity
+        self.terms = [None] * capacity
+        self.size = 0  # linhas já usadas alguma vez (as seguintes estão livres)
+        self.changes = 0  # entradas incluídas ou removidas desde o último refresh do IDF
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def search(self, vector: np.ndarray, partition: int, now: float, threshold: float) -> list:
+        """Linhas válidas da partição com similaridade >= `threshold`, da mais parecida para a menos (até MAX_CANDIDATES)."""
+        if not self.size:
+            return []
+        scores = self.vectors[:self.size] @ vector
+        valid = (self.partitions[:self.size] == partition) & (self.expires_at[:self.size] > now)
+        scores = np.where(valid, scores, -1.0)
+        if self.size > MAX_CANDIDATES:
+            top = np.argpartition(scores, -MAX_CANDIDATES)[-MAX_CANDIDATES:]
+        else:
+            top = np.arange(self.size)
+        top = top[np.argsort(-scores[top])]
+        return [int(row) for row in top if scores[row] >= threshold]
+
+    def _free_row(self, now: float) -> int:
+        if self.size < self.capacity:
+            self.size += 1
+            return self.size - 1
+        # Expiradas primeiro; depois a usada há mais tempo
+        row = int(np.where(self.expires_at <= now, -np.inf, self.last_used).argmin())
+        if self.expires_at[row] > now:
+            self.evictions += 1
+        return row
+
+    def _remove(self, row: int):
+        # O df só conta as entradas presentes: sai junto com a entrada
+        self.vectorizer.unfit(self.tf[row])
+        self.tf[row] = 0
+        self.vectors[row] = 0
+        self.expires_at[row] = 0
+        self.values[row] = None
+        self.terms[row] = None
+        self.changes += 1
+
+    def insert(self, tf: np.ndarray, terms: frozenset, partition: int, value, expires_at: float, now: float):
+        row = self._free_row(now)
+        if self.expires_at[row] > 0:
+            self._remove(row)
+        self.vectorizer.fit(tf)
+        self.tf[row] = tf
+        self.vectors[row] = self.vectorizer.weigh(tf)
+        self.partitions[row] = partition
+        self.expires_at[row] = expires_at
+        self.last_used[row] = now
+        self.values[row] = value
+        self.terms[row] = terms
+        self.changes += 1
+
+    def refresh(self, now: float):
+        """Tira as entradas expiradas, recalcula o IDF e refaz os vetores guardados com ele."""
+        for row in np.flatnonzero((self.expires_at[:self.size] > 0) & (self.expires_at[:self.size] <= now)):
+            self._remove(int(row))
+        self.vectorizer.refresh()
+        self.vectors[:self.size] = self.vectorizer.weigh(self.tf[:self.size])
+        self.changes = 0
+
+    def maybe_refresh(self, now: float):
+        if self.changes >= max(IDF_REFRESH_MIN_CHANGES, self.vectorizer.documents * IDF_REFRESH_FRACTION):
+            self.refresh(now)
+
+    def live_rows(self, now: float) -> np.ndarray:
+        return np.flatnonzero(self.expires_at[:self.size] > now)
+
+
+class SemanticCache:
+    def __init__(self, thresholds: dict, ttls: dict, dim: int = None, maxsize: int = None, path: str = None,
+                 snapshot_interval: float = None):
+        self.thresholds = thresholds
+        self.ttls = ttls
+        self.dim = dim or int(os.getenv("SEMANTIC_CACHE_DIM", 1024))
+        self.maxsize = maxsize or int(os.getenv("SEMANTIC_CACHE_SIZE", 2000))
+        self.path = os.getenv("SEMANTIC_CACHE_PATH", "./semantic_cache.npz") if path is None else path
+        self.snapshot_interval = snapshot_interval or float(os.getenv("SEMANTIC_CACHE_SNAPSHOT_INTERVAL", 300))
+        self._indexes = {}
+        self._dirty = False
+        self._task = None
+        self.snapshots = 0
+        self.loaded = 0
+
+    def enabled_for(self, agent_name: str) -> bool:
+        return self.thresholds.get(agent_name, 0) > 0 and self.ttls.get(agent_name, 0) > 0
+
+    def _index(self, agent_name: str) -> _AgentIndex:
+        index = self._indexes.get(agent_name)
+        if index is None:
+            index = self._indexes[agent_name] = _AgentIndex(self.dim, self.maxsize)
+        return index
+
+    # --- API pública ---
+    def get(self, agent_name: str, context: str, text: str):
+        """Resposta guardada para um texto parecido (e com as mesmas palavras de conteúdo) na mesma partição, ou None."""
+        if not self.enabled_for(agent_name):
+            return None
+        index = self._index(agent_name)
+        vector = index.vectorizer.weigh(index.vectorizer.tf(text))
+        now = time.time()
+        terms = _terms(text)
+        for row in index.search(vector, _partition(context, text), now, self.thresholds[agent_name]):
+            if index.terms[row] == terms:
+                index.hits += 1
+                index.last_used[row] = now
+                return index.values[row]
+        index.misses += 1
+        return None
+
+    def set(self, agent_name: str, context: str, text: str, value):
+        if not self.enabled_for(agent_name):
+            return
+        index = self._index(agent_name)
+        tf = index.vectorizer.tf(text)
+        if not tf.any():
+            return
+        now = time.time()
+        index.insert(tf, _terms(text), _partition(context, text), value, now + self.ttls[agent_name], now)
+        index.maybe_refresh(now)
+        self._dirty = True
+
+    def stats(self) -> dict:
+        now = time.time()
+        agents = {
+            agent_name: {
+                "size": int(index.live_rows(now).size),
+                "maxsize": index.capacity,
+                "hits": index.hits,
+                "misses": index.misses,
+                "evictions": index.evictions,
+                "threshold": self.thresholds.get(agent_name),
+            }
+            for agent_name, index in self._indexes.items()
+        }
+        hits = sum(agent["hits"] for agent in agents.values())
+        misses = sum(agent["misses"] for agent in agents.values())
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "memory_bytes": sum(index.tf.nbytes + index.vectors.nbytes for index in self._indexes.values()),
+            "snapshots": self.snapshots,
+            "loaded": self.loaded,
+            "agents": agents,
+        }
+
+    # --- Snapshot em disco ---
+    def _snapshot_arrays(self) -> dict:
+        """Cópia das entradas válidas, feita no loop para o arquivo ser gravado numa thread."""
+        now = time.time()
+        arrays = {"version": np.array(SNAPSHOT_VERSION), "dim": np.array(self.dim)}
+        for agent_name, index in self._indexes.items():
+            rows = index.live_rows(now)
+            arrays[f"{agent_name}:tf"] = index.tf[rows]
+            arrays[f"{agent_name}:partitions"] = index.partitions[rows]
+            arrays[f"{agent_name}:expires_at"] = index.expires_at[rows]
+            arrays[f"{agent_name}:last_used"] = index.last_used[rows]
+            arrays[f"{agent_name}:values"] = np.array(json.dumps([index.values[row] for row in rows], ensure_ascii=False))
+            arrays[f"{agent_name}:terms"] = np.array(json.dumps([sorted(index.terms[row]) for row in rows]))
+        return arrays
+
+    def _write(self, arrays: dict):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temporary, self.path)
+
+    def _read(self) -> dict:
+        with np.load(self.path, allow_pickle=False) as data:
+            return {key: data[key] for key in data.files}
+
+    def _restore(self, arrays: dict):
+        if int(arrays.pop("version", 1)) != SNAPSHOT_VERSION:
+            logger.warning("Snapshot do cache semântico ignorado: formato antigo")
+            return
+        if int(arrays.pop("dim")) != self.dim:
+            logger.warning("Snapshot do cache semântico ignorado: SEMANTIC_CACHE_DIM mudou")
+            return
+        now = time.time()
+        for agent_name in {key.split(":", 1)[0] for key in arrays}:
+            if not self.enabled_for(agent_name):
+                continue
+            index = self._index(agent_name)
+            values = json.loads(str(arrays[f"{agent_name}:values"]))
+            terms = json.loads(str(arrays[f"{agent_name}:terms"]))
+            expires_at = arrays[f"{agent_name}:expires_at"]
+            last_used = arrays[f"{agent_name}:last_used"]
+            # Se o índice diminuiu, ficam as usadas mais recentemente
+            rows = [row for row in np.argsort(-last_used) if expires_at[row] > now][:index.capacity]
+            for row in rows:
+                index.insert(arrays[f"{agent_name}:tf"][row], frozenset(terms[row]), int(arrays[f"{agent_name}:partitions"][row]),
+                             values[row], float(expires_at[row]), float(last_used[row]))
+            # O df é refeito pelas entradas restauradas; o IDF e os vetores, de uma vez no fim
+            index.refresh(now)
+            self.loaded += len(rows)
+
+    async def snapshot(self):
+        if not self.path or not self._dirty:
+            return
+        arrays = self._snapshot_arrays()
+        self._dirty = False
+        await asyncio.to_thread(self._write, arrays)
+        self.snapshots += 1
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except Exception:
+                logger.exception("Falha ao gravar o snapshot do cache semântico")
+
+    async def start(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                self._restore(await asyncio.to_thread(self._read))
+            except Exception:
+                logger.exception("Falha ao carregar o snapshot do cache semântico")
+        if self.path:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.snapshot()
+        except Exception:
+            logger.exception("Falha ao gravar o snapshot do cache semântico")
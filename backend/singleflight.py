@@ -0,0 +1,63 @@
+# backend/singleflight.py
+
+"""
+Coalescência de chamadas idênticas em voo ("single-flight").
+
+Quando várias requisições com a mesma impressão digital de prompt chegam ao
+mesmo tempo, só a primeira chama o provedor; as demais aguardam o mesmo
+resultado (ou a mesma exceção).
+"""
+
+import asyncio
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    def _forget(self, key, task):
+        call = self._calls.get(key)
+        if call is not None and call.task is task:
+            del self._calls[key]
+
+    async def do(self, key: str, fn):
+        """
+        Executa `fn()` uma única vez por chave entre chamadores concorrentes.
+
+        Se um chamador for cancelado (cliente desconectou), os outros continuam
+        esperando; a chamada ao provedor só é cancelada quando não resta nenhum
+        chamador interessado.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(fn())
+            call = self._calls[key] = _Call(task)
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(key, call.task)
+                call.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,88 @@
+# backend/startup.py
+
+"""
+Relatório de inicialização por fase e prontidão do worker.
+
+O lifespan executa as fases obrigatórias (schema do banco, workers em
+segundo plano) dentro de `phase()`; o que pode terminar depois que a porta já
+está aberta (importar e aquecer os SDKs dos provedores) roda em
+`background()`. O worker só fica "pronto" (`/health/ready`) quando as duas
+partes terminam, com sucesso ou não: um aquecimento que falhou não impede o
+tráfego, só fica registrado no relatório.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class StartupReport:
+    def __init__(self):
+        self.phases = {}  # nome -> {"ms", "ok", "background", "error"}
+        self.started = False
+        self._tasks = {}
+
+    def record(self, name: str, seconds: float, ok: bool = True, background: bool = False, error: str = None):
+        entry = {"ms": round(seconds * 1000, 1), "ok": ok, "background": background}
+        if error:
+            entry["error"] = error
+        self.phases[name] = entry
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.record(name, time.perf_counter() - started, ok=False, error=type(e).__name__)
+            raise
+        self.record(name, time.perf_counter() - started)
+
+    def background(self, name: str, coro) -> asyncio.Task:
+        """Roda `coro` sem bloquear a subida; falhas são registradas, não propagadas."""
+        async def run():
+            started = time.perf_counter()
+            try:
+                await coro
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Falha na fase de inicialização %s", name)
+                self.record(name, time.perf_counter() - started, ok=False, background=True, error=type(e).__name__)
+            else:
+                self.record(name, time.perf_counter() - started, background=True)
+            if self.ready:
+                logger.info("Worker pronto: %s", self.summary())
+
+        task = self._tasks[name] = asyncio.create_task(run())
+        return task
+
+    def mark_started(self):
+        """Fim das fases obrigatórias do lifespan (o servidor vai abrir a porta)."""
+        self.started = True
+        logger.info("Inicialização: %s", self.summary())
+
+    @property
+    def ready(self) -> bool:
+        return self.started and all(task.done() for task in self._tasks.values())
+
+    async def wait_ready(self):
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def cancel_background(self):
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def summary(self) -> str:
+        return ", ".join(f"{name}={entry['ms']:.0f}ms{'' if entry['ok'] else ' (falhou)'}" for name, entry in self.phases.items())
+
+    def as_dict(self) -> dict:
+        return {
+            "ready": self.ready,
+            "pending": sorted(name for name, task in self._tasks.items() if not task.done()),
+            "phases": self.phases,
+        }
@@ -0,0 +1,70 @@
+# backend/streaming.py
+
+"""
+Utilitários para as respostas em streaming (NDJSON) dos agentes.
+
+Cada linha enviada ao cliente é um objeto JSON com um campo `type`:
+
+- `delta`: trecho de texto recém-gerado (`text`);
+- `item`: um item completo da lista da resposta (`index`, `text`), quando o
+  endpoint passa um `parser` (ex.: `structured.JsonArrayParser`);
+- `done`: fim do stream, com o texto completo (`text`);
+- `error`: falha depois que o stream já começou (`detail`).
+"""
+
+import json
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def ndjson_line(payload: dict) -> bytes:
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+async def prefetch(deltas):
+    """
+    Aguarda o primeiro trecho do provedor e devolve um gerador equivalente.
+
+    Assim, falhas antes do primeiro token ainda podem virar um erro HTTP
+    normal, em vez de uma linha `error` num stream com status 200.
+    """
+    try:
+        first = await deltas.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def chained():
+        if first is None:
+            return
+        yield first
+        async for delta in deltas:
+            yield delta
+
+    return chained()
+
+
+async def stream_agent(deltas, reservation, error_prefix: str, parser=None):
+    """
+    Converte os trechos do provedor em linhas NDJSON.
+
+    O uso só é confirmado na cota quando o primeiro trecho chega; se o
+    provedor falhar antes disso, a reserva é devolvida.
+    """
+    started = False
+    text = []
+    try:
+        async for delta in deltas:
+            if not started:
+                reservation.commit()
+                started = True
+            text.append(delta)
+            yield ndjson_line({"type": "delta", "text": delta})
+            if parser:
+                for index, item in parser.feed(delta):
+                    yield ndjson_line({"type": "item", "index": index, "text": item})
+        yield ndjson_line({"type": "done", "text": "".join(text)})
+    except Exception as e:
+        yield ndjson_line({"type": "error", "detail": f"{error_prefix}: {str(e)}"})
+    finally:
+        if not started:
+            await reservation.release()
@@ -0,0 +1,227 @@
+# backend/structured.py
+
+"""
+Saída estruturada dos agentes: o modelo responde em JSON e a resposta é
+validada num modelo Pydantic, no lugar das regexes de cada endpoint.
+
+- `ResponseSchema` junta o modelo de saída às instruções de formato que vão
+  no prompt (com um exemplo do JSON esperado). Com a OpenAI o pedido também
+  usa o modo JSON da API (`json_mode`);
+- `parse` tenta primeiro o caminho rápido (o texto inteiro é o JSON,
+  validado direto pelo pydantic-core) e só então procura o objeto dentro de
+  cercas de código ou texto em volta;
+- `complete_structured` faz no máximo `STRUCTURED_MAX_REPAIRS` novas chamadas
+  (padrão 1), e só quando a validação falha, mostrando ao modelo o erro e a
+  resposta anterior;
+- `JsonArrayParser` extrai os itens de uma lista do JSON à medida que o
+  stream chega, para os endpoints em streaming.
+"""
+
+import json
+import os
+import re
+
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+import metrics
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+# Como o `#\w+` de antes: "#marketing-digital" vira "#marketing"; sem "#", vale a palavra inicial
+_HASHTAG_RE = re.compile(r"(?:^|#)(\w+)")
+_NUMBERING_RE = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s*")
+
+STRUCTURED_OUTCOMES = metrics.Counter(
+    "monsterapp_structured_output_total", "Respostas estruturadas por resultado da validação.", ("agent", "outcome")
+)
+
+
+class StructuredOutputError(Exception):
+    """A resposta do modelo não pôde ser validada no formato pedido."""
+
+
+def _clean_items(items: list) -> list:
+    # Modelos às vezes numeram os itens mesmo dentro do JSON
+    cleaned = (_NUMBERING_RE.sub("", item).strip() for item in items)
+    return [item for item in cleaned if item]
+
+
+def _require_items(items: list) -> list:
+    # `min_length` é checado antes da limpeza: uma lista só de "-" ou "###" ainda precisa falhar
+    if not items:
+        raise ValueError("nenhum item válido na lista")
+    return items
+
+
+# --- Modelos de saída ---
+class TopicsOutput(BaseModel):
+    topics: list[str] = Field(min_length=1)
+
+    @field_validator("topics")
+    @classmethod
+    def _clean(cls, value: list) -> list:
+        return _require_items(_clean_items(value))
+
+
+class CopyVariationsOutput(BaseModel):
+    variations: list[str] = Field(min_length=1)
+
+    @field_validator("variations")
+    @classmethod
+    def _clean(cls, value: list) -> list:
+        return _require_items(_clean_items(value))
+
+
+class HashtagsOutput(BaseModel):
+    hashtags: list[str] = Field(min_length=1)
+
+    @field_validator("hashtags")
+    @classmethod
+    def _normalize(cls, value: list) -> list:
+        # "#tag", "tag" ou "#tag #outra" viram "#tag"; repetidas saem
+        tags = (f"#{match}" for item in value for match in _HASHTAG_RE.findall(item.strip()))
+        return _require_items(list(dict.fromkeys(tags)))
+
+
+class CompetitorAnalysisOutput(BaseModel):
+    niche_identified: str
+    content_style_analysis: str
+    insights: list[str]
+
+    @field_validator("insights")
+    @classmethod
+    def _clean(cls, value: list) -> list:
+        return _clean_items(value)
+
+
+# --- Esquema e parsing ---
+class ResponseSchema:
+    def __init__(self, model: type, example: dict):
+        self.model = model
+        self.example = json.dumps(example, ensure_ascii=False)
+        self.instructions = (
+            "Responda apenas com um objeto JSON válido, sem texto antes ou depois, "
+            f"exatamente neste formato: {self.example}"
+        )
+
+    def with_instructions(self, messages: list) -> list:
+        """Cópia das mensagens com as instruções de formato no fim da última mensagem do usuário."""
+        messages = [dict(message) for message in messages]
+        messages[-1]["content"] = f"{messages[-1]['content']}\n\n{self.instructions}"
+        return messages
+
+    def parse(self, text: str) -> tuple:
+        """(modelo validado, "json" ou "extracted"); levanta StructuredOutputError."""
+        try:
+            return self.model.model_validate_json(text), "json"
+        except ValidationError as e:
+            error = e
+        candidate = _extract_object(text)
+        if candidate is not None and candidate != text:
+            try:
+                return self.model.model_validate_json(candidate), "extracted"
+            except ValidationError as e:
+                error = e
+        raise StructuredOutputError(_describe(error))
+
+
+# --- Esquemas dos agentes ---
+TOPICS = ResponseSchema(TopicsOutput, {"topics": ["tópico 1", "tópico 2", "tópico 3", "tópico 4", "tópico 5"]})
+COPY_VARIATIONS = ResponseSchema(CopyVariationsOutput, {"variations": ["variação 1", "variação 2", "variação 3"]})
+HASHTAGS = ResponseSchema(HashtagsOutput, {"hashtags": ["#marketing", "#socialmedia", "#dicas"]})
+COMPETITOR_ANALYSIS = ResponseSchema(CompetitorAnalysisOutput, {
+    "niche_identified": "nicho do perfil",
+    "content_style_analysis": "estilo de conteúdo",
+    "insights": ["insight 1", "insight 2", "insight 3"],
+})
+
+
+def _extract_object(text: str):
+    fenced = _FENCE_RE.search(text)
+    if fenced:
+        return fenced.group(1)
+    start, end = text.find("{"), text.rfind("}")
+    return text[start:end + 1] if 0 <= start < end else None
+
+
+def _describe(error: ValidationError) -> str:
+    first = error.errors()[0]
+    location = ".".join(str(part) for part in first["loc"])
+    return f"{location}: {first['msg']}" if location else first["msg"]
+
+
+MAX_REPAIRS = int(os.getenv("STRUCTURED_MAX_REPAIRS", 1))
+
+
+async def complete_structured(router, agent_name: str, messages: list, schema: ResponseSchema,
+                              max_repairs: int = None):
+    """Chama o agente pedindo JSON e devolve o modelo validado, com reparo limitado se a validação falhar."""
+    max_repairs = MAX_REPAIRS if max_repairs is None else max_repairs
+    messages = schema.with_instructions(messages)
+    text = await router.complete(agent_name, messages, json_mode=True)
+    for attempt in range(max_repairs + 1):
+        try:
+            with metrics.stage("parse"):
+                result, outcome = schema.parse(text)
+        except StructuredOutputError as e:
+            if attempt == max_repairs:
+                STRUCTURED_OUTCOMES.labels(agent_name, "failed").inc()
+                raise
+            STRUCTURED_OUTCOMES.labels(agent_name, "repair").inc()
+            text = await router.complete(agent_name, messages + [
+                {"role": "assistant", "content": text[:4000]},
+                {"role": "user", "content": f"A resposta anterior não seguiu o formato ({e}). {schema.instructions}"},
+            ], json_mode=True)
+            continue
+        STRUCTURED_OUTCOMES.labels(agent_name, "repaired" if attempt else outcome).inc()
+        return result
+
+
+# --- Streaming ---
+class JsonArrayParser:
+    """
+    Extrai os itens (strings) do campo lista `field` de um objeto JSON à
+    medida que o texto chega: cada item é emitido assim que sua string fecha.
+    """
+
+    def __init__(self, field: str):
+        self._start = re.compile(r'"%s"\s*:\s*\[' % re.escape(field))
+        self._buffer = ""
+        self._pos = 0
+        self._state = "before"  # before -> array -> after
+        self._item_start = None
+        self._escape = False
+        self.items = []
+
+    def feed(self, chunk: str) -> list:
+        self._buffer += chunk
+        if self._state == "before":
+            match = self._start.search(self._buffer)
+            if not match:
+                return []
+            self._state, self._pos = "array", match.end()
+        if self._state != "array":
+            return []
+
+        found = []
+        buffer, i = self._buffer, self._pos
+        while i < len(buffer):
+            char = buffer[i]
+            if self._item_start is not None:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    text = _clean_items([json.loads(f'"{buffer[self._item_start:i]}"', strict=False)])
+                    self._item_start = None
+                    if text:
+                        self.items.append(text[0])
+                        found.append((len(self.items) - 1, text[0]))
+            elif char == '"':
+                self._item_start = i + 1
+            elif char == "]":
+                self._state = "after"
+                break
+            i += 1
+        self._pos = i
+        return found
@@ -0,0 +1,40 @@
+# backend/tests/conftest.py
+
+"""
+Configuração comum dos testes. Os módulos do backend são importados como no
+servidor (`import main`), e o ambiente é preparado antes disso: banco
+temporário, caches em disco desligados e nenhum provedor real contatado.
+
+Os testes são síncronos e rodam cada cenário com `asyncio.run`; engines e
+sessões são criados dentro do cenário, no mesmo event loop em que são usados.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_WORKDIR = tempfile.mkdtemp(prefix="monsterapp-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_WORKDIR}/app.db")
+os.environ.setdefault("RESPONSE_CACHE_PATH", "")
+os.environ.setdefault("SEMANTIC_CACHE_PATH", "")
+os.environ.setdefault("MEDIA_DIR", os.path.join(_WORKDIR, "media"))
+os.environ.setdefault("PROVIDER_WARMUP", "0")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+import database  # noqa: E402
+import main  # noqa: E402
+
+
+@pytest.fixture
+def open_database(tmp_path):
+    """Coroutine que cria um banco SQLite novo com o schema do app: (engine, session_factory)."""
+    async def open_():
+        engine = database.create_engine_from_env(f"sqlite:///{tmp_path}/test.db")
+        await database.init_models(engine, main.Base.metadata)
+        return engine, database.create_session_factory(engine)
+    return open_
@@ -0,0 +1,60 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from analytics import UsageAnalytics
+
+
+class FakeRollup:
+    """Agregados vazios; a marca d'água avança `advance_per_read` a cada leitura."""
+
+    def __init__(self, advance_per_read=0, hourly=None):
+        self.current = 10
+        self.advance_per_read = advance_per_read
+        self.hourly = hourly or {}
+        self.reads = 0
+
+    async def read(self, since, until=None, **kwargs):
+        self.reads += 1
+        watermark = self.current
+        self.current += self.advance_per_read
+        # As horas de `hourly` são de hoje: só entram na leitura da parte aberta
+        hourly = self.hourly if until is None else {}
+        return {"hourly": hourly, "daily": {}, "latency": {}, "watermark": watermark}
+
+    async def watermark(self):
+        return self.current
+
+
+def test_closed_days_are_cached_when_no_compaction_ran_during_the_read():
+    analytics = UsageAnalytics(FakeRollup(), ttl=0.001)
+    asyncio.run(analytics.report(days=7))
+    time.sleep(0.01)
+    asyncio.run(analytics.report(days=7))
+    assert analytics.history_builds == 1
+    assert analytics.history_skipped == 0
+
+
+def test_closed_days_are_not_cached_when_a_compaction_overlapped_the_read():
+    rollup = FakeRollup(advance_per_read=5)
+    analytics = UsageAnalytics(rollup, ttl=0.001)
+    asyncio.run(analytics.report(days=7))
+    time.sleep(0.01)
+    asyncio.run(analytics.report(days=7))
+    assert analytics.history_builds == 2
+    assert analytics.history_skipped == 2
+
+
+def test_heatmap_shifts_half_hour_offsets_and_caches_each_offset_apart():
+    hour = datetime.combine(datetime.utcnow().date(), datetime.min.time()) + timedelta(hours=10)
+    analytics = UsageAnalytics(FakeRollup(hourly={(1, "agente", hour): (4, 0)}))
+
+    def peak(tz_offset_minutes):
+        report = asyncio.run(analytics.report(days=7, tz_offset_minutes=tz_offset_minutes))
+        assert report["tz_offset_minutes"] == tz_offset_minutes
+        return report["peak_hours"][0]["hour"]
+
+    # 10:00 UTC: 15:30 em +5:30, 16:00 em +6:00 e 06:30 em -3:30
+    assert peak(330) == 15
+    assert peak(360) == 16
+    assert peak(-210) == 6
@@ -0,0 +1,33 @@
+# backend/tests/test_database.py
+
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+import database
+import main
+
+
+def test_added_boolean_column_uses_the_postgres_literal():
+    table = main.ApiUsage.__table__
+    ddl = database._add_column_ddl(table, table.c.cache_hit, postgresql.dialect())
+    assert ddl == "ALTER TABLE api_usage ADD COLUMN cache_hit BOOLEAN DEFAULT false"
+
+
+def test_old_api_usage_table_gets_the_new_columns(tmp_path):
+    async def scenario():
+        engine = database.create_engine_from_env(f"sqlite:///{tmp_path}/old.db")
+        async with engine.begin() as conn:
+            await conn.execute(text(
+                "CREATE TABLE api_usage (id INTEGER PRIMARY KEY, user_id INTEGER,"
+                " agent_name VARCHAR, timestamp DATETIME)"
+            ))
+            await conn.execute(text("INSERT INTO api_usage (user_id, agent_name) VALUES (1, 'x')"))
+        await database.init_models(engine, main.Base.metadata)
+        async with engine.connect() as conn:
+            row = (await conn.execute(text("SELECT cache_hit, latency_ms FROM api_usage"))).one()
+        await engine.dispose()
+        return tuple(row)
+
+    assert asyncio.run(scenario()) == (0, None)
@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+import main
+from image_jobs import FAILED, QUEUED, RUNNING, SUCCEEDED, FairQueue, ImageJobManager
+from main import ApiUsage, ImageJob
+from quota import MemoryQuotaBackend, QuotaEngine, utc_day
+
+AGENT = "gerar-imagem"
+
+
+def make_jobs(session_factory, tmp_path, generate, **kwargs):
+    jobs = ImageJobManager(session_factory, ImageJob, generate, media_dir=str(tmp_path / "media"), workers=1,
+                           sweep_interval=3600, **kwargs)
+
+    async def download(url):
+        return url.encode()
+
+    jobs._download = download
+    return jobs
+
+
+async def set_job(session_factory, job_id, **values):
+    async with session_factory() as db:
+        await db.execute(update(ImageJob).where(ImageJob.id == job_id).values(**values))
+        await db.commit()
+
+
+def test_fair_queue_alternates_between_users():
+    async def scenario():
+        queue = FairQueue()
+        for item in ("a1", "a2", "a3"):
+            queue.put("a", item)
+        queue.put("b", "b1")
+        return [(await queue.get())[1] for _ in range(4)]
+
+    assert asyncio.run(scenario()) == ["a1", "b1", "a2", "a3"]
+
+
+def test_finished_image_is_stored_by_content_hash(open_database, tmp_path):
+    async def generate(prompt):
+        return "imagem"
+
+    async def scenario():
+        engine, session_factory = await open_database()
+        jobs = make_jobs(session_factory, tmp_path, generate)
+        await jobs.start()
+        job = await jobs.wait(await jobs.submit(1, "um gato"), 5)
+        await jobs.stop()
+        await engine.dispose()
+        return job, jobs.media
+
+    job, media = asyncio.run(scenario())
+    digest = hashlib.sha256(b"imagem").hexdigest()
+    assert job["status"] == SUCCEEDED and job["image_sha256"] == digest
+    with open(media.path_for(digest), "rb") as f:
+        assert f.read() == b"imagem"
+
+
+def test_provider_error_fails_the_job(open_database, tmp_path):
+    async def generate(prompt):
+        raise RuntimeError("provedor fora do ar")
+
+    async def scenario():
+        engine, session_factory = await open_database()
+        jobs = make_jobs(session_factory, tmp_path, generate)
+        await jobs.start()
+        job = await jobs.wait(await jobs.submit(1, "um gato"), 5)
+        await jobs.stop()
+        await engine.dispose()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job["status"] == FAILED
+    assert "fora do ar" in job["error"]
+
+
+def test_job_interrupted_by_a_stop_is_resumed_on_the_next_start(open_database, tmp_path):
+    async def scenario():
+        engine, session_factory = await open_database()
+        running = asyncio.Event()
+
+        async def hang(prompt):
+            running.set()
+            await asyncio.sleep(3600)
+
+        jobs = make_jobs(session_factory, tmp_path, hang)
+        await jobs.start()
+        job_id = await jobs.submit(1, "um gato")
+        await running.wait()
+        await jobs.stop()
+        interrupted = await jobs.get(job_id)
+
+        async def generate(prompt):
+            return "imagem"
+
+        jobs._generate = generate
+        await jobs.start()
+        job = await jobs.wait(job_id, 5)
+        await jobs.stop()
+        await engine.dispose()
+        return interrupted, job
+
+    interrupted, job = asyncio.run(scenario())
+    assert interrupted["status"] == QUEUED
+    assert job["status"] == SUCCEEDED
+
+
+@pytest.mark.parametrize("attempts, expected", [(1, SUCCEEDED), (2, FAILED)])
+def test_expired_lease_requeues_until_attempts_run_out(open_database, tmp_path, attempts, expected):
+    async def generate(prompt):
+        return "imagem"
+
+    async def scenario():
+        engine, session_factory = await open_database()
+        jobs = make_jobs(session_factory, tmp_path, generate, max_attempts=2)
+        job_id = await jobs.submit(1, "um gato")
+        # Worker que morreu com o job em andamento há uma hora
+        await set_job(session_factory, job_id, status=RUNNING, attempts=attempts,
+                started_at=datetime.utcnow() - timedelta(hours=1))
+        await jobs.start()
+        job = await jobs.wait(job_id, 5)
+        await jobs.stop()
+        await engine.dispose()
+        return job
+
+    assert asyncio.run(scenario())["status"] == expected
+
+
+async def start_scenario(open_database, tmp_path, generate, **kwargs):
+    engine, session_factory = await open_database()
+    quota = QuotaEngine(session_factory, ApiUsage, backend=MemoryQuotaBackend(), flush_interval=3600)
+    await quota.start()
+    jobs = make_jobs(session_factory, tmp_path, generate, **kwargs)
+    await jobs.start()
+    return engine, quota, jobs
+
+
+async def stop_scenario(engine, quota, jobs):
+    await jobs.stop()
+    await quota.stop()
+    await engine.dispose()
+
+
+def test_quota_is_committed_with_the_generation_latency_when_the_image_is_ready(open_database, tmp_path):
+    async def generate(prompt):
+        await asyncio.sleep(0.2)
+        return "imagem"
+
+    async def scenario():
+        engine, quota, jobs = await start_scenario(open_database, tmp_path, generate)
+        reservation = await quota.reserve(1, AGENT, limit=2)
+        job_id = await jobs.submit(1, "um gato", reservation)
+        pending = list(quota._pending)
+        job = await jobs.wait(job_id, 5)
+        committed = list(quota._pending)
+        count = await quota.backend.daily_count(1, AGENT, utc_day())
+        await stop_scenario(engine, quota, jobs)
+        return pending, job, committed, count
+
+    pending, job, committed, count = asyncio.run(scenario())
+    assert pending == []
+    assert job["status"] == SUCCEEDED
+    assert len(committed) == 1 and committed[0]["latency_ms"] >= 200
+    assert count == 1
+
+
+def test_quota_is_released_when_the_job_fails(open_database, tmp_path):
+    async def generate(prompt):
+        raise RuntimeError("provedor fora do ar")
+
+    async def scenario():
+        engine, quota, jobs = await start_scenario(open_database, tmp_path, generate)
+        reservation = await quota.reserve(1, AGENT, limit=2)
+        job = await jobs.wait(await jobs.submit(1, "um gato", reservation), 5)
+        count = await quota.backend.daily_count(1, AGENT, utc_day())
+        pending = list(quota._pending)
+        await stop_scenario(engine, quota, jobs)
+        return job, count, pending
+
+    job, count, pending = asyncio.run(scenario())
+    assert job["status"] == FAILED
+    assert count == 0
+    assert pending == []
+
+
+def test_quota_is_released_when_the_lease_expires_without_attempts_left(open_database, tmp_path):
+    async def generate(prompt):
+        return "imagem"
+
+    async def scenario():
+        engine, quota, jobs = await start_scenario(open_database, tmp_path, generate, max_attempts=1)
+        await jobs.stop()  # sem workers: o job fica como se um worker tivesse morrido com ele
+        reservation = await quota.reserve(1, AGENT, limit=2)
+        job_id = await jobs.submit(1, "um gato", reservation)
+        await set_job(jobs._session_factory, job_id, status=RUNNING, attempts=1,
+                      started_at=datetime.utcnow() - timedelta(hours=1))
+        await jobs.start()
+        await asyncio.sleep(0.1)  # o sweep inicial roda no start
+        job = await jobs.get(job_id)
+        count = await quota.backend.daily_count(1, AGENT, utc_day())
+        await stop_scenario(engine, quota, jobs)
+        return job, count
+
+    job, count = asyncio.run(scenario())
+    assert job["status"] == FAILED
+    assert count == 0
+
+
+def test_a_job_resumed_after_a_restart_is_charged_to_the_daily_quota(open_database, tmp_path, monkeypatch):
+    async def generate(prompt):
+        return "imagem"
+
+    async def scenario():
+        engine, quota, jobs = await start_scenario(open_database, tmp_path, generate,
+                                                   record_usage=main.record_image_usage)
+        await jobs.stop()
+        (await quota.reserve(1, AGENT, limit=2)).commit()  # uma imagem já gerada hoje
+        job_id = await jobs.submit(1, "um gato", await quota.reserve(1, AGENT, limit=2))
+        # Restart com o job ainda na fila: a reserva em memória se perde
+        await jobs.stop()
+        await quota.stop()
+        restarted = QuotaEngine(jobs._session_factory, ApiUsage, backend=MemoryQuotaBackend(), flush_interval=3600)
+        monkeypatch.setattr(main, "quota_engine", restarted)
+        await restarted.start()
+        await jobs.start()
+        job = await jobs.wait(job_id, 5)
+        count = await restarted.backend.daily_count(1, AGENT, utc_day())
+        blocked = await restarted.reserve(1, AGENT, limit=2)
+        recorded = list(restarted._pending)
+        await stop_scenario(engine, restarted, jobs)
+        return job, count, blocked, recorded
+
+    job, count, blocked, recorded = asyncio.run(scenario())
+    assert job["status"] == SUCCEEDED
+    assert count == 2
+    assert blocked is None
+    assert len(recorded) == 1 and recorded[0]["latency_ms"] is not None
@@ -0,0 +1,40 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "INTERNAL_API_TOKEN", "segredo")
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_internal_analytics_requires_the_internal_token(client):
+    assert client.get("/internal/analytics").status_code == 401
+    assert client.get("/internal/analytics", headers={"Authorization": "Bearer outro"}).status_code == 401
+    response = client.get("/internal/analytics", headers={"Authorization": "Bearer segredo"})
+    assert response.status_code == 200
+    assert "totals" in response.json()
+
+
+def test_cache_stats_requires_the_internal_token(client):
+    assert client.get("/internal/cache-stats").status_code == 401
+    assert client.get("/internal/cache-stats", headers={"Authorization": "Bearer segredo"}).status_code == 200
+
+
+@pytest.mark.parametrize("path", ["/metrics", "/internal/slow-requests"])
+def test_observability_endpoints_require_the_internal_token(client, path):
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={"Authorization": "Bearer segredo"}).status_code == 200
+
+
+def test_a_user_token_does_not_open_internal_endpoints(client):
+    token = main.create_access_token({"sub": "alguem@exemplo.com"})
+    assert client.get("/internal/analytics", headers={"Authorization": f"Bearer {token}"}).status_code == 401
+
+
+def test_internal_endpoints_are_hidden_without_a_configured_token(client, monkeypatch):
+    monkeypatch.setattr(main, "INTERNAL_API_TOKEN", "")
+    assert client.get("/internal/analytics", headers={"Authorization": "Bearer segredo"}).status_code == 404
@@ -0,0 +1,175 @@
+import asyncio
+import time
+from datetime import date
+
+import pytest
+from sqlalchemy import func, select
+
+import quota
+from main import ApiUsage
+from quota import MemoryQuotaBackend, QuotaEngine, SQLiteQuotaBackend
+
+AGENT = "pesquisar-hashtags"
+MONDAY, TUESDAY = date(2026, 3, 2), date(2026, 3, 3)
+
+
+def make_engine(session_factory, backend=None):
+    return QuotaEngine(session_factory, ApiUsage, backend=backend or MemoryQuotaBackend(), flush_interval=3600)
+
+
+def test_daily_limit_resets_at_midnight(open_database, monkeypatch):
+    today = [MONDAY]
+    monkeypatch.setattr(quota, "utc_day", lambda moment=None: today[0])
+
+    async def scenario():
+        engine, session_factory = await open_database()
+        quota_engine = make_engine(session_factory)
+        first = await quota_engine.reserve(1, AGENT, limit=2, amount=2)
+        blocked = await quota_engine.reserve(1, AGENT, limit=2)
+        today[0] = TUESDAY
+        after_midnight = await quota_engine.reserve(1, AGENT, limit=2, amount=2)
+        # Devolver a reserva de ontem não libera cota de hoje
+        await first.release()
+        still_blocked = await quota_engine.reserve(1, AGENT, limit=2)
+        await quota_engine.stop()
+        await engine.dispose()
+        return first, blocked, after_midnight, still_blocked, quota_engine.backend
+
+    first, blocked, after_midnight, still_blocked, backend = asyncio.run(scenario())
+    assert first is not None and blocked is None
+    assert after_midnight is not None
+    assert still_blocked is None
+    assert all(day == TUESDAY for _, _, day in backend._daily)
+
+
+def test_sqlite_counters_reset_at_midnight(tmp_path):
+    async def scenario():
+        backend = SQLiteQuotaBackend(str(tmp_path / "quota.db"))
+        allowed = [await backend.consume_daily(1, AGENT, MONDAY, 1) for _ in range(2)]
+        allowed.append(await backend.consume_daily(1, AGENT, TUESDAY, 1))
+        await backend.close()
+        return allowed
+
+    assert asyncio.run(scenario()) == [True, False, True]
+
+
+def test_sqlite_limit_is_shared_between_workers(tmp_path):
+    async def scenario():
+        workers = [SQLiteQuotaBackend(str(tmp_path / "quota.db")) for _ in range(2)]
+        allowed = [await workers[i % 2].consume_daily(1, AGENT, MONDAY, 3) for i in range(6)]
+        count = await workers[0].daily_count(1, AGENT, MONDAY)
+        for backend in workers:
+            await backend.close()
+        return allowed, count
+
+    allowed, count = asyncio.run(scenario())
+    assert allowed == [True, True, True, False, False, False]
+    assert count == 3
+
+
+@pytest.mark.parametrize("make_backend", [MemoryQuotaBackend, lambda: SQLiteQuotaBackend(":memory:")])
+def test_burst_limit_rejects_with_the_wait_until_the_window_frees(make_backend):
+    async def scenario():
+        backend = make_backend()
+        waits = [await backend.consume_burst(1, 2, 60) for _ in range(3)]
+        other_user = await backend.consume_burst(2, 2, 60)
+        await backend.close()
+        return waits, other_user
+
+    waits, other_user = asyncio.run(scenario())
+    assert waits[:2] == [0, 0]
+    assert 0 < waits[2] <= 60
+    assert other_user == 0
+
+
+def test_usage_survives_a_restart(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        before = make_engine(session_factory)
+        reservation = await before.reserve(1, AGENT, limit=2, amount=2)
+        reservation.commit(2)
+        await before.stop()  # grava os usos pendentes em api_usage
+
+        after = make_engine(session_factory)
+        blocked = await after.reserve(1, AGENT, limit=2)
+        other_user = await after.reserve(2, AGENT, limit=2)
+        await after.stop()
+        await engine.dispose()
+        return blocked, other_user
+
+    blocked, other_user = asyncio.run(scenario())
+    assert blocked is None
+    assert other_user is not None
+
+
+def test_released_reservations_do_not_count_after_a_restart(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        before = make_engine(session_factory)
+        reservation = await before.reserve(1, AGENT, limit=2, amount=2)
+        reservation.commit(1)
+        await reservation.release()
+        await before.stop()
+
+        after = make_engine(session_factory)
+        allowed = await after.reserve(1, AGENT, limit=2)
+        blocked = await after.reserve(1, AGENT, limit=2)
+        await after.stop()
+        await engine.dispose()
+        return allowed, blocked
+
+    allowed, blocked = asyncio.run(scenario())
+    assert allowed is not None
+    assert blocked is None
+
+
+def test_unlimited_usage_is_still_recorded(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        quota_engine = make_engine(session_factory)
+        await quota_engine.start()
+        reservation = await quota_engine.reserve(1, AGENT, amount=5)
+        reservation.commit(5)
+        await quota_engine.stop()
+        async with session_factory() as db:
+            recorded = await db.scalar(select(func.count(ApiUsage.id)))
+        await engine.dispose()
+        return reservation, recorded
+
+    reservation, recorded = asyncio.run(scenario())
+    assert reservation.limited is False
+    assert recorded == 5
+
+
+def test_burst_window_forgets_idle_users():
+    async def scenario():
+        backend = MemoryQuotaBackend()
+        for user_id in range(100):
+            assert await backend.consume_burst(user_id, 1, 0.01) == 0
+        blocked = await backend.consume_burst(0, 1, 0.01)
+        time.sleep(0.15)
+        allowed = await backend.consume_burst(100, 1, 0.01)
+        return blocked, allowed, set(backend._hits)
+
+    blocked, allowed, users = asyncio.run(scenario())
+    assert blocked > 0
+    assert allowed == 0
+    assert users == {100}
+
+
+@pytest.mark.parametrize("make_backend", [MemoryQuotaBackend, lambda: SQLiteQuotaBackend(":memory:")])
+def test_charge_counts_past_the_limit(open_database, make_backend):
+    async def scenario():
+        engine, session_factory = await open_database()
+        quota_engine = make_engine(session_factory, make_backend())
+        (await quota_engine.reserve(1, AGENT, limit=1)).commit()
+        (await quota_engine.charge(1, AGENT)).commit()
+        count = await quota_engine.backend.daily_count(1, AGENT, quota.utc_day())
+        blocked = await quota_engine.reserve(1, AGENT, limit=2)
+        await quota_engine.stop()
+        await engine.dispose()
+        return count, blocked
+
+    count, blocked = asyncio.run(scenario())
+    assert count == 2
+    assert blocked is None
@@ -0,0 +1,225 @@
+import asyncio
+import gc
+from types import SimpleNamespace
+
+import pytest
+
+import router
+from router import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, ProviderRouter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Relógio monotônico controlado pelo teste."""
+    now = [1000.0]
+    monkeypatch.setattr(router, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(threshold=3, cooldown=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()  # o sucesso zera a sequência
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow() and not breaker.available()
+
+
+def test_breaker_half_opens_after_cooldown_with_a_single_probe(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.record_failure()
+    clock[0] += 29
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.available()
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Só uma chamada de teste por vez
+    assert not breaker.allow() and not breaker.available()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.failures == 0
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_probe_reopens_for_a_full_cooldown(clock):
+    breaker = CircuitBreaker(threshold=5, cooldown=30)
+    for _ in range(5):
+        breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock[0] += 29
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.allow()
+
+
+def test_cancelled_probe_frees_the_probe_slot(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.record_cancel()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+def test_router_skips_an_open_backend_until_its_probe_succeeds(clock):
+    calls = []
+    healthy = {"gemini:gemini-pro": False}
+
+    def factory(spec):
+        async def call(messages, timeout, json_mode=False):
+            calls.append(spec)
+            if spec in healthy and not healthy[spec]:
+                raise RuntimeError(f"{spec} fora do ar")
+            return spec
+        return call, 10
+
+    provider_router = ProviderRouter(
+        {"agente": ["gemini:gemini-pro", "openai:gpt-4o-mini"]}, factory,
+        hedge_percentile=0, breaker_threshold=2, breaker_cooldown=30,
+    )
+
+    async def complete():
+        return await provider_router.complete("agente", [{"role": "user", "content": "oi"}])
+
+    async def scenario():
+        results = [await complete() for _ in range(3)]
+        calls_while_open = list(calls)
+        clock[0] += 30
+        healthy["gemini:gemini-pro"] = True
+        results.append(await complete())
+        return results, calls_while_open
+
+    results, calls_while_open = asyncio.run(scenario())
+    assert results == ["openai:gpt-4o-mini"] * 3 + ["gemini:gemini-pro"]
+    # Duas falhas abrem o circuito; a terceira chamada já vai direto para o fallback
+    assert calls_while_open == ["gemini:gemini-pro", "openai:gpt-4o-mini"] * 2 + ["openai:gpt-4o-mini"]
+    assert provider_router.failovers == 2
+    assert provider_router.backend("gemini:gemini-pro").breaker.state == CLOSED
+
+
+def test_slow_primary_is_hedged_and_the_loser_is_cancelled():
+    cancelled = []
+
+    def factory(spec):
+        async def call(messages, timeout, json_mode=False):
+            if spec == "gemini:gemini-pro":
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(spec)
+                    raise
+            return spec
+        return call, 30
+
+    provider_router = ProviderRouter(
+        {"agente": ["gemini:gemini-pro", "openai:gpt-4o-mini"]}, factory,
+        hedge_percentile=0.95, hedge_min_samples=1, hedge_min_delay=0.05,
+    )
+    primary = provider_router.backend("gemini:gemini-pro")
+    primary.stats.record(True, 0.01)
+
+    async def scenario():
+        result = await provider_router.complete("agente", [{"role": "user", "content": "oi"}])
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(scenario()) == "openai:gpt-4o-mini"
+    assert cancelled == ["gemini:gemini-pro"]
+    assert provider_router.hedges == 1 and provider_router.hedge_wins == 1
+    # Perder o hedge não conta como falha do primário
+    assert primary.breaker.state == CLOSED and primary.breaker.failures == 0
+
+
+def test_loser_failing_while_cancelled_has_its_exception_retrieved():
+    unretrieved = []
+    gate = asyncio.Event()
+
+    def factory(spec):
+        async def call(messages, timeout, json_mode=False):
+            if spec == "gemini:gemini-pro":
+                await gate.wait()
+                return spec
+            # O hedge libera o primário e, ao ser cancelado, falha ao fechar a conexão
+            gate.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                raise RuntimeError("conexão fechada")
+        return call, 30
+
+    provider_router = ProviderRouter(
+        {"agente": ["gemini:gemini-pro", "openai:gpt-4o-mini"]}, factory,
+        hedge_percentile=0.95, hedge_min_samples=1, hedge_min_delay=0.01,
+    )
+    provider_router.backend("gemini:gemini-pro").stats.record(True, 0.001)
+
+    async def scenario():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unretrieved.append(context["message"]))
+        result = await provider_router.complete("agente", [{"role": "user", "content": "oi"}])
+        await asyncio.sleep(0.01)
+        gc.collect()
+        return result
+
+    assert asyncio.run(scenario()) == "gemini:gemini-pro"
+    assert provider_router.hedges == 1
+    assert unretrieved == []
+
+
+def make_stream_router(broken: dict, **kwargs):
+    def factory(spec):
+        async def call(messages, timeout, json_mode=False):
+            return spec
+        return call, 10
+
+    def stream_factory(spec):
+        async def stream(messages, timeout, json_mode=False):
+            for index, delta in enumerate(["a", "b", "c"]):
+                if broken.get(spec) == index:
+                    raise RuntimeError(f"{spec} caiu")
+                yield delta
+        return stream
+
+    return ProviderRouter(
+        {"agente": ["gemini:gemini-pro", "openai:gpt-4o-mini"]}, factory, stream_factory,
+        hedge_percentile=0, **kwargs,
+    )
+
+
+async def collect(deltas):
+    return [delta async for delta in deltas]
+
+
+def test_stream_fails_over_before_the_first_chunk(clock):
+    provider_router = make_stream_router({"gemini:gemini-pro": 0}, breaker_threshold=1)
+    messages = [{"role": "user", "content": "oi"}]
+
+    assert asyncio.run(collect(provider_router.stream("agente", messages))) == ["a", "b", "c"]
+    assert provider_router.failovers == 1
+    assert provider_router.backend("gemini:gemini-pro").breaker.state == OPEN
+    assert provider_router.backend("openai:gpt-4o-mini").breaker.failures == 0
+    # Com o circuito aberto, o próximo stream já começa pelo fallback
+    assert asyncio.run(collect(provider_router.stream("agente", messages))) == ["a", "b", "c"]
+    assert provider_router.failovers == 1
+
+
+def test_stream_failure_after_the_first_chunk_reaches_the_consumer(clock):
+    provider_router = make_stream_router({"gemini:gemini-pro": 2})
+    received = []
+
+    async def scenario():
+        async for delta in provider_router.stream("agente", [{"role": "user", "content": "oi"}]):
+            received.append(delta)
+
+    with pytest.raises(RuntimeError, match="caiu"):
+        asyncio.run(scenario())
+    assert received == ["a", "b"]
+    assert provider_router.failovers == 0
+    assert provider_router.backend("gemini:gemini-pro").breaker.failures == 1
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+import semantic_cache
+from semantic_cache import SemanticCache
+
+AGENT = "gerar-copy-social-media"
+
+
+def make_cache(threshold=0.9, ttl=3600, **kwargs):
+    kwargs.setdefault("path", "")
+    return SemanticCache({AGENT: threshold}, {AGENT: ttl}, **kwargs)
+
+
+def similarity(cache, first, second):
+    vectorizer = cache._index(AGENT).vectorizer
+    return float(vectorizer.weigh(vectorizer.tf(first)) @ vectorizer.weigh(vectorizer.tf(second)))
+
+
+def test_reordered_prompt_is_served_from_the_cache():
+    cache = make_cache()
+    cache.set(AGENT, "ctx", "dicas de marketing digital", {"copy": "a"})
+    assert cache.get(AGENT, "ctx", "Marketing digital: dicas") == {"copy": "a"}
+    assert cache.get(AGENT, "outro contexto", "dicas de marketing digital") is None
+
+
+def test_identical_prompt_still_hits_after_the_idf_changes():
+    cache = make_cache()
+    cache.set(AGENT, "ctx", "Post sobre receitas veganas para o fim de semana", {"copy": "a"})
+    for i in range(1000):
+        cache.set(AGENT, "ctx", f"legenda {i} sobre receitas e fim de semana na praia {i % 37}", {"copy": i})
+    assert cache.get(AGENT, "ctx", "Post sobre receitas veganas para o fim de semana") == {"copy": "a"}
+
+
+def test_document_frequencies_only_count_entries_still_in_the_index():
+    cache = make_cache(maxsize=10)
+    for i in range(50):
+        cache.set(AGENT, "ctx", f"texto número {i}", {"copy": i})
+    index = cache._index(AGENT)
+    assert index.vectorizer.documents == 10
+    assert index.evictions == 40
+    assert cache.get(AGENT, "ctx", "texto número 49") == {"copy": 49}
+    assert cache.get(AGENT, "ctx", "texto número 0") is None
+
+
+def test_expired_entries_leave_the_index_on_refresh():
+    cache = make_cache()
+    cache.set(AGENT, "ctx", "promoção de inverno", {"copy": "a"})
+    index = cache._index(AGENT)
+    index.expires_at[0] = 1
+    index.refresh(now=2)
+    assert index.vectorizer.documents == 0
+    assert cache.get(AGENT, "ctx", "promoção de inverno") is None
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "semantic.npz")
+
+    async def scenario():
+        cache = make_cache(path=path)
+        cache.set(AGENT, "ctx", "dicas de marketing digital", {"copy": "a"})
+        await cache.stop()
+        restored = make_cache(path=path)
+        await restored.start()
+        await restored.stop()
+        return restored
+
+    restored = asyncio.run(scenario())
+    assert restored.loaded == 1
+    assert restored.get(AGENT, "ctx", "marketing digital dicas") == {"copy": "a"}
+    assert restored._index(AGENT).vectorizer.documents == 1
+
+
+def test_snapshot_with_another_dimension_is_ignored(tmp_path):
+    path = str(tmp_path / "semantic.npz")
+
+    async def scenario():
+        cache = make_cache(path=path, dim=512)
+        cache.set(AGENT, "ctx", "dicas de marketing digital", {"copy": "a"})
+        await cache.stop()
+        restored = make_cache(path=path, dim=1024)
+        await restored.start()
+        await restored.stop()
+        return restored
+
+    assert asyncio.run(scenario()).loaded == 0
+
+
+def test_refresh_keeps_stored_and_query_vectors_on_the_same_idf():
+    cache = make_cache()
+    for i in range(semantic_cache.IDF_REFRESH_MIN_CHANGES * 2):
+        cache.set(AGENT, "ctx", f"receitas fáceis para o jantar {i}", {"copy": i})
+    assert similarity(cache, "dicas de marketing digital", "dicas de marketing digital") > 0.999
+
+
+def test_negated_prompt_does_not_reuse_the_affirmative_one():
+    cache = make_cache()
+    cache.set(AGENT, "ctx", "Post sobre receitas veganas", {"copy": "a"})
+    assert similarity(cache, "Post sobre receitas veganas", "Post sobre receitas não veganas") > 0.9
+    assert cache.get(AGENT, "ctx", "Post sobre receitas não veganas") is None
+    assert cache.get(AGENT, "ctx", "Post sobre receitas sem ingredientes veganos") is None
+    assert cache.get(AGENT, "ctx", "POST SOBRE RECEITAS VEGANAS!") == {"copy": "a"}
+
+
+@pytest.mark.parametrize("stored, asked", [
+    ("Post de aniversário para a Maria", "Post de aniversário para a Joana"),
+    ("Promoção de inauguração da nossa padaria no centro", "Promoção de inauguração da nossa pizzaria no centro"),
+    ("Lançamento da nova coleção de verão da loja com descontos especiais para clientes fiéis",
+     "Lançamento da nova coleção de inverno da loja com descontos especiais para clientes fiéis"),
+])
+def test_near_misses_with_one_different_word_are_not_reused(stored, asked):
+    cache = make_cache()
+    cache.set(AGENT, "ctx", stored, {"copy": "a"})
+    assert cache.get(AGENT, "ctx", asked) is None
+
+
+def test_accents_case_order_and_connecting_words_do_not_matter():
+    cache = make_cache()
+    cache.set(AGENT, "ctx", "Promoção de inauguração da padaria", {"copy": "a"})
+    assert cache.get(AGENT, "ctx", "PROMOCAO DE INAUGURACAO DA PADARIA!") == {"copy": "a"}
+    assert cache.get(AGENT, "ctx", "inauguração da padaria: promoção") == {"copy": "a"}
+    assert cache.get(AGENT, "ctx", "Promoção inauguração padaria") == {"copy": "a"}
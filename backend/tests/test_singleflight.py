@@ -0,0 +1,101 @@
+import asyncio
+
+from singleflight import SingleFlight
+
+
+class Upstream:
+    """Chamada ao provedor que só termina quando o teste libera."""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return f"resultado {self.calls}"
+
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+def test_concurrent_callers_share_one_upstream_call():
+    async def scenario():
+        flight, upstream = SingleFlight(), Upstream()
+        upstream.release = asyncio.Event()
+        callers = [asyncio.ensure_future(flight.do("chave", upstream)) for _ in range(3)]
+        await settle()
+        upstream.release.set()
+        return await asyncio.gather(*callers), upstream.calls, flight.stats()
+
+    results, calls, stats = asyncio.run(scenario())
+    assert results == ["resultado 1"] * 3
+    assert calls == 1
+    assert stats == {"in_flight": 0, "upstream_calls": 1, "coalesced": 2}
+
+
+def test_cancelling_one_caller_keeps_the_call_for_the_others():
+    async def scenario():
+        flight, upstream = SingleFlight(), Upstream()
+        upstream.release = asyncio.Event()
+        leaving = asyncio.ensure_future(flight.do("chave", upstream))
+        staying = asyncio.ensure_future(flight.do("chave", upstream))
+        await settle()
+        leaving.cancel()
+        await settle()
+        upstream.release.set()
+        return await staying, leaving.cancelled(), upstream.cancelled
+
+    result, left, upstream_cancelled = asyncio.run(scenario())
+    assert result == "resultado 1"
+    assert left
+    assert upstream_cancelled == 0
+
+
+def test_cancelling_every_caller_cancels_the_upstream_call():
+    async def scenario():
+        flight, upstream = SingleFlight(), Upstream()
+        upstream.release = asyncio.Event()
+        callers = [asyncio.ensure_future(flight.do("chave", upstream)) for _ in range(2)]
+        await settle()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await settle()
+        in_flight = flight.stats()["in_flight"]
+
+        # A próxima chamada com a mesma chave começa do zero
+        upstream.release.set()
+        again = await flight.do("chave", upstream)
+        return upstream.cancelled, in_flight, again
+
+    upstream_cancelled, in_flight, again = asyncio.run(scenario())
+    assert upstream_cancelled == 1
+    assert in_flight == 0
+    assert again == "resultado 2"
+
+
+def test_errors_reach_every_caller_and_are_not_kept():
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("provedor fora do ar")
+
+    async def scenario():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("chave", failing) for _ in range(3)), return_exceptions=True)
+        return results, flight.stats()["in_flight"]
+
+    results, in_flight = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert in_flight == 0
@@ -0,0 +1,30 @@
+import asyncio
+
+import structured
+
+
+class ScriptedRouter:
+    """Devolve as respostas na ordem dada e guarda as mensagens de cada chamada."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    async def complete(self, agent_name, messages, json_mode=False):
+        self.calls.append(messages)
+        return self.responses.pop(0)
+
+
+def test_hashtags_keep_only_the_word_part_of_each_tag():
+    output = structured.HashtagsOutput(hashtags=["#marketing-digital", "dicas", "#a #b", "#marketing"])
+    assert output.hashtags == ["#marketing", "#dicas", "#a", "#b"]
+
+
+def test_hashtags_empty_after_normalizing_trigger_a_repair():
+    router = ScriptedRouter('{"hashtags": ["###", "-"]}', '{"hashtags": ["#marketing"]}')
+    result = asyncio.run(structured.complete_structured(
+        router, "pesquisar-hashtags", [{"role": "user", "content": "marketing"}], structured.HASHTAGS, max_repairs=1
+    ))
+    assert result.hashtags == ["#marketing"]
+    assert len(router.calls) == 2
+    assert "nenhum item válido" in router.calls[1][-1]["content"]
@@ -0,0 +1,162 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from main import ApiUsage, RollupState, UsageDaily, UsageHourly, UsageLatencyDaily
+from usage_rollup import UsageRollup
+
+
+def make_rollup(session_factory, **kwargs):
+    kwargs.setdefault("settle_seconds", 0)
+    return UsageRollup(session_factory, ApiUsage, UsageHourly, UsageDaily, UsageLatencyDaily, RollupState, **kwargs)
+
+
+async def add_usage(session_factory, count, user_id=1, agent_name="pesquisar-hashtags", when=None):
+    when = when or datetime.utcnow() - timedelta(minutes=5)
+    async with session_factory() as db:
+        db.add_all(ApiUsage(user_id=user_id, agent_name=agent_name, timestamp=when, latency_ms=120) for _ in range(count))
+        await db.commit()
+
+
+def total(counts):
+    return sum(counts.values())
+
+
+def test_counts_are_the_same_before_and_after_compaction(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        rollup = make_rollup(session_factory, batch_size=2)
+        await add_usage(session_factory, 5)
+        since = datetime.utcnow() - timedelta(days=1)
+        before = await rollup.counts(since)
+        assert await rollup.compact() == 5
+        after = await rollup.counts(since)
+        await engine.dispose()
+        return before, after
+
+    before, after = asyncio.run(scenario())
+    assert total(before) == total(after) == 5
+
+
+def test_compaction_between_the_statements_of_a_read_does_not_double_count(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        reader, compactor = make_rollup(session_factory), make_rollup(session_factory)
+        await add_usage(session_factory, 5)
+
+        # Outro worker compacta logo depois de o leitor ler a marca d'água
+        read_watermark = reader._read_watermark
+
+        async def read_then_compact(db):
+            watermark = await read_watermark(db)
+            assert await compactor.compact() == 5
+            return watermark
+
+        reader._read_watermark = read_then_compact
+        counts = await reader.counts(datetime.utcnow() - timedelta(days=1))
+        reader._read_watermark = read_watermark
+        again = await reader.counts(datetime.utcnow() - timedelta(days=1))
+        await engine.dispose()
+        return counts, again
+
+    counts, again = asyncio.run(scenario())
+    assert total(counts) == 5
+    assert total(again) == 5
+
+
+def test_reads_running_alongside_compactions_always_see_every_row_once(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        readers = [make_rollup(session_factory) for _ in range(3)]
+        compactors = [make_rollup(session_factory, batch_size=3) for _ in range(2)]
+        await add_usage(session_factory, 20)
+        since = datetime.utcnow() - timedelta(days=1)
+        results = await asyncio.gather(
+            *(compactor.compact() for compactor in compactors),
+            *(reader.counts(since) for reader in readers for _ in range(5)),
+        )
+        compacted = sum(results[:len(compactors)])
+        totals = [total(counts) for counts in results[len(compactors):]]
+        await engine.dispose()
+        return compacted, totals
+
+    compacted, totals = asyncio.run(scenario())
+    # O compare-and-set da marca impede que dois compactadores somem o mesmo lote
+    assert compacted == 20
+    assert totals == [20] * len(totals)
+
+
+def test_rows_inside_the_settle_window_stay_in_the_raw_tail(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        rollup = make_rollup(session_factory, settle_seconds=60)
+        await add_usage(session_factory, 3, when=datetime.utcnow())
+        compacted = await rollup.compact()
+        counts = await rollup.counts(datetime.utcnow() - timedelta(days=1))
+        await engine.dispose()
+        return compacted, counts
+
+    compacted, counts = asyncio.run(scenario())
+    assert compacted == 0
+    assert total(counts) == 3
+
+
+def test_older_rows_behind_a_recent_one_are_not_skipped(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        rollup = make_rollup(session_factory, settle_seconds=60, raw_retention_days=30)
+        # Um flush regravado depois de uma falha: timestamps antigos com ids maiores
+        await add_usage(session_factory, 1, when=datetime.utcnow())
+        await add_usage(session_factory, 2, when=datetime.utcnow() - timedelta(days=40))
+        compacted = await rollup.compact()
+        deleted = await rollup.apply_retention()
+        rollup.settle = timedelta(0)  # a linha recente assenta
+        compacted_later = await rollup.compact()
+        counts = await rollup.counts(datetime.utcnow() - timedelta(days=41))
+        await engine.dispose()
+        return compacted, deleted, compacted_later, counts
+
+    compacted, deleted, compacted_later, counts = asyncio.run(scenario())
+    assert compacted == 0 and deleted == 0
+    assert compacted_later == 3
+    assert total(counts) == 3
+
+
+def test_concurrent_compactors_sum_each_row_once(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        compactors = [make_rollup(session_factory, batch_size=3) for _ in range(3)]
+        await add_usage(session_factory, 20)
+        compacted = sum(await asyncio.gather(*(compactor.compact() for compactor in compactors)))
+        # Quem perdeu o compare-and-set termina o que sobrou
+        compacted += await compactors[0].compact()
+        counts = await compactors[0].counts(datetime.utcnow() - timedelta(days=1))
+        await engine.dispose()
+        return compacted, counts
+
+    compacted, counts = asyncio.run(scenario())
+    assert compacted == 20
+    assert total(counts) == 20
+
+
+def test_retention_only_deletes_compacted_rows(open_database):
+    async def scenario():
+        engine, session_factory = await open_database()
+        rollup = make_rollup(session_factory, raw_retention_days=30)
+        old = datetime.utcnow() - timedelta(days=40)
+        await add_usage(session_factory, 4, when=old)
+        await rollup.compact()
+        await add_usage(session_factory, 2, when=old)  # ainda não compactadas
+        deleted = await rollup.apply_retention()
+        async with session_factory() as db:
+            remaining = await db.scalar(select(func.count(ApiUsage.id)))
+        counts = await rollup.counts(old - timedelta(days=1))
+        await engine.dispose()
+        return deleted, remaining, counts
+
+    deleted, remaining, counts = asyncio.run(scenario())
+    # A linha da própria marca d'água fica (ver apply_retention)
+    assert deleted == 3
+    assert remaining == 3
+    assert total(counts) == 6
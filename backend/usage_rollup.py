@@ -0,0 +1,306 @@
+# backend/usage_rollup.py
+
+"""
+Agregados de uso (por hora e por dia) e retenção do log bruto `api_usage`.
+
+`api_usage` recebe uma linha por chamada de agente. Em vez de varrer esse log
+a cada consulta, um compactador incremental soma as linhas novas nas tabelas
+`usage_hourly` e `usage_daily`, chaveadas por (usuário, agente, período), e
+as latências num histograma diário por faixas logarítmicas
+(`usage_latency_daily`), que permite calcular percentis sem o log bruto:
+
+- o progresso fica numa marca d'água (`rollup_state`): o maior id de
+  `api_usage` já somado. Cada rodada processa no máximo `batch_size` linhas
+  com id acima da marca, parando na primeira mais nova que `settle_seconds`
+  (para não pular linhas de transações que ainda não fizeram commit). Só o
+  prefixo contíguo de ids é somado: um lote regravado depois de uma falha,
+  ou workers gravando fora de ordem, podem pôr timestamps antigos em ids
+  maiores que os de linhas recentes, e estas ficariam abaixo da marca;
+- a marca é avançada com compare-and-set na mesma transação dos UPSERTs, então
+  vários workers podem rodar o compactador sem contar a mesma linha duas vezes;
+- depois de `raw_retention_days`, linhas brutas já compactadas são apagadas;
+  os agregados por hora ficam `hourly_retention_days` e os diários para sempre.
+
+As consultas (cota do dia, relatórios) leem os agregados e somam só a cauda
+ainda não compactada do log bruto, então o custo não cresce com o histórico.
+"""
+
+import asyncio
+import logging
+import math
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+logger = logging.getLogger(__name__)
+
+WATERMARK = "api_usage"
+
+# Faixas de latência: [0, 10ms), depois cada faixa é 25% maior que a anterior (até ~6min)
+LATENCY_BIN_BASE_MS = 10
+LATENCY_BIN_GROWTH = 1.25
+LATENCY_BINS = 48
+
+
+def latency_bin(latency_ms: float) -> int:
+    if latency_ms < LATENCY_BIN_BASE_MS:
+        return 0
+    return min(int(math.log(latency_ms / LATENCY_BIN_BASE_MS, LATENCY_BIN_GROWTH)) + 1, LATENCY_BINS - 1)
+
+
+def latency_bin_upper_ms(index: int) -> float:
+    return LATENCY_BIN_BASE_MS * LATENCY_BIN_GROWTH ** index
+
+
+def _hour_start(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+class UsageRollup:
+    def __init__(self, session_factory, usage_model, hourly_model, daily_model, latency_model, state_model,
+                 interval: float = None, batch_size: int = None, settle_seconds: float = None,
+                 raw_retention_days: int = None, hourly_retention_days: int = None):
+        self._session_factory = session_factory
+        self._usage_model = usage_model
+        self._hourly_model = hourly_model
+        self._daily_model = daily_model
+        self._latency_model = latency_model
+        self._state_model = state_model
+        self.interval = interval or float(os.getenv("ROLLUP_INTERVAL", 60))
+        self.batch_size = batch_size or int(os.getenv("ROLLUP_BATCH_SIZE", 5000))
+        self.settle = timedelta(seconds=float(os.getenv("ROLLUP_SETTLE_SECONDS", 60)) if settle_seconds is None else settle_seconds)
+        # 0 mantém as linhas para sempre
+        self.raw_retention_days = int(os.getenv("USAGE_RAW_RETENTION_DAYS", 30)) if raw_retention_days is None else raw_retention_days
+        self.hourly_retention_days = int(os.getenv("USAGE_HOURLY_RETENTION_DAYS", 90)) if hourly_retention_days is None else hourly_retention_days
+        self.compacted_rows = 0
+        self.deleted_rows = 0
+        self._task = None
+
+    # --- Compactação ---
+    def _upsert(self, db, model, rows, keys, totals):
+        """INSERT ... ON CONFLICT somando as colunas `totals` às já existentes."""
+        dialect = postgresql if db.bind.dialect.name == "postgresql" else sqlite
+        stmt = dialect.insert(model)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: getattr(model, column) + getattr(stmt.excluded, column) for column in totals},
+        )
+        return db.execute(stmt, rows)
+
+    async def _read_watermark(self, db) -> int:
+        State = self._state_model
+        return await db.scalar(select(State.value).where(State.name == WATERMARK)) or 0
+
+    async def _watermark(self, db) -> int:
+        State = self._state_model
+        value = await db.scalar(select(State.value).where(State.name == WATERMARK))
+        if value is None:
+            dialect = postgresql if db.bind.dialect.name == "postgresql" else sqlite
+            await db.execute(dialect.insert(State).values(name=WATERMARK, value=0).on_conflict_do_nothing())
+            await db.commit()
+            value = 0
+        return value
+
+    async def _begin_snapshot(self, db):
+        """
+        Faz as próximas leituras de `db` verem um único snapshot do banco, até o
+        fim da transação. No Postgres, READ COMMITTED tira um snapshot por
+        comando; o pysqlite só abre transação antes de escritas, então sem o
+        BEGIN explícito cada SELECT também veria um estado diferente.
+        """
+        if db.bind.dialect.name == "postgresql":
+            await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        else:
+            await db.execute(text("BEGIN"))
+
+    async def compact_once(self) -> int:
+        """Soma um lote de linhas novas nos agregados. Retorna quantas linhas foram compactadas."""
+        Usage, State = self._usage_model, self._state_model
+        cutoff = datetime.utcnow() - self.settle
+        async with self._session_factory() as db:
+            watermark = await self._watermark(db)
+            rows = (await db.execute(
+                select(Usage.id, Usage.user_id, Usage.agent_name, Usage.timestamp, Usage.cache_hit, Usage.latency_ms)
+                .where(Usage.id > watermark)
+                .order_by(Usage.id)
+                .limit(self.batch_size)
+            )).all()
+            # A marca não pode passar de uma linha ainda dentro do `settle`
+            settled = next((i for i, row in enumerate(rows) if row.timestamp >= cutoff), len(rows))
+            rows = rows[:settled]
+            if not rows:
+                return 0
+            # Compare-and-set: se outro worker avançou a marca antes, desiste desta rodada
+            advanced = await db.execute(
+                update(State).where(State.name == WATERMARK, State.value == watermark).values(value=rows[-1].id)
+            )
+            if advanced.rowcount != 1:
+                await db.rollback()
+                return 0
+            hourly, daily, latency = self._fold(rows, hourly=True, daily=True, latency=True)
+            keys = ["user_id", "agent_name", "bucket"]
+            for model, totals in ((self._hourly_model, hourly), (self._daily_model, daily)):
+                await self._upsert(db, model, [
+                    {"user_id": user_id, "agent_name": agent_name, "bucket": bucket, "count": count, "cache_hits": cache_hits}
+                    for (user_id, agent_name, bucket), (count, cache_hits) in totals.items()
+                ], keys, ("count", "cache_hits"))
+            if latency:
+                await self._upsert(db, self._latency_model, [
+                    {"user_id": user_id, "agent_name": agent_name, "bucket": bucket, "bin": bin_, "count": count}
+                    for (user_id, agent_name, bucket, bin_), count in latency.items()
+                ], keys + ["bin"], ("count",))
+            await db.commit()
+        self.compacted_rows += len(rows)
+        return len(rows)
+
+    async def compact(self) -> int:
+        """Compacta até alcançar o fim do log (respeitando o `settle`)."""
+        total = 0
+        while True:
+            compacted = await self.compact_once()
+            total += compacted
+            if compacted < self.batch_size:
+                return total
+
+    async def apply_retention(self) -> int:
+        Usage, Hourly = self._usage_model, self._hourly_model
+        now = datetime.utcnow()
+        deleted = 0
+        async with self._session_factory() as db:
+            watermark = await self._watermark(db)
+            if self.raw_retention_days > 0:
+                # Só apaga o que já está nos agregados. A linha da própria marca fica: sem
+                # AUTOINCREMENT o SQLite reusaria ids abaixo dela e linhas novas seriam ignoradas
+                result = await db.execute(delete(Usage).where(
+                    Usage.id < watermark, Usage.timestamp < now - timedelta(days=self.raw_retention_days)
+                ))
+                deleted += result.rowcount
+            if self.hourly_retention_days > 0:
+                await db.execute(delete(Hourly).where(Hourly.bucket < now - timedelta(days=self.hourly_retention_days)))
+            await db.commit()
+        self.deleted_rows += deleted
+        return deleted
+
+    async def _loop(self):
+        last_retention = None
+        while True:
+            try:
+                await self.compact()
+                if last_retention is None or datetime.utcnow() - last_retention > timedelta(hours=1):
+                    await self.apply_retention()
+                    last_retention = datetime.utcnow()
+            except Exception:
+                logger.exception("Falha ao compactar os registros de uso")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- Consultas ---
+    @staticmethod
+    def _fold(rows, hourly=False, daily=False, latency=False, include_cache_hits=True):
+        """Agrega linhas brutas de `api_usage` no mesmo formato das tabelas de agregados."""
+        hourly_totals = defaultdict(lambda: [0, 0])
+        daily_totals = defaultdict(lambda: [0, 0])
+        latency_totals = defaultdict(int)
+        for row in rows:
+            if row.cache_hit and not include_cache_hits:
+                continue
+            day = row.timestamp.date()
+            targets = []
+            if hourly:
+                targets.append(hourly_totals[(row.user_id, row.agent_name, _hour_start(row.timestamp))])
+            if daily:
+                targets.append(daily_totals[(row.user_id, row.agent_name, day)])
+            for entry in targets:
+                entry[0] += 1
+                entry[1] += int(bool(row.cache_hit))
+            if latency and row.latency_ms is not None:
+                latency_totals[(row.user_id, row.agent_name, day, latency_bin(row.latency_ms))] += 1
+        return hourly_totals, daily_totals, latency_totals
+
+    async def read(self, since: datetime, until: datetime = None, user_id: int = None, agent_name: str = None,
+                   hourly: bool = False, daily: bool = True, latency: bool = False) -> dict:
+        """
+        Agregados entre `since` e `until` (alinhados ao dia; `hourly` aceita
+        horas), somados às linhas brutas ainda não compactadas. A marca d'água,
+        a cauda bruta e os agregados são lidos numa única transação: uma
+        compactação de outro worker no meio da leitura não conta linhas duas
+        vezes. Retorna um dict com as chaves pedidas, mais `watermark` (a marca
+        usada):
+
+        - `hourly` / `daily`: (usuário, agente, período) -> [usos, acertos de cache]
+        - `latency`: (usuário, agente, dia, faixa) -> quantidade
+        """
+        Usage = self._usage_model
+        wanted = {"hourly": (self._hourly_model, _hour_start(since), until and _hour_start(until)),
+                  "daily": (self._daily_model, since.date(), until and until.date()),
+                  "latency": (self._latency_model, since.date(), until and until.date())}
+        flags = {"hourly": hourly, "daily": daily, "latency": latency}
+        async with self._session_factory() as db, db.begin():
+            await self._begin_snapshot(db)
+            watermark = await self._read_watermark(db)
+            raw = select(Usage.user_id, Usage.agent_name, Usage.timestamp, Usage.cache_hit, Usage.latency_ms).where(
+                Usage.id > watermark, Usage.timestamp >= since
+            )
+            if until is not None:
+                raw = raw.where(Usage.timestamp < until)
+            if user_id is not None:
+                raw = raw.where(Usage.user_id == user_id)
+            if agent_name is not None:
+                raw = raw.where(Usage.agent_name == agent_name)
+            hourly_totals, daily_totals, latency_totals = self._fold((await db.execute(raw)).all(), hourly, daily, latency)
+            result = {"hourly": hourly_totals, "daily": daily_totals, "latency": latency_totals}
+
+            for name, (model, start, end) in wanted.items():
+                if not flags[name]:
+                    result.pop(name)
+                    continue
+                query = select(model).where(model.bucket >= start)
+                if end is not None:
+                    query = query.where(model.bucket < end)
+                if user_id is not None:
+                    query = query.where(model.user_id == user_id)
+                if agent_name is not None:
+                    query = query.where(model.agent_name == agent_name)
+                totals = result[name]
+                for row in (await db.execute(query)).scalars():
+                    if name == "latency":
+                        totals[(row.user_id, row.agent_name, row.bucket, row.bin)] += row.count
+                    else:
+                        entry = totals[(row.user_id, row.agent_name, row.bucket)]
+                        entry[0] += row.count
+                        entry[1] += row.cache_hits
+                result[name] = dict(totals)
+        result["watermark"] = watermark
+        return result
+
+    async def counts(self, since: datetime, until: datetime = None, user_id: int = None,
+                     include_cache_hits: bool = True) -> dict:
+        """Usos por (usuário, agente, dia) entre `since` e `until`."""
+        daily = (await self.read(since, until, user_id=user_id))["daily"]
+        return {key: count if include_cache_hits else count - cache_hits for key, (count, cache_hits) in daily.items()}
+
+    async def watermark(self) -> int:
+        """Marca d'água atual (o maior id de `api_usage` já compactado)."""
+        async with self._session_factory() as db:
+            return await self._read_watermark(db)
+
+    async def stats(self) -> dict:
+        Usage = self._usage_model
+        async with self._session_factory() as db:
+            watermark = await self._watermark(db)
+            backlog = await db.scalar(select(func.count()).select_from(Usage).where(Usage.id > watermark))
+        return {"watermark": watermark, "backlog": backlog, "compacted_rows": self.compacted_rows, "deleted_rows": self.deleted_rows}
@@ -87,20 +87,6 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
       sendResponse({ success: true, message: 'Post scheduled successfully (simulated).' });
     }, 1000);
     return true; // Indicates that sendResponse will be called asynchronously
-  } else if (request.action === 'fetchEngagementMetrics') {
-    // Simulate fetching engagement metrics
-    console.log("Simulating fetching engagement metrics...");
-    setTimeout(() => {
-      sendResponse({ success: true, data: { likes: 1234, comments: 567, shares: 89, reach: 123456 } });
-    }, 1000);
-    return true; // Indicates that sendResponse will be called asynchronously
-  } else if (request.action === 'fetchBestPostTimes') {
-    // Simulate fetching best post times
-    console.log("Simulating fetching best post times...");
-    setTimeout(() => {
-      sendResponse({ success: true, data: { monday: '10:00 AM', tuesday: '11:30 AM', wednesday: '09:00 AM' } });
-    }, 1000);
-    return true; // Indicates that sendResponse will be called asynchronously
   }
 });
 
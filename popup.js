@@ -126,6 +126,77 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     };
 
+    const getApi = async (endpoint, buttonToLoad) => {
+        setLoading(buttonToLoad, true);
+        try {
+            const apiUrl = appState.apiUrl;
+            if (!apiUrl) {
+                throw new Error("API URL não configurada. Recarregue a extensão.");
+            }
+            const headers = {};
+            if (appState.authToken) {
+                headers['Authorization'] = `Bearer ${appState.authToken}`;
+            }
+
+            const response = await fetch(`${apiUrl}${endpoint}`, { headers: headers });
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
+            }
+            return await response.json();
+        } finally {
+            setLoading(buttonToLoad, false);
+        }
+    };
+
+    // Chama um endpoint de streaming (NDJSON) e repassa cada evento para onEvent
+    const streamApi = async (endpoint, body, buttonToLoad, onEvent) => {
+        setLoading(buttonToLoad, true);
+        try {
+            const apiUrl = appState.apiUrl;
+            if (!apiUrl) {
+                throw new Error("API URL não configurada. Recarregue a extensão.");
+            }
+            const headers = {
+                'Content-Type': 'application/json',
+            };
+            if (appState.authToken) {
+                headers['Authorization'] = `Bearer ${appState.authToken}`;
+            }
+
+            const response = await fetch(`${apiUrl}${endpoint}`, {
+                method: 'POST',
+                headers: headers,
+                body: JSON.stringify(body),
+            });
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
+            }
+
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const event = JSON.parse(line);
+                    if (event.type === 'error') {
+                        throw new Error(event.detail);
+                    }
+                    onEvent(event);
+                }
+            }
+        } finally {
+            setLoading(buttonToLoad, false);
+        }
+    };
+
     // --- AUTHENTICATION LOGIC ---
     const handleLogin = () => {
         chrome.runtime.sendMessage({ action: 'initiateOAuth', platform: 'google' }, async (response) => {
@@ -285,8 +356,14 @@ document.addEventListener('DOMContentLoaded', function () {
             const requestBody = {
                 original_copy: contentToVary,
             };
-            const data = await callApi('/generate-copy-variations', requestBody, generateVariationsBtn);
-            generatedVariationsOutput.textContent = data.variations.map((v, i) => `${i + 1}. ${v}`).join('\n\n');
+            // Cada variação aparece assim que o modelo termina de escrevê-la
+            const variations = [];
+            await streamApi('/generate-copy-variations/stream', requestBody, generateVariationsBtn, (event) => {
+                if (event.type === 'item') {
+                    variations.push(event.text);
+                    generatedVariationsOutput.textContent = variations.map((v, i) => `${i + 1}. ${v}`).join('\n\n');
+                }
+            });
         } catch (error) {
             generatedVariationsOutput.textContent = `Error from Copy Variations Agent: ${error.message}`;
         }
@@ -337,36 +414,36 @@ document.addEventListener('DOMContentLoaded', function () {
     const fetchBestTimesBtn = document.getElementById('fetch-best-times');
     const bestTimesOutput = document.getElementById('best-times-output');
 
+    // Analytics de uso vindos do backend (/analytics/usage); o fuso ajusta o mapa de calor
+    const fetchUsageAnalytics = (button) => {
+        const tzOffset = -new Date().getTimezoneOffset();
+        return getApi(`/analytics/usage?days=30&tz_offset_minutes=${tzOffset}`, button);
+    };
+
     fetchEngagementBtn.addEventListener('click', async () => {
-        setLoading(fetchEngagementBtn, true);
-        engagementOutput.textContent = "Fetching engagement metrics...";
+        engagementOutput.textContent = "Fetching usage metrics...";
         try {
-            const response = await chrome.runtime.sendMessage({ action: 'fetchEngagementMetrics' });
-            if (response.success) {
-                engagementOutput.textContent = JSON.stringify(response.data, null, 2);
-            } else {
-                engagementOutput.textContent = `Error: ${response.message}`;
-            }
+            const data = await fetchUsageAnalytics(fetchEngagementBtn);
+            engagementOutput.textContent = JSON.stringify({ totals: data.totals, agents: data.agents }, null, 2);
         } catch (error) {
             engagementOutput.textContent = `Error: ${error.message}`;
         }
-        setLoading(fetchEngagementBtn, false);
     });
 
     fetchBestTimesBtn.addEventListener('click', async () => {
-        setLoading(fetchBestTimesBtn, true);
-        bestTimesOutput.textContent = "Fetching best post times...";
+        bestTimesOutput.textContent = "Fetching peak activity hours...";
         try {
-            const response = await chrome.runtime.sendMessage({ action: 'fetchBestPostTimes' });
-            if (response.success) {
-                bestTimesOutput.textContent = JSON.stringify(response.data, null, 2);
+            const data = await fetchUsageAnalytics(fetchBestTimesBtn);
+            if (data.peak_hours.length === 0) {
+                bestTimesOutput.textContent = "No activity in the last 30 days yet.";
             } else {
-                bestTimesOutput.textContent = `Error: ${response.message}`;
+                bestTimesOutput.textContent = data.peak_hours
+                    .map(peak => `${peak.weekday} ${String(peak.hour).padStart(2, '0')}:00 (${peak.calls} calls)`)
+                    .join('\n');
             }
         } catch (error) {
             bestTimesOutput.textContent = `Error: ${error.message}`;
         }
-        setLoading(fetchBestTimesBtn, false);
     });
 
     // Inicia a aplicação